@@ -1,5 +1,4 @@
 from django.contrib import admin
-from django.core.cache import cache
 from django.utils.html import format_html
 from django.urls import reverse
 from django.contrib import messages
@@ -54,7 +53,7 @@ class ServiceAdmin(admin.ModelAdmin):
     list_editable = ['is_active', 'profit_margin']
     fieldsets = (
         ('Basic Information', {
-            'fields': ('name', 'code', 'icon_url', 'is_active', 'supports_multiple_sms', 'mtelsms_service_id')
+            'fields': ('name', 'code', 'icon_url', 'is_active', 'supports_multiple_sms', 'mtelsms_service_id', 'fivesim_product')
         }),
         ('Pricing', {
             'fields': ('price', 'profit_margin'),
@@ -82,15 +81,9 @@ class ServiceAdmin(admin.ModelAdmin):
         try:
             from .mtelsms import get_mtelsms_client
             
-            # Use cached prices to avoid too many API calls (cache for 5 minutes)
-            cache_key = 'mtelsms_realtime_prices'
-            prices_data = cache.get(cache_key)
-            
-            if prices_data is None:
-                # Get real-time price from MTelSMS
-                client = get_mtelsms_client()
-                prices_data = client.get_prices_verification()
-                cache.set(cache_key, prices_data, 300)  # Cache for 5 minutes
+            # Service list is served from the shared provider cache (5 minutes)
+            client = get_mtelsms_client()
+            prices_data = client.get_prices_verification()
             
             # Look for this service in the pricing data
             if obj.code in prices_data:
@@ -144,7 +137,20 @@ class ServiceAdmin(admin.ModelAdmin):
     
     update_prices_from_api.short_description = "Update prices from provider API"
     
-    actions = ['update_prices_from_api']
+    def clear_sold_out(self, request, queryset):
+        """Offer the selected services again before their sold-out entries expire"""
+        from .stock_cache import clear_sold_out
+        
+        cleared = 0
+        for service in queryset:
+            cleared += clear_sold_out('MTELSMS', service.code)
+            if service.fivesim_product:
+                cleared += clear_sold_out('FIVESIM', service.fivesim_product)
+        messages.success(request, f"Cleared {cleared} sold-out entr{'y' if cleared == 1 else 'ies'}.")
+    
+    clear_sold_out.short_description = "Clear sold-out status (offer again now)"
+    
+    actions = ['update_prices_from_api', 'clear_sold_out']
     
     def is_special_service(self, obj):
         return obj.code == 'service_not_listed'
@@ -168,6 +174,14 @@ class ServiceAdmin(admin.ModelAdmin):
                 'Service Not Listed is not set up. You can create it by running: python manage.py add_service_not_listed'
             )
         
+        # Combinations purchases currently skip because the provider had no numbers
+        from datetime import datetime
+        from .stock_cache import sold_out_list
+        for entry in sold_out_list():
+            until = datetime.fromtimestamp(entry['until'], tz=timezone.get_current_timezone())
+            where = entry['product'] if entry['provider'] == 'MTELSMS' else f"{entry['country']}/{entry['operator']}/{entry['product']}"
+            messages.info(request, f"Sold out on {entry['provider']}: {where} - not offered until {until:%H:%M:%S}")
+        
         return super().changelist_view(request, extra_context)
 
 @admin.register(Rental)
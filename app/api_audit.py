@@ -0,0 +1,165 @@
+"""
+Buffered API Request Log
+Queues APIRequest records in memory and writes them with bulk_create from a
+background thread, so reseller API calls don't pay for an INSERT on the
+request thread.
+
+A batch is written when API_AUDIT_BATCH_SIZE records are queued or
+API_AUDIT_FLUSH_INTERVAL seconds have passed, whichever comes first. Records
+are dropped (and counted) if the queue holds API_AUDIT_MAX_QUEUE records.
+Set API_AUDIT_ASYNC = False to write each record immediately instead.
+"""
+
+import atexit
+import logging
+import queue
+import threading
+import time
+from typing import Dict, List
+
+from django.conf import settings
+from django.db import close_old_connections, connection
+
+logger = logging.getLogger(__name__)
+
+
+class APIRequestLogSink:
+    """
+    Background writer for APIRequest records
+    """
+
+    def __init__(self, batch_size: int = 100, flush_interval: float = 2.0,
+                 max_queue: int = 10000, async_writes: bool = True):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.async_writes = async_writes
+        self.queue = queue.Queue(maxsize=max_queue)
+
+        self.stats = {'queued': 0, 'flushed': 0, 'dropped': 0, 'failed': 0}
+        self.stats_lock = threading.Lock()
+
+        self.thread = None
+        self.thread_lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.stopping = threading.Event()
+
+    def _count(self, name: str, amount: int = 1):
+        with self.stats_lock:
+            self.stats[name] += amount
+
+    def get_stats(self) -> Dict[str, int]:
+        """Counters plus the number of records still waiting to be written"""
+        with self.stats_lock:
+            stats = dict(self.stats)
+        stats['pending'] = self.queue.qsize()
+        return stats
+
+    def submit(self, record) -> bool:
+        """
+        Queue an unsaved APIRequest for writing
+
+        Returns:
+            bool: False if the record was dropped because the queue is full
+        """
+        if not self.async_writes:
+            self._write([record])
+            return True
+
+        self._ensure_thread()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self._count('dropped')
+            logger.warning("API request log queue full, dropping record")
+            return False
+
+        self._count('queued')
+        return True
+
+    def _ensure_thread(self):
+        """Start the writer thread on first use (not at import time)"""
+        if self.thread and self.thread.is_alive():
+            return
+        with self.thread_lock:
+            if self.thread and self.thread.is_alive():
+                return
+            self.stopping.clear()
+            self.thread = threading.Thread(target=self._run, name='api-request-log', daemon=True)
+            self.thread.start()
+
+    def _run(self):
+        """Writer loop: collect a batch until it is full or the interval passes"""
+        try:
+            while not self.stopping.is_set():
+                batch = self._collect(time.monotonic() + self.flush_interval)
+                if batch:
+                    close_old_connections()
+                    self._write(batch)
+        finally:
+            connection.close()
+
+    def _collect(self, deadline: float) -> List:
+        batch = []
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, batch: List):
+        from .api_models import APIRequest
+
+        with self.flush_lock:
+            try:
+                APIRequest.objects.bulk_create(batch, batch_size=self.batch_size)
+                self._count('flushed', len(batch))
+                return
+            except Exception as e:
+                logger.error(f"Failed to write {len(batch)} API request log records, retrying one by one: {str(e)}")
+
+            # Don't lose the whole batch to one bad record
+            for record in batch:
+                try:
+                    record.save(force_insert=True)
+                    self._count('flushed')
+                except Exception as e:
+                    self._count('failed')
+                    logger.error(f"Failed to write API request log record: {str(e)}")
+
+    def flush(self) -> int:
+        """
+        Write everything queued so far on the calling thread
+
+        Returns:
+            int: Number of records taken from the queue
+        """
+        batch = []
+        while True:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+
+        for start in range(0, len(batch), self.batch_size):
+            self._write(batch[start:start + self.batch_size])
+        return len(batch)
+
+    def stop(self, timeout: float = 5.0):
+        """Stop the writer thread and write any remaining records"""
+        self.stopping.set()
+        if self.thread and self.thread.is_alive():
+            self.thread.join(timeout)
+        self.flush()
+
+
+audit_log = APIRequestLogSink(
+    batch_size=getattr(settings, 'API_AUDIT_BATCH_SIZE', 100),
+    flush_interval=getattr(settings, 'API_AUDIT_FLUSH_INTERVAL', 2.0),
+    max_queue=getattr(settings, 'API_AUDIT_MAX_QUEUE', 10000),
+    async_writes=getattr(settings, 'API_AUDIT_ASYNC', True),
+)
+atexit.register(audit_log.stop)
@@ -8,6 +8,7 @@ from functools import wraps
 from django.http import JsonResponse
 from django.contrib.auth.models import User
 from .models import APIKey
+from .rate_limit import check_rate_limit, usage_recorder
 import logging
 
 logger = logging.getLogger(__name__)
@@ -51,8 +52,8 @@ def get_user_from_api_key(api_key: str):
         if not api_key_obj.user.is_active:
             return None, None
         
-        # Update last used timestamp
-        api_key_obj.record_usage()
+        # Count usage; written to the APIKey row in periodic batches
+        usage_recorder.record(api_key_obj.pk)
         
         return api_key_obj.user, api_key_obj
         
@@ -88,22 +89,27 @@ def require_api_key(f):
                 'error': 'Invalid or inactive API key.'
             }, status=401)
         
-        # Check rate limit
-        if api_key_obj.is_rate_limited():
-            return JsonResponse({
+        # Check rate limit (token bucket, no database query)
+        rate_limit = check_rate_limit(api_key_obj)
+        if rate_limit and not rate_limit.allowed:
+            response = JsonResponse({
                 'success': False,
                 'error': 'Rate limit exceeded. Please try again later.',
                 'rate_limit': {
                     'max_requests_per_minute': api_key_obj.rate_limit_per_minute,
-                    'retry_after': 60  # seconds
+                    'retry_after': rate_limit.retry_after  # seconds
                 }
             }, status=429)
+            return rate_limit.apply_headers(response)
         
         # Attach user and api_key to request
         request.api_user = user
         request.api_key_obj = api_key_obj
         
-        return f(request, *args, **kwargs)
+        response = f(request, *args, **kwargs)
+        if rate_limit:
+            rate_limit.apply_headers(response)
+        return response
     
     return decorated_function
 
@@ -108,8 +108,8 @@ class APIRequest(models.Model):
     order_id = models.CharField(max_length=100, null=True, blank=True)
     amount = models.DecimalField(max_digits=12, decimal_places=2, null=True, blank=True)
     
-    # Timestamp
-    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+    # Timestamp (set when the request is logged, not when the batch is written)
+    created_at = models.DateTimeField(default=timezone.now, db_index=True)
     
     class Meta:
         ordering = ['-created_at']
@@ -184,6 +184,52 @@ class APIOrderMapping(models.Model):
         ordering = ['-created_at']
         verbose_name = "API Order"
         verbose_name_plural = "API Orders"
+        indexes = [
+            # Reseller order list: an API key's orders, newest first
+            models.Index(fields=['api_key', '-created_at'], name='apiorder_key_created_idx'),
+        ]
     
     def __str__(self):
         return f"API Order {self.api_order_id} by {self.api_key.user.username}"
+
+
+class WebhookDelivery(models.Model):
+    """
+    Outbox of webhook events waiting to be sent to an APIWebhook endpoint
+    """
+    EVENT_CHOICES = [
+        ('sms_received', 'SMS Received'),
+        ('order_expired', 'Order Expired'),
+        ('order_cancelled', 'Order Cancelled'),
+    ]
+    
+    STATUS_CHOICES = [
+        ('PENDING', 'Pending'),
+        ('DELIVERED', 'Delivered'),
+        ('FAILED', 'Failed'),
+    ]
+    
+    webhook = models.ForeignKey(APIWebhook, on_delete=models.CASCADE, related_name='deliveries')
+    event = models.CharField(max_length=30, choices=EVENT_CHOICES)
+    payload = models.JSONField()
+    # One delivery per webhook/event/order, so racing emitters don't send duplicates
+    dedupe_key = models.CharField(max_length=255, unique=True)
+    
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='PENDING')
+    attempts = models.IntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    
+    created_at = models.DateTimeField(auto_now_add=True)
+    delivered_at = models.DateTimeField(null=True, blank=True)
+    
+    class Meta:
+        ordering = ['created_at']
+        verbose_name = "Webhook Delivery"
+        verbose_name_plural = "Webhook Deliveries"
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at'], name='webhook_due_idx'),
+        ]
+    
+    def __str__(self):
+        return f"{self.event} -> {self.webhook.url} ({self.status})"
@@ -1,17 +1,24 @@
-from django.http import JsonResponse
+from django.http import JsonResponse, HttpResponse, StreamingHttpResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_http_methods
 from django.contrib.auth.decorators import login_required
 from django.shortcuts import get_object_or_404, redirect
+from django.urls import reverse
 from django.utils import timezone
 from django.db import transaction
 from django.db import models
-from decimal import Decimal
+from decimal import Decimal, InvalidOperation
 import json
 import logging
 
-from .models import UserProfile, Service, Rental, SMSMessage, Transaction
+from .models import UserProfile, Service, Rental, Transaction
 from .mtelsms import get_mtelsms_client, MTelSMSException
+from .sms_poller import get_cached_rental_status
+from .live_updates import event_stream, live_updates_enabled
+from .refunds import queue_rental_refund, apply_refunds, rental_refund_key
+from .purchase_pipeline import InsufficientBalance
+from .providers import Product, NoNumbers, ProviderFailed
+from .routing import route_purchase, NoProvider, PriceAboveQuote
 from .korapay import KoraPayClient
 
 logger = logging.getLogger(__name__)
@@ -83,120 +90,88 @@ def rent_number(request):
         
         service = get_object_or_404(Service, code=service_code, is_active=True)
         
-        # Get service price (USD converted to NGN + profit margin)
-        service_price_naira = service.get_naira_price()
-        service_price_usd = service.get_usd_price()
+        # Validate that some provider can sell it
+        service_id = service.mtelsms_service_id
+        if (not service_id or service_id.strip() == '') and not service.fivesim_product:
+            logger.error(f"Service {service.name} ({service.code}) has no MTelSMS service_id")
+            return error_response(f"Service '{service.name}' is not available. Please contact support.")
         
+        # A higher price than the listed one, agreed to after a PriceAboveQuote answer
+        accept_price = None
+        if data.get('accept_price'):
+            try:
+                accept_price = Decimal(str(data['accept_price']))
+            except (InvalidOperation, ValueError):
+                return error_response("Invalid price")
+        
+        # Hold the funds, buy from the best provider (MTelSMS, or 5sim for
+        # services mapped to a 5sim product) and fall over to the other one
+        # if it has no numbers - see app/routing.py. The user never pays more
+        # than the listed (or agreed) price.
         try:
-            # Get user profile (SQLite doesn't support row-level locking well)
-            with transaction.atomic():
-                # Get or create user profile
-                profile, created = UserProfile.objects.get_or_create(user=request.user)
-                
-                # Check balance
-                user_balance_naira = profile.get_naira_balance()
-                if user_balance_naira < service_price_naira:
-                    return error_response("Insufficient balance")
-                
-                # Call MTelSMS API while holding the lock
-                client = get_mtelsms_client()
-                try:
-                    # Get service_id from service model
-                    service_id = service.mtelsms_service_id
-                    
-                    # Validate that we have a valid numeric service_id
-                    if not service_id or service_id.strip() == '':
-                        logger.error(f"Service {service.name} ({service.code}) has no MTelSMS service_id")
-                        return error_response(f"Service '{service.name}' is not available. Please contact support.")
-                    
-                    rental_id, phone_number, actual_price, time_remaining = client.get_number(
-                        service_id=service_id,
-                        max_price=service_price_usd,
-                        wholesale=False
-                    )
-                    logger.info(f"MTelSMS API success: rental_id={rental_id}, phone={phone_number}")
-                except MTelSMSException as e:
-                    logger.error(f"MTelSMS API failed: {str(e)}")
-                    return error_response(str(e))
-                except Exception as api_error:
-                    logger.error(f"Unexpected MTelSMS error: {str(api_error)}")
-                    return error_response(f"API communication error: {str(api_error)}")
-                
-                # MTelSMS call succeeded, now handle database operations
-                try:
-                    rental = Rental.objects.create(
-                        user=request.user,
-                        rental_id=rental_id,
-                        service=service,
-                        phone_number=phone_number,
-                        price=service_price_naira,
-                        area_codes=None,
-                        carriers=None,
-                        max_price=None
-                    )
-                    logger.info(f"Rental record created: {rental.id}, price=₦{service_price_naira}")
-                    
-                    # Create transaction record
-                    Transaction.objects.create(
-                        user=request.user,
-                        amount=-service_price_naira,
-                        transaction_type='RENTAL',
-                        description=f"Rented {service.name} number {phone_number}",
-                        rental=rental
-                    )
-                    logger.info(f"Transaction record created for rental {rental_id}")
-                    
-                    # Update user balance
-                    old_balance = profile.balance
-                    profile.balance -= service_price_naira
-                    profile.save()
-                    logger.info(f"Balance updated: {old_balance} -> {profile.balance} (deducted {service_price_naira})")
-                    
-                    logger.info(f"Rental process completed successfully: {rental_id}")
-                    
-                except Exception as db_error:
-                    logger.error(f"DATABASE ERROR after MTelSMS success! rental_id={rental_id}, phone={phone_number}, error={str(db_error)}")
-                    raise db_error
-            
-            # Transaction completed successfully
+            routed = route_purchase(request.user, Product.for_service(service, max_price_naira=accept_price))
+        except InsufficientBalance:
+            return error_response("Insufficient balance")
+        except PriceAboveQuote as e:
+            return JsonResponse({
+                'error': str(e),
+                'confirm_price': str(e.price_naira),
+                'quoted_price': str(e.quoted_naira),
+            }, status=409)
+        except NoProvider as e:
+            return error_response(str(e))
+        except (NoNumbers, ProviderFailed) as e:
+            logger.error(f"Rental failed: {str(e)}")
+            return error_response(str(e))
+        except Exception as e:
+            # The provider sold a number but the records failed - it was cancelled and the funds returned
+            logger.error(f"Final error in rent_number: {str(e)}")
+            return error_response(f"Rental failed: {str(e)}", 500)
+        
+        purchase = routed.purchase
+        logger.info(f"Rental process completed successfully: {routed.provider} {purchase.order_id}")
+        
+        if routed.provider == 'FIVESIM':
+            # Bought from 5sim instead - the order is shown on Dashboard 1
+            order = routed.record
             return json_response({
                 'success': True,
+                'provider': 'FIVESIM',
+                'order_id': order.order_id,
+                'phone_number': order.phone_number,
+                'price': str(order.price_naira),
+                'price_naira': str(order.price_naira),
+                'expires_at': order.expires_at.isoformat(),
+                'redirect_url': reverse('dashboard_1'),
+            })
+        
+        rental = routed.record
+        rental_id = rental.rental_id
+        phone_number = rental.phone_number
+        service_price_naira = rental.price
+        
+        return json_response({
+            'success': True,
+            'provider': 'MTELSMS',
+            'rental_id': rental_id,
+            'phone_number': phone_number,
+            'price': str(service_price_naira),
+            'price_naira': str(service_price_naira),
+            'profit_margin': str(service.profit_margin),
+            # Include full rental data for immediate display
+            'rental': {
                 'rental_id': rental_id,
+                'service_name': service.name,
+                'service_code': service.code,
                 'phone_number': phone_number,
+                'status': 'WAITING',
                 'price': str(service_price_naira),
-                'price_naira': str(service_price_naira),
-                'profit_margin': str(service.profit_margin),
-                # Include full rental data for immediate display
-                'rental': {
-                    'rental_id': rental_id,
-                    'service_name': service.name,
-                    'service_code': service.code,
-                    'phone_number': phone_number,
-                    'status': 'WAITING',
-                    'price': str(service_price_naira),
-                    'price_naira': f"{float(service_price_naira):,.2f}",
-                    'code': None,
-                    'full_text': None,
-                    'created_at': rental.created_at.isoformat()
-                }
-            })
-            
-        except Exception as e:
-            # Check if we have rental_id (meaning MTelSMS succeeded but DB failed)
-            if 'rental_id' in locals():
-                logger.error(f"Database transaction failed after MTelSMS success! Attempting to cancel rental_id={rental_id}")
-                try:
-                    client = get_mtelsms_client()
-                    cancel_success = client.cancel_rental(rental_id=rental_id)
-                    if cancel_success:
-                        logger.info(f"Successfully cancelled rental_id={rental_id} on MTelSMS after database failure")
-                    else:
-                        logger.error(f"Failed to cancel rental_id={rental_id} on MTelSMS - MANUAL INTERVENTION REQUIRED!")
-                except Exception as cancel_error:
-                    logger.error(f"Error cancelling rental_id={rental_id}: {str(cancel_error)} - MANUAL INTERVENTION REQUIRED!")
-            
-            logger.error(f"Final error in rent_number: {str(e)}")
-            return error_response(f"Rental failed: {str(e)}", 500)
+                'price_naira': f"{float(service_price_naira):,.2f}",
+                'code': None,
+                'full_text': None,
+                'created_at': rental.created_at.isoformat()
+            }
+        })
     
     except Exception as e:
         logger.error(f"Error renting number: {str(e)}")
@@ -205,263 +180,65 @@ def rent_number(request):
 @login_required
 @require_http_methods(["GET"])
 def check_sms(request, rental_id):
-    """Check for SMS messages on a rental"""
+    """
+    Check for SMS messages on a rental
+
+    Answers from the database only. The MTelSMS poller (run_sms_poller) owns
+    every WAITING rental: it fetches codes, auto-cancels after 5 minutes and
+    refunds expired rentals, so no provider call is made here.
+    """
     try:
         rental = get_object_or_404(Rental, rental_id=rental_id, user=request.user)
         
-        # For already completed/cancelled rentals, return stored messages
-        if rental.status in ['CANCELLED', 'DONE', 'EXPIRED']:
-            messages = []
-            for msg in rental.messages.all():
-                messages.append({
-                    'code': msg.code,
-                    'full_text': msg.full_text,
-                    'received_at': msg.received_at.isoformat()
-                })
-            return json_response({
-                'status': rental.status,
-                'messages': messages,
-                'refunded': rental.refunded
+        messages = []
+        for msg in rental.messages.all():
+            messages.append({
+                'code': msg.code,
+                'full_text': msg.full_text,
+                'received_at': msg.received_at.isoformat()
             })
         
-        # AUTO-CANCEL AFTER 5 MINUTES IF NO SMS RECEIVED
-        # Check if rental has been waiting for 5+ minutes
-        from datetime import timedelta
-        if rental.status == 'WAITING':
-            time_since_creation = timezone.now() - rental.created_at
-            if time_since_creation >= timedelta(minutes=5):
-                logger.info(f"Rental {rental_id} has been waiting for {time_since_creation.total_seconds()/60:.1f} minutes - attempting auto-cancel")
-                
-                # Before auto-cancelling, check MTelSMS one more time to ensure SMS wasn't just received
-                try:
-                    client = get_mtelsms_client()
-                    status, code, phone_number, time_remaining = client.get_code(rental_id=rental_id)
-                    
-                    # If SMS was received, save it and return success (no cancel)
-                    if status == 'RECEIVED' and code:
-                        rental.status = 'RECEIVED'
-                        rental.save()
-                        
-                        message, created = SMSMessage.objects.get_or_create(
-                            rental=rental,
-                            code=code,
-                            defaults={'full_text': code}
-                        )
-                        
-                        logger.info(f"SMS received for rental {rental_id} just before auto-cancel - saved code")
-                        
-                        return json_response({
-                            'status': 'RECEIVED',
-                            'messages': [{
-                                'code': code,
-                                'full_text': code,
-                                'received_at': message.created_at.isoformat()
-                            }],
-                            'time_remaining': time_remaining
-                        })
-                    
-                    # SMS still not received after 5 minutes - proceed with auto-cancel
-                    elif status == 'WAITING':
-                        logger.info(f"Auto-cancelling rental {rental_id} after 5 minutes with no SMS")
-                        
-                        # Attempt to cancel with MTelSMS
-                        cancel_success = client.cancel_rental(rental_id=rental_id)
-                        
-                        if cancel_success:
-                            with transaction.atomic():
-                                # Reload rental with lock
-                                rental = Rental.objects.select_for_update().get(rental_id=rental_id, user=request.user)
-                                
-                                # Check if already refunded (race condition protection)
-                                if rental.refunded:
-                                    return json_response({
-                                        'status': 'CANCELLED',
-                                        'messages': [],
-                                        'refunded': True
-                                    })
-                                
-                                # Update rental status
-                                rental.status = 'CANCELLED'
-                                rental.refunded = True
-                                rental.save()
-                                
-                                # Issue refund
-                                refund_amount_naira = rental.get_naira_price()
-                                
-                                profile = UserProfile.objects.select_for_update().get(user=request.user)
-                                profile.balance += refund_amount_naira
-                                profile.save()
-                                
-                                # Create refund transaction
-                                Transaction.objects.create(
-                                    user=request.user,
-                                    amount=refund_amount_naira,
-                                    transaction_type='REFUND',
-                                    description=f'Auto-refund: No SMS after 5 minutes - {rental.phone_number}',
-                                    rental=rental
-                                )
-                                
-                                logger.info(f"Auto-cancelled rental {rental_id} and refunded ₦{refund_amount_naira}")
-                            
-                            return json_response({
-                                'status': 'CANCELLED',
-                                'messages': [],
-                                'refunded': True
-                            })
-                        else:
-                            logger.warning(f"Failed to cancel rental {rental_id} with MTelSMS after 5 minutes")
-                            # Continue with normal flow if cancel failed
-                    
-                except MTelSMSException as e:
-                    logger.error(f"MTelSMS error during auto-cancel check for {rental_id}: {str(e)}")
-                    # Continue with normal flow if API call failed
+        response = {
+            'status': rental.status,
+            'messages': messages,
+        }
         
-        try:
-            client = get_mtelsms_client()
-            # MTelSMS uses get_code() instead of get_status() for retrieving SMS
-            status, code, phone_number, time_remaining = client.get_code(
-                rental_id=rental_id
-            )
-            
-            # Check if rental has expired (time_remaining = 0 or negative)
-            if time_remaining <= 0 and status == 'WAITING':
-                logger.info(f"Rental {rental_id} has expired (time_remaining={time_remaining})")
-                
-                with transaction.atomic():
-                    # Reload rental with lock to prevent race conditions
-                    rental = Rental.objects.select_for_update().get(rental_id=rental_id, user=request.user)
-                    
-                    # Check if already refunded (double-refund protection)
-                    if rental.refunded:
-                        logger.info(f"Rental {rental_id} already refunded, skipping")
-                        return json_response({
-                            'status': 'EXPIRED',
-                            'messages': [],
-                            'refunded': True
-                        })
-                    
-                    # Mark as expired
-                    rental.status = 'EXPIRED'
-                    rental.refunded = True
-                    rental.save()
-                    
-                    # Issue refund
-                    profile = UserProfile.objects.select_for_update().get(user=rental.user)
-                    profile.balance += rental.price
-                    profile.save()
-                    
-                    # Log refund transaction
-                    Transaction.objects.create(
-                        user=rental.user,
-                        amount=rental.price,
-                        transaction_type='REFUND',
-                        description=f'Automatic refund for expired rental {rental.phone_number}'
-                    )
-                    
-                    logger.info(f"Automatic refund issued for expired rental {rental_id}, user received ₦{rental.price}")
-                
-                return json_response({
-                    'status': 'EXPIRED',
-                    'messages': [],
-                    'refunded': True
-                })
-            
-            # Update rental status
-            rental.status = status
-            rental.save()
-            
-            # Save message if received
-            if status == 'RECEIVED' and code:
-                message, created = SMSMessage.objects.get_or_create(
-                    rental=rental,
-                    code=code,
-                    defaults={'full_text': code}  # MTelSMS returns code only, not full text
-                )
-            
-            # Get all messages for this rental
-            messages = []
-            for msg in rental.messages.all():
-                messages.append({
-                    'code': msg.code,
-                    'full_text': msg.full_text,
-                    'received_at': msg.received_at.isoformat()
-                })
-            
-            return json_response({
-                'status': status,
-                'messages': messages,
-                'time_remaining': time_remaining
-            })
+        if rental.status in ['CANCELLED', 'DONE', 'EXPIRED']:
+            response['refunded'] = rental.refunded
+        elif rental.expires_at is not None:
+            # Provider deadline, refreshed by the poller
+            response['time_remaining'] = rental.time_remaining
+            response['expires_at'] = rental.expires_at.isoformat()
+        else:
+            # Last provider state seen by the poller, if any
+            provider_state = get_cached_rental_status(rental.rental_id)
+            if provider_state:
+                response['time_remaining'] = provider_state['time_remaining']
         
-        except MTelSMSException as e:
-            error_msg = str(e).lower()
-            
-            # Log the full error for debugging
-            logger.warning(f"MTelSMS error for rental {rental_id}: {error_msg}")
-            
-            # Check if rental is expired/invalid on MTelSMS side
-            # MTelSMS might return various error messages for expired rentals
-            expired_keywords = [
-                'invalid service id',
-                'record expired',
-                'expired',
-                'not found',
-                'invalid id',
-                'invalid request',
-                'no such',
-                'does not exist'
-            ]
-            
-            is_expired = any(keyword in error_msg for keyword in expired_keywords)
-            
-            if is_expired:
-                logger.info(f"Detected expired rental {rental_id} from error: {error_msg}")
-                
-                with transaction.atomic():
-                    # Reload rental with lock to prevent race conditions
-                    rental = Rental.objects.select_for_update().get(rental_id=rental_id, user=request.user)
-                    
-                    # Check if already refunded (double-refund protection)
-                    if rental.refunded:
-                        logger.info(f"Rental {rental_id} already refunded, skipping")
-                        return json_response({
-                            'status': 'EXPIRED',
-                            'messages': [],
-                            'refunded': True
-                        })
-                    
-                    # Mark as expired
-                    rental.status = 'EXPIRED'
-                    rental.refunded = True
-                    rental.save()
-                    
-                    # Issue refund
-                    profile = UserProfile.objects.select_for_update().get(user=rental.user)
-                    profile.balance += rental.price
-                    profile.save()
-                    
-                    Transaction.objects.create(
-                        user=rental.user,
-                        amount=rental.price,
-                        transaction_type='REFUND',
-                        description=f'Automatic refund: Rental expired on provider - {rental.phone_number}'
-                    )
-                    
-                    logger.info(f"Rental {rental_id} expired on MTelSMS, user refunded ₦{rental.price}")
-                
-                return json_response({
-                    'status': 'EXPIRED',
-                    'messages': [],
-                    'refunded': True
-                })
-            
-            # For other errors, return the original error message
-            return error_response(str(e))
+        return json_response(response)
     
     except Exception as e:
         logger.error(f"Error checking SMS: {str(e)}")
         return error_response("Failed to check SMS", 500)
 
+@login_required
+@require_http_methods(["GET"])
+def order_events(request):
+    """
+    Server-Sent Events stream of the user's rental and 5sim order updates
+
+    Replaces per-order polling on the dashboards. Responds 204 when disabled
+    (the default, see app/live_updates.py), which tells EventSource not to
+    reconnect so the dashboards fall back to polling.
+    """
+    if not live_updates_enabled():
+        return HttpResponse(status=204)
+    
+    response = StreamingHttpResponse(event_stream(request.user), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'  # Don't let nginx buffer the stream
+    return response
+
 @login_required
 @csrf_exempt
 @require_http_methods(["POST"])
@@ -498,19 +275,9 @@ def cancel_rental(request):
                     # Get proper refund amounts for both display and balance update
                     refund_amount_naira = rental.get_naira_price()
                     
-                    # Create refund transaction in NGN
-                    Transaction.objects.create(
-                        user=request.user,
-                        amount=refund_amount_naira,
-                        transaction_type='REFUND',
-                        description=f"Refund for cancelled rental {rental.phone_number}",
-                        rental=rental
-                    )
-                    
-                    # Update user balance (all balances are in NGN)
-                    profile = UserProfile.objects.select_for_update().get(user=request.user)
-                    profile.balance += refund_amount_naira
-                    profile.save()
+                    # Record and credit the refund (all balances are in NGN)
+                    queue_rental_refund(rental, f"Refund for cancelled rental {rental.phone_number}")
+                    apply_refunds([rental_refund_key(rental)])
                 
                 return json_response({
                     'success': True,
@@ -572,7 +339,8 @@ def get_rentals(request):
                 'supports_multiple': rental.service.supports_multiple_sms,
                 'code': latest_message.code if latest_message else None,
                 'full_text': latest_message.full_text if latest_message else None,
-                'created_at': rental.created_at.isoformat()
+                'created_at': rental.created_at.isoformat(),
+                'expires_at': rental.expires_at.isoformat() if rental.expires_at else None
             })
         
         return json_response({
@@ -731,7 +499,8 @@ def get_rental_history(request):
                 'price_naira': f"{float(rental.get_naira_price()):,.2f}",
                 'code': latest_message.code if latest_message else None,
                 'full_text': latest_message.full_text if latest_message else None,
-                'created_at': rental.created_at.isoformat()
+                'created_at': rental.created_at.isoformat(),
+                'expires_at': rental.expires_at.isoformat() if rental.expires_at else None
             })
         
         # Calculate statistics
@@ -873,7 +642,9 @@ def initiate_korapay_payment(request):
                 user=request.user,
                 amount=amount,  # Store in NGN to preserve exact amount paid
                 transaction_type='DEPOSIT',
-                description=f"Wallet funding via Kora Pay - ₦{amount:,.2f} (Pending: {payment_result['tx_ref']})"
+                description=f"Wallet funding via Kora Pay - ₦{amount:,.2f} (Pending: {payment_result['tx_ref']})",
+                payment_reference=payment_result['tx_ref'],
+                status='PENDING'
             )
             
             return json_response({
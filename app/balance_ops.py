@@ -0,0 +1,101 @@
+"""
+Balance Operations
+Every change to UserProfile.balance goes through here as a single atomic
+UPDATE, so concurrent purchases, refunds and deposits never hold a row lock
+on the profile across Python code:
+
+- debit():  UPDATE ... SET balance = balance - x WHERE user_id = .. AND balance >= x
+            (no row updated means the balance did not cover it)
+- credit(): UPDATE ... SET balance = balance + x WHERE user_id = ..
+
+Both optionally write the matching Transaction row in the same database
+transaction as the balance update.
+"""
+
+import logging
+from decimal import Decimal
+from typing import Optional
+
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import UserProfile, Transaction
+
+logger = logging.getLogger(__name__)
+
+
+class InsufficientBalance(Exception):
+    """Raised when a user's balance cannot cover a debit"""
+
+    def __init__(self, required: Decimal, available: Decimal):
+        self.required = required
+        self.available = available
+        super().__init__(f"Insufficient balance. You need ₦{required:.2f} but have ₦{available:.2f}")
+
+
+def get_balance(user_id: int) -> Decimal:
+    """Current balance (0 if the user has no profile yet)"""
+    balance = UserProfile.objects.filter(user_id=user_id).values_list('balance', flat=True).first()
+    return balance if balance is not None else Decimal('0')
+
+
+def _record(user_id: int, amount: Decimal, transaction_type: Optional[str], description: str,
+            rental=None) -> Optional[Transaction]:
+    if not transaction_type:
+        return None
+    return Transaction.objects.create(
+        user_id=user_id,
+        amount=amount,
+        transaction_type=transaction_type,
+        description=description,
+        rental=rental,
+    )
+
+
+def debit(user_id: int, amount: Decimal, transaction_type: Optional[str] = None,
+          description: str = '', rental=None) -> Optional[Transaction]:
+    """
+    Take amount from a balance if it covers it
+
+    Args:
+        transaction_type: Also write a Transaction of this type (e.g. 'RENTAL')
+
+    Returns:
+        The Transaction written, if any
+
+    Raises:
+        InsufficientBalance: If the balance is lower than amount (nothing is changed)
+    """
+    with transaction.atomic():
+        updated = UserProfile.objects.filter(user_id=user_id, balance__gte=amount).update(
+            balance=F('balance') - amount, updated_at=timezone.now()
+        )
+        if not updated:
+            raise InsufficientBalance(amount, get_balance(user_id))
+        return _record(user_id, amount, transaction_type, description, rental)
+
+
+def credit(user_id: int, amount: Decimal, transaction_type: Optional[str] = None,
+           description: str = '', rental=None) -> Optional[Transaction]:
+    """
+    Add amount to a balance (creating the profile if the user has none)
+
+    Args:
+        transaction_type: Also write a Transaction of this type (e.g. 'DEPOSIT')
+
+    Returns:
+        The Transaction written, if any
+    """
+    with transaction.atomic():
+        updated = UserProfile.objects.filter(user_id=user_id).update(
+            balance=F('balance') + amount, updated_at=timezone.now()
+        )
+        if not updated:
+            profile, created = UserProfile.objects.get_or_create(user_id=user_id, defaults={'balance': amount})
+            if not created:
+                # Created concurrently since the UPDATE above
+                UserProfile.objects.filter(user_id=user_id).update(
+                    balance=F('balance') + amount, updated_at=timezone.now()
+                )
+        return _record(user_id, amount, transaction_type, description, rental)
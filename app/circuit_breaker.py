@@ -0,0 +1,276 @@
+"""
+Provider Circuit Breakers
+One breaker per provider endpoint (e.g. mtelsms/getNumber, fivesim/user/buy),
+consulted by ProviderTransport before every request:
+
+- CLOSED: calls go through; the outcome and latency of recent calls are kept
+  in a rolling window. When enough of them failed or were slow (past the
+  endpoint's slow-call threshold) the breaker opens
+- OPEN: calls fail at once with CircuitOpen instead of waiting out a
+  timeout, so a provider outage doesn't tie up web workers. The open period
+  doubles (with jitter) each time the breaker reopens, up to a maximum
+- HALF_OPEN: after the open period a few probe calls go through with a
+  shortened read timeout; if they succeed the breaker closes, otherwise it
+  opens again for longer
+
+An opened breaker is also written to the 'shared' cache, so other web
+workers and daemons stop calling the endpoint too instead of each learning
+about the outage on their own. Views check provider_available() before
+holding funds or starting work that needs the provider.
+
+Settings (all optional):
+    CIRCUIT_BREAKER_WINDOW        calls kept per endpoint (default 20)
+    CIRCUIT_BREAKER_MIN_CALLS     calls needed before it can open (default 5)
+    CIRCUIT_BREAKER_FAILURE_RATE  failed-or-slow fraction that opens it (default 0.5)
+    CIRCUIT_BREAKER_SLOW_CALL     seconds after which a call counts as slow (default 10)
+    CIRCUIT_BREAKER_OPEN_SECONDS  first open period (default 15)
+    CIRCUIT_BREAKER_MAX_OPEN_SECONDS  longest open period (default 300)
+    CIRCUIT_BREAKER_PROBES        successful probes needed to close (default 2)
+"""
+
+import logging
+import random
+import threading
+import time
+from collections import deque
+from typing import Dict, List, Optional
+
+import requests
+from django.conf import settings
+from django.core.cache import caches
+
+logger = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+SHARED_KEY_PREFIX = 'circuit:'
+# How often a breaker re-reads the shared open marker
+SHARED_CHECK_INTERVAL = 1.0
+
+UNAVAILABLE_MESSAGE = 'This service is temporarily unavailable. Please try again in a few minutes.'
+
+
+class CircuitOpen(requests.exceptions.ConnectionError):
+    """
+    Raised instead of calling an endpoint whose breaker is open
+
+    A ConnectionError, so the provider clients' existing network error
+    handling applies to it.
+    """
+
+    def __init__(self, provider: str, endpoint: str, retry_after: float):
+        self.provider = provider
+        self.endpoint = endpoint
+        self.retry_after = retry_after
+        super().__init__(f"{provider} {endpoint} is unavailable (circuit open, retry in {retry_after:.0f}s)")
+
+
+def endpoint_key(endpoint: Optional[str]) -> str:
+    """
+    Breaker name for an endpoint: MTelSMS actions as they are, 5sim paths by
+    their first two segments so IDs and product names share one breaker
+    ('/user/check/123' and '/user/check/456' are both '/user/check')
+    """
+    if not endpoint:
+        return 'default'
+    if endpoint.startswith('/'):
+        return '/' + '/'.join(endpoint.strip('/').split('/')[:2])
+    return endpoint
+
+
+class CircuitBreaker:
+    """
+    Breaker for one provider endpoint
+    """
+
+    def __init__(self, provider: str, endpoint: str):
+        self.provider = provider
+        self.endpoint = endpoint
+        self.window = getattr(settings, 'CIRCUIT_BREAKER_WINDOW', 20)
+        self.min_calls = getattr(settings, 'CIRCUIT_BREAKER_MIN_CALLS', 5)
+        self.failure_rate = getattr(settings, 'CIRCUIT_BREAKER_FAILURE_RATE', 0.5)
+        self.slow_call = getattr(settings, 'CIRCUIT_BREAKER_SLOW_CALL', 10)
+        self.base_open = getattr(settings, 'CIRCUIT_BREAKER_OPEN_SECONDS', 15)
+        self.max_open = getattr(settings, 'CIRCUIT_BREAKER_MAX_OPEN_SECONDS', 300)
+        self.probes_needed = getattr(settings, 'CIRCUIT_BREAKER_PROBES', 2)
+
+        self.state = CLOSED
+        self.calls = deque(maxlen=self.window)  # True for a good call
+        self.open_until = 0.0  # monotonic
+        self.trips = 0  # consecutive openings, drives the backoff
+        self.probes_in_flight = 0
+        self.probe_successes = 0
+        self.opened_at: Optional[float] = None  # wall clock, for status
+        self.last_error = ''
+        self.lock = threading.Lock()
+        self._shared_checked = 0.0
+
+    @property
+    def name(self) -> str:
+        return f"{self.provider}:{self.endpoint}"
+
+    def before_call(self):
+        """
+        Admit a call or raise CircuitOpen
+
+        Every admitted call must be followed by record().
+        """
+        self._check_shared()
+        with self.lock:
+            now = time.monotonic()
+            if self.state == OPEN:
+                if now < self.open_until:
+                    raise CircuitOpen(self.provider, self.endpoint, self.open_until - now)
+                self.state = HALF_OPEN
+                self.probes_in_flight = 0
+                self.probe_successes = 0
+                logger.info(f"Circuit {self.name} half-open, probing")
+            if self.state == HALF_OPEN:
+                # Only as many concurrent probes as needed to close
+                if self.probes_in_flight >= self.probes_needed:
+                    raise CircuitOpen(self.provider, self.endpoint, 1)
+                self.probes_in_flight += 1
+
+    def record(self, ok: bool, duration: float, error: str = ''):
+        """Record an admitted call's outcome (slow calls count against the breaker)"""
+        good = ok and duration < self.slow_call
+        if not ok:
+            self.last_error = error[:200]
+        elif not good:
+            self.last_error = f"slow response ({duration:.1f}s)"
+
+        with self.lock:
+            if self.state == HALF_OPEN:
+                self.probes_in_flight = max(0, self.probes_in_flight - 1)
+                if not good:
+                    self._open()
+                    return
+                self.probe_successes += 1
+                if self.probe_successes >= self.probes_needed:
+                    self._close()
+                return
+
+            self.calls.append(good)
+            if self.state == CLOSED and len(self.calls) >= self.min_calls:
+                bad = self.calls.count(False)
+                if bad / len(self.calls) >= self.failure_rate:
+                    self._open()
+
+    def probe_timeout(self, timeout):
+        """Read timeout for half-open probes: no longer than the slow-call threshold"""
+        if self.state != HALF_OPEN:
+            return timeout
+        if isinstance(timeout, tuple):
+            return (timeout[0], min(timeout[1], self.slow_call))
+        return min(timeout, self.slow_call)
+
+    def _open(self):
+        # Called with the lock held
+        open_for = min(self.max_open, self.base_open * (2 ** self.trips))
+        open_for *= random.uniform(0.8, 1.2)
+        self.trips += 1
+        self.state = OPEN
+        self.open_until = time.monotonic() + open_for
+        self.opened_at = time.time()
+        self.calls.clear()
+        logger.warning(f"Circuit {self.name} opened for {open_for:.0f}s ({self.last_error})")
+        self._publish(open_for)
+
+    def _close(self):
+        # Called with the lock held
+        self.state = CLOSED
+        self.trips = 0
+        self.opened_at = None
+        self.calls.clear()
+        logger.info(f"Circuit {self.name} closed")
+        self._publish(None)
+
+    def _publish(self, open_for: Optional[float]):
+        """Share the open (or closed) state with other processes"""
+        key = SHARED_KEY_PREFIX + self.name
+        try:
+            if open_for is None:
+                caches['shared'].delete(key)
+            else:
+                caches['shared'].set(key, {
+                    'open_until': time.time() + open_for,
+                    'trips': self.trips,
+                    'error': self.last_error,
+                }, int(open_for) + 1)
+        except Exception as e:
+            logger.debug(f"Could not publish circuit {self.name}: {str(e)}")
+
+    def _check_shared(self):
+        """Open this breaker if another process opened it (checked at most once a second)"""
+        now = time.monotonic()
+        if self.state != CLOSED or now - self._shared_checked < SHARED_CHECK_INTERVAL:
+            return
+        self._shared_checked = now
+        try:
+            shared = caches['shared'].get(SHARED_KEY_PREFIX + self.name)
+        except Exception:
+            return
+        if not shared:
+            return
+        remaining = shared['open_until'] - time.time()
+        if remaining <= 0:
+            return
+        with self.lock:
+            if self.state == CLOSED:
+                self.state = OPEN
+                self.open_until = now + remaining
+                self.trips = max(self.trips, shared.get('trips', 1))
+                self.opened_at = time.time()
+                self.last_error = shared.get('error', '')
+                logger.info(f"Circuit {self.name} opened by another process for {remaining:.0f}s")
+
+    def available(self) -> bool:
+        """Whether a call would be admitted now (without admitting one)"""
+        self._check_shared()
+        return self.state == CLOSED or time.monotonic() >= self.open_until
+
+    def as_dict(self) -> Dict:
+        return {
+            'provider': self.provider,
+            'endpoint': self.endpoint,
+            'state': self.state,
+            'retry_after': max(0, round(self.open_until - time.monotonic())) if self.state == OPEN else 0,
+            'recent_calls': len(self.calls),
+            'recent_failures': self.calls.count(False),
+            'trips': self.trips,
+            'last_error': self.last_error,
+        }
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(provider: str, endpoint: Optional[str] = None) -> CircuitBreaker:
+    """The process-wide breaker for a provider endpoint"""
+    key = f"{provider}:{endpoint_key(endpoint)}"
+    breaker = _breakers.get(key)
+    if breaker is None:
+        with _breakers_lock:
+            breaker = _breakers.get(key)
+            if breaker is None:
+                breaker = CircuitBreaker(provider, endpoint_key(endpoint))
+                _breakers[key] = breaker
+    return breaker
+
+
+def provider_available(provider: str, endpoint: Optional[str] = None) -> bool:
+    """
+    Whether calls to a provider endpoint are currently let through
+
+    For views: answer "temporarily unavailable" straight away when this is
+    False rather than holding funds or a worker for a call that will fail.
+    """
+    return get_breaker(provider, endpoint).available()
+
+
+def breaker_status() -> List[Dict]:
+    """State of every breaker this process has used"""
+    return [breaker.as_dict() for breaker in list(_breakers.values())]
@@ -0,0 +1,301 @@
+"""
+Order Deadline Scheduler
+Fires the 5-minute auto-cancel and expiry refund for MTelSMS rentals and 5sim
+orders when each one is due, instead of re-scanning every active row on a
+fixed interval (check_expired_rentals, expire_stuck_rentals,
+auto_cancel_5min_rentals, auto_cancel_5min_fivesim,
+auto_refund_expired_fivesim).
+
+- Pending deadlines are loaded once at start-up; deadlines that passed while
+  the scheduler was down fire immediately (catch-up after a restart)
+- Orders created afterwards are picked up with a cheap primary-key watermark
+  query, so the scheduler never re-reads rows it already knows about
+- Deadlines live in a min-heap; the loop sleeps until the earliest one
+- Each action re-reads its row and re-checks the condition before acting,
+  so a deadline for an order that received an SMS or was refunded elsewhere
+  is simply dropped. Actions that leave the order unresolved (e.g. the
+  provider cancel failed, or getCode errors) are retried with exponential
+  backoff from RETRY_DELAY up to MAX_RETRY_DELAY, and given up after
+  DEADLINE_MAX_RETRIES (default 6) tries; the sweeps
+  (check_expired_rentals, the 5sim sweeper) remain the backstop for those
+- run_deadline_scheduler holds a lease so only one instance fires
+  deadlines; its cancel and refund writes are fenced with it
+"""
+
+import heapq
+import itertools
+import logging
+import time
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional, Tuple
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils import timezone
+
+from .models import Rental, FiveSimOrder
+from .sms_poller import AUTO_CANCEL_AFTER, get_cached_rental_status
+
+logger = logging.getLogger(__name__)
+
+# Used for rentals created before Rental.expires_at was recorded
+RENTAL_EXPIRY_FALLBACK = Rental.DEFAULT_VALIDITY
+
+RETRY_DELAY = timedelta(seconds=30)
+MAX_RETRY_DELAY = timedelta(minutes=15)
+
+# How long 5sim orders stay eligible for an expiry refund (matches the sweeper)
+FIVESIM_REFUND_WINDOW = timedelta(hours=72)
+
+FIVESIM_ACTIVE_STATUSES = ['PENDING', 'RECEIVED']
+FIVESIM_REFUNDABLE_STATUSES = ['PENDING', 'TIMEOUT', 'CANCELED']
+
+# Deadline kinds
+RENTAL_CANCEL = 'rental_cancel'
+RENTAL_EXPIRE = 'rental_expire'
+FIVESIM_CANCEL = 'fivesim_cancel'
+FIVESIM_EXPIRE = 'fivesim_expire'
+
+
+def rental_expires_at(rental: Rental) -> datetime:
+    """Best known provider deadline for a rental"""
+    if rental.expires_at is not None:
+        return rental.expires_at
+    state = get_cached_rental_status(rental.rental_id)
+    if state and state.get('time_remaining') is not None:
+        checked_at = datetime.fromisoformat(state['checked_at'])
+        return checked_at + timedelta(seconds=max(0, state['time_remaining']))
+    return rental.created_at + RENTAL_EXPIRY_FALLBACK
+
+
+class DeadlineScheduler:
+    """
+    In-process min-heap of order deadlines
+    """
+
+    def __init__(self, poller=None, sweeper=None, dry_run: bool = False,
+                 discover_interval: Optional[float] = None):
+        self.dry_run = dry_run
+        self.discover_interval = discover_interval or getattr(settings, 'DEADLINE_DISCOVER_INTERVAL', 2.0)
+        self._poller = poller
+        self._sweeper = sweeper
+        self.heap: List[Tuple[float, int, str, str]] = []
+        self.scheduled: Dict[Tuple[str, str], float] = {}  # (kind, key) -> due timestamp
+        self.retries: Dict[Tuple[str, str], int] = {}  # (kind, key) -> unresolved tries so far
+        self.max_retries = getattr(settings, 'DEADLINE_MAX_RETRIES', 6)
+        self.counter = itertools.count()
+        self.rental_watermark = 0
+        self.fivesim_watermark = 0
+        self.last_discover = 0.0
+        self.lease = None  # Held Lease fencing writes, if any
+        self.stats = {'loaded': 0, 'fired': 0, 'acted': 0, 'retried': 0, 'gave_up': 0, 'errors': 0}
+        self.handlers: Dict[str, Callable[[str], Optional[bool]]] = {
+            RENTAL_CANCEL: self._rental_cancel,
+            RENTAL_EXPIRE: self._rental_expire,
+            FIVESIM_CANCEL: self._fivesim_cancel,
+            FIVESIM_EXPIRE: self._fivesim_expire,
+        }
+
+    # Provider clients are created on first use so an idle provider needs no key
+
+    @property
+    def poller(self):
+        if self._poller is None:
+            from .sms_poller import SMSPoller
+            self._poller = SMSPoller(dry_run=self.dry_run)
+        self._poller.lease = self.lease
+        return self._poller
+
+    @property
+    def sweeper(self):
+        if self._sweeper is None:
+            from .fivesim_sweeper import FiveSimSweeper
+            self._sweeper = FiveSimSweeper(dry_run=self.dry_run)
+        self._sweeper.lease = self.lease
+        return self._sweeper
+
+    # Scheduling
+
+    def schedule(self, kind: str, key: str, due_at: datetime):
+        """Add a deadline (an earlier one for the same order and kind wins)"""
+        due = due_at.timestamp()
+        current = self.scheduled.get((kind, key))
+        if current is not None and current <= due:
+            return
+        self.scheduled[(kind, key)] = due
+        heapq.heappush(self.heap, (due, next(self.counter), kind, key))
+
+    def schedule_rental(self, rental: Rental):
+        self.schedule(RENTAL_CANCEL, rental.rental_id, rental.created_at + AUTO_CANCEL_AFTER)
+        self.schedule(RENTAL_EXPIRE, rental.rental_id, rental_expires_at(rental))
+        self.rental_watermark = max(self.rental_watermark, rental.pk)
+
+    def schedule_fivesim(self, order: FiveSimOrder):
+        if order.status in FIVESIM_ACTIVE_STATUSES:
+            self.schedule(FIVESIM_CANCEL, str(order.order_id), order.created_at + AUTO_CANCEL_AFTER)
+        self.schedule(FIVESIM_EXPIRE, str(order.order_id), order.expires_at)
+        self.fivesim_watermark = max(self.fivesim_watermark, order.pk)
+
+    def load(self):
+        """Load every pending deadline (run once at start-up)"""
+        rentals = Rental.objects.filter(status='WAITING', refunded=False).only(
+            'id', 'rental_id', 'created_at', 'expires_at'
+        )
+        fivesim_orders = FiveSimOrder.objects.filter(
+            status__in=FIVESIM_REFUNDABLE_STATUSES + ['RECEIVED'],
+            refunded=False,
+            created_at__gte=timezone.now() - FIVESIM_REFUND_WINDOW,
+        ).only('id', 'order_id', 'status', 'created_at', 'expires_at')
+
+        for rental in rentals:
+            self.schedule_rental(rental)
+            self.stats['loaded'] += 1
+        for order in fivesim_orders:
+            self.schedule_fivesim(order)
+            self.stats['loaded'] += 1
+
+        # Nothing older than what exists now needs discovering later
+        self.rental_watermark = max(
+            self.rental_watermark, Rental.objects.order_by('-pk').values_list('pk', flat=True).first() or 0
+        )
+        self.fivesim_watermark = max(
+            self.fivesim_watermark, FiveSimOrder.objects.order_by('-pk').values_list('pk', flat=True).first() or 0
+        )
+        self.last_discover = time.monotonic()
+        logger.info(f"Deadline scheduler loaded {self.stats['loaded']} orders ({len(self.heap)} deadlines)")
+
+    def discover(self):
+        """Schedule orders created since the last look (primary-key range scan)"""
+        for rental in Rental.objects.filter(pk__gt=self.rental_watermark).only(
+                'id', 'rental_id', 'status', 'refunded', 'created_at', 'expires_at').order_by('pk'):
+            self.rental_watermark = rental.pk
+            if rental.status == 'WAITING' and not rental.refunded:
+                self.schedule_rental(rental)
+
+        for order in FiveSimOrder.objects.filter(pk__gt=self.fivesim_watermark).only(
+                'id', 'order_id', 'status', 'refunded', 'created_at', 'expires_at').order_by('pk'):
+            self.fivesim_watermark = order.pk
+            if not order.refunded:
+                self.schedule_fivesim(order)
+
+        self.last_discover = time.monotonic()
+
+    # Running
+
+    def run_due(self) -> int:
+        """
+        Fire every deadline that is due
+
+        Returns:
+            int: Number of deadlines fired
+        """
+        fired = 0
+        now = time.time()
+        while self.heap and self.heap[0][0] <= now:
+            due, _, kind, key = heapq.heappop(self.heap)
+            if self.scheduled.get((kind, key)) != due:
+                continue  # Superseded by an earlier deadline
+            del self.scheduled[(kind, key)]
+            fired += 1
+            self.stats['fired'] += 1
+
+            try:
+                outcome = self.handlers[kind](key)
+            except Exception as e:
+                self.stats['errors'] += 1
+                logger.error(f"Deadline {kind} for {key} failed: {str(e)}")
+                outcome = None
+
+            if outcome is None:
+                self._retry(kind, key)
+                continue
+            self.retries.pop((kind, key), None)
+            if outcome:
+                self.stats['acted'] += 1
+        return fired
+
+    def _retry(self, kind: str, key: str):
+        """Try an unresolved deadline again later, backing off, or give up on it"""
+        tries = self.retries.get((kind, key), 0) + 1
+        if tries > self.max_retries:
+            self.retries.pop((kind, key), None)
+            self.stats['gave_up'] += 1
+            logger.warning(f"Deadline {kind} for {key} still unresolved after {self.max_retries} retries, "
+                           f"leaving it to the sweeps")
+            return
+        self.retries[(kind, key)] = tries
+        self.stats['retried'] += 1
+        delay = min(RETRY_DELAY * (2 ** (tries - 1)), MAX_RETRY_DELAY)
+        self.schedule(kind, key, timezone.now() + delay)
+
+    def seconds_until_next(self) -> float:
+        """Time the loop may sleep before the next deadline or discovery"""
+        until_discover = self.discover_interval - (time.monotonic() - self.last_discover)
+        if not self.heap:
+            return max(0.0, until_discover)
+        return max(0.0, min(self.heap[0][0] - time.time(), until_discover))
+
+    def run_forever(self, max_sleep: float = 5.0, lease=None):
+        """
+        Main loop
+
+        With a lease, returns once the lease was lost (another instance took
+        over) so the caller can stand by again.
+        """
+        self.lease = lease
+        self.load()
+        while lease is None or not lease.lost:
+            try:
+                close_old_connections()
+                if time.monotonic() - self.last_discover >= self.discover_interval:
+                    self.discover()
+                self.run_due()
+            except Exception as e:
+                logger.error(f"Unexpected error in deadline scheduler: {str(e)}")
+            time.sleep(min(max_sleep, max(0.05, self.seconds_until_next())))
+
+    # Actions. Return True when the order was resolved by this deadline,
+    # False when there was nothing to do, None to retry later.
+
+    def _rental_cancel(self, rental_id: str) -> Optional[bool]:
+        return self._rental_deadline(RENTAL_CANCEL, rental_id)
+
+    def _rental_expire(self, rental_id: str) -> Optional[bool]:
+        return self._rental_deadline(RENTAL_EXPIRE, rental_id)
+
+    def _rental_deadline(self, kind: str, rental_id: str) -> Optional[bool]:
+        rental = Rental.objects.select_related('user').filter(rental_id=rental_id).first()
+        if rental is None or rental.status != 'WAITING' or rental.refunded:
+            return False
+
+        # One last provider check: stores a code that just arrived, otherwise
+        # auto-cancels (past 5 minutes) or refunds (expired upstream)
+        self.poller.poll_rental(rental)
+        if self.dry_run:
+            return True
+
+        rental.refresh_from_db(fields=['status', 'refunded', 'expires_at'])
+        if rental.status == 'WAITING' and not rental.refunded:
+            if kind == RENTAL_EXPIRE and rental.expires_at and rental.expires_at > timezone.now() + RETRY_DELAY:
+                # Provider extended the deadline (getCode refreshes expires_at).
+                # A cancel that left the rental WAITING failed and is retried.
+                self.schedule(RENTAL_EXPIRE, rental_id, rental.expires_at)
+                return False
+            return None
+        return True
+
+    def _fivesim_cancel(self, order_id: str) -> Optional[bool]:
+        order = FiveSimOrder.objects.select_related('user').prefetch_related('sms_messages').filter(
+            order_id=int(order_id)
+        ).first()
+        if order is None or order.refunded or order.status not in FIVESIM_ACTIVE_STATUSES:
+            return False
+        return self.sweeper.cancel_if_waiting(order)
+
+    def _fivesim_expire(self, order_id: str) -> Optional[bool]:
+        order = FiveSimOrder.objects.select_related('user').prefetch_related('sms_messages').filter(
+            order_id=int(order_id)
+        ).first()
+        if order is None or order.refunded:
+            return False
+        return self.sweeper.refund_if_expired(order)
@@ -7,10 +7,17 @@ import requests
 import logging
 from typing import Dict, List, Optional, Union
 from django.conf import settings
-from django.core.cache import cache
+from .http_transport import get_transport
+from .circuit_breaker import CircuitOpen
+from .provider_cache import provider_cache
+from .singleflight import provider_calls
+from .pricing_index import PRICES_CACHE_KEY, bump_prices_version, get_pricing_index
 
 logger = logging.getLogger(__name__)
 
+# Read-only endpoints; everything else (buy, cancel, finish, ban) changes an order
+IDEMPOTENT_ENDPOINTS = ('/guest/', '/user/check/', '/user/profile', '/user/sms/inbox/')
+
 class FiveSimAPI:
     """
     5sim.net API client for SMS verification services
@@ -19,6 +26,8 @@ class FiveSimAPI:
     def __init__(self, api_key: Optional[str] = None):
         self.base_url = "https://5sim.net/v1"
         self.api_key = api_key or getattr(settings, 'FIVESIM_API_KEY', None)
+        # Pooled keep-alive connections shared by every client in the process
+        self.transport = get_transport('fivesim')
         self.headers = {
             'Accept': 'application/json',
         }
@@ -43,7 +52,10 @@ class FiveSimAPI:
         """
         try:
             url = f"{self.base_url}{endpoint}"
-            response = requests.get(url, headers=self.headers, params=params, timeout=30)
+            response = self.transport.get(
+                url, endpoint=endpoint, idempotent=endpoint.startswith(IDEMPOTENT_ENDPOINTS),
+                headers=self.headers, params=params
+            )
             
             if response.status_code == 200:
                 try:
@@ -61,6 +73,10 @@ class FiveSimAPI:
                 response_text = response.text.strip()
                 raise Exception(f"Response: {response_text}")
                 
+        except CircuitOpen as e:
+            # 5sim has been failing - not called at all
+            logger.warning(f"5sim API call skipped: {str(e)}")
+            raise Exception("Service temporarily unavailable. Please try again in a few minutes.")
         except requests.exceptions.RequestException as e:
             logger.error(f"5sim API request failed: {str(e)}")
             raise Exception(f"Network error: {str(e)}")
@@ -76,18 +92,12 @@ class FiveSimAPI:
         Returns:
             Dictionary of products with their details
         """
-        cache_key = f"5sim_products_{country}_{operator}"
-        cached_data = cache.get(cache_key)
-        
-        if cached_data:
-            return cached_data
-            
         endpoint = f"/guest/products/{country}/{operator}"
-        data = self._make_request(endpoint)
         
-        # Cache for 5 minutes
-        cache.set(cache_key, data, 300)
-        return data
+        # Fresh for 5 minutes, shared by all processes
+        return provider_cache.get_or_fetch(
+            f"5sim_products_{country}_{operator}", lambda: self._make_request(endpoint), ttl=300, stale_ttl=300
+        )
     
     def get_all_prices(self) -> Dict:
         """
@@ -96,18 +106,14 @@ class FiveSimAPI:
         Returns:
             Complete pricing data
         """
-        cache_key = "5sim_all_prices"
-        cached_data = cache.get(cache_key)
-        
-        if cached_data:
-            return cached_data
-            
         endpoint = "/guest/prices"
-        data = self._make_request(endpoint)
         
-        # Cache for 10 minutes
-        cache.set(cache_key, data, 600)
-        return data
+        # Fresh for 10 minutes, shared by all processes; pricing indexes are
+        # rebuilt whenever new data is fetched
+        return provider_cache.get_or_fetch(
+            PRICES_CACHE_KEY, lambda: self._make_request(endpoint), ttl=600, stale_ttl=600,
+            on_refresh=lambda data: bump_prices_version()
+        )
     
     def get_prices_by_country(self, country: str) -> Dict:
         """
@@ -119,19 +125,13 @@ class FiveSimAPI:
         Returns:
             Pricing data for the specified country
         """
-        cache_key = f"5sim_prices_country_{country}"
-        cached_data = cache.get(cache_key)
-        
-        if cached_data:
-            return cached_data
-            
         endpoint = "/guest/prices"
         params = {"country": country}
-        data = self._make_request(endpoint, params)
         
-        # Cache for 10 minutes
-        cache.set(cache_key, data, 600)
-        return data
+        # Fresh for 10 minutes, shared by all processes
+        return provider_cache.get_or_fetch(
+            f"5sim_prices_country_{country}", lambda: self._make_request(endpoint, params), ttl=600, stale_ttl=600
+        )
     
     def get_prices_by_product(self, product: str) -> Dict:
         """
@@ -143,19 +143,13 @@ class FiveSimAPI:
         Returns:
             Pricing data for the specified product
         """
-        cache_key = f"5sim_prices_product_{product}"
-        cached_data = cache.get(cache_key)
-        
-        if cached_data:
-            return cached_data
-            
         endpoint = "/guest/prices"
         params = {"product": product}
-        data = self._make_request(endpoint, params)
         
-        # Cache for 10 minutes
-        cache.set(cache_key, data, 600)
-        return data
+        # Fresh for 10 minutes, shared by all processes
+        return provider_cache.get_or_fetch(
+            f"5sim_prices_product_{product}", lambda: self._make_request(endpoint, params), ttl=600, stale_ttl=600
+        )
     
     def get_prices_by_country_and_product(self, country: str, product: str) -> Dict:
         """
@@ -168,19 +162,13 @@ class FiveSimAPI:
         Returns:
             Pricing data for the specified country and product
         """
-        cache_key = f"5sim_prices_{country}_{product}"
-        cached_data = cache.get(cache_key)
-        
-        if cached_data:
-            return cached_data
-            
         endpoint = "/guest/prices"
         params = {"country": country, "product": product}
-        data = self._make_request(endpoint, params)
         
-        # Cache for 10 minutes
-        cache.set(cache_key, data, 600)
-        return data
+        # Fresh for 10 minutes, shared by all processes
+        return provider_cache.get_or_fetch(
+            f"5sim_prices_{country}_{product}", lambda: self._make_request(endpoint, params), ttl=600, stale_ttl=600
+        )
     
     def get_available_countries(self) -> List[str]:
         """
@@ -190,8 +178,7 @@ class FiveSimAPI:
             List of country names
         """
         try:
-            prices = self.get_all_prices()
-            return list(prices.keys())
+            return list(get_pricing_index(self).countries)
         except Exception as e:
             logger.error(f"Failed to get countries: {str(e)}")
             return []
@@ -204,14 +191,7 @@ class FiveSimAPI:
             List of product names
         """
         try:
-            prices = self.get_all_prices()
-            products = set()
-            
-            for country_data in prices.values():
-                if isinstance(country_data, dict):
-                    products.update(country_data.keys())
-            
-            return list(products)
+            return list(get_pricing_index(self).products)
         except Exception as e:
             logger.error(f"Failed to get products: {str(e)}")
             return []
@@ -228,29 +208,7 @@ class FiveSimAPI:
             List of operator names
         """
         try:
-            if country and product:
-                data = self.get_prices_by_country_and_product(country, product)
-                if country in data and product in data[country]:
-                    return list(data[country][product].keys())
-            elif country:
-                data = self.get_prices_by_country(country)
-                operators = set()
-                for product_data in data.get(country, {}).values():
-                    if isinstance(product_data, dict):
-                        operators.update(product_data.keys())
-                return list(operators)
-            else:
-                # Get all operators from all countries
-                prices = self.get_all_prices()
-                operators = set()
-                
-                for country_data in prices.values():
-                    if isinstance(country_data, dict):
-                        for product_data in country_data.values():
-                            if isinstance(product_data, dict):
-                                operators.update(product_data.keys())
-                
-                return list(operators)
+            return list(get_pricing_index(self).operators_for(country, product))
         except Exception as e:
             logger.error(f"Failed to get operators: {str(e)}")
             return []
@@ -356,12 +314,14 @@ class FiveSimAPI:
             
         Raises:
             Exception: If check fails or authentication required
+        
+        Concurrent checks of the same order share one upstream call.
         """
         if not self.api_key:
             raise Exception("API key required for order operations")
             
         endpoint = f"/user/check/{order_id}"
-        return self._make_request(endpoint)
+        return provider_calls.do_copy(('fivesim', 'check', str(order_id)), lambda: self._make_request(endpoint))
     
     def finish_order(self, order_id: int) -> Dict:
         """
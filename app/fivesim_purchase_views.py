@@ -8,8 +8,6 @@ Handles purchase o        if active_orders.count() >= 3:
 """
 
 import logging
-from decimal import Decimal
-from datetime import datetime, timedelta
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
@@ -21,14 +19,20 @@ from django.db.transaction import atomic
 from django.core.paginator import Paginator
 from django.conf import settings
 
-from .models import FiveSimOrder, FiveSimSMS, UserProfile, Transaction
+from .models import FiveSimOrder, FiveSimSMS, UserProfile
 from .fivesim import FiveSimAPI
+from .providers import Product
+from .routing import route_purchase, NoProvider
+from .fivesim_sync import refresh_order, latest_sms_code
+from .refunds import queue_fivesim_refund, apply_refunds, fivesim_refund_key
+from .purchase_pipeline import InsufficientBalance
 
 logger = logging.getLogger(__name__)
 
 # Backend API key - set this in your settings
 FIVESIM_API_KEY = getattr(settings, 'FIVESIM_API_KEY', None)
 
+
 @login_required
 @require_http_methods(["POST"])
 def buy_activation_number(request):
@@ -66,89 +70,49 @@ def buy_activation_number(request):
                 'error': 'Country, operator, and product are required'
             })
         
-        # Initialize API client with backend key
-        api_client = FiveSimAPI(FIVESIM_API_KEY)
-        
         # Prepare purchase parameters
-        purchase_params = {
-            'country': country,
-            'operator': operator,
-            'product': product,
+        options = {
             'forwarding': forwarding,
             'reuse': reuse,
             'voice': voice,
         }
         
         if forwarding and forwarding_number:
-            purchase_params['number'] = forwarding_number
+            options['number'] = forwarding_number
         if ref:
-            purchase_params['ref'] = ref
+            options['ref'] = ref
         if max_price:
             try:
-                purchase_params['max_price'] = float(max_price)
+                options['max_price'] = float(max_price)
             except ValueError:
                 pass
         
-        # Make the purchase
-        logger.info(f"Calling 5sim API with params: {purchase_params}")
-        result = api_client.buy_activation_number(**purchase_params)
-        logger.info(f"5sim API response: {result}")
-        
-        # Calculate price using simple fixed pricing (same logic as pricing endpoint)
-        api_price_rub = Decimal(str(result['price']))  # What 5sim charged us in RUB
-        wholesale_ngn = api_price_rub * settings.EXCHANGE_RATE_RUB_TO_NGN  # Convert to NGN (20x)
-        price_naira = wholesale_ngn + settings.FIVESIM_FIXED_PROFIT_NGN  # Add ₦1,000 profit
-        
-        # Parse expiration date
-        expires_at = datetime.fromisoformat(result['expires'].replace('Z', '+00:00'))
-        
-        # Log the actual duration 5sim gave us
-        purchase_time = timezone.now()
-        duration_minutes = (expires_at - purchase_time).total_seconds() / 60
-        logger.info(f"5sim Purchase: {product} - Duration given: {duration_minutes:.1f} minutes (expires at {expires_at})")
+        purchase_product = Product(
+            fivesim_country=country,
+            fivesim_product=product,
+            fivesim_operator=operator,
+            fivesim_options=options,
+            description=f'Dashboard 1 activation number: {product}',
+        )
         
-        # Get user profile and check balance
-        user_profile = UserProfile.objects.get(user=request.user)
-        if user_profile.balance < price_naira:
+        # Hold the estimated price, buy with no database transaction open and
+        # settle the held amount to the actual price (see app/routing.py)
+        logger.info(f"Calling 5sim API with params: {country}/{operator}/{product} {options}")
+        try:
+            routed = route_purchase(request.user, purchase_product, providers=('FIVESIM',))
+        except InsufficientBalance as e:
+            return JsonResponse({
+                'success': False,
+                'error': str(e)
+            })
+        except NoProvider as e:
             return JsonResponse({
                 'success': False,
-                'error': f'Insufficient balance. You need ₦{price_naira:.2f} but have ₦{user_profile.balance:.2f}'
+                'error': str(e)
             })
+        order = routed.record
         
-        # Create order record and deduct balance
-        with atomic():
-            # Deduct balance
-            user_profile.balance -= price_naira
-            user_profile.save()
-            
-            order = FiveSimOrder.objects.create(
-                user=request.user,
-                order_id=result['id'],
-                order_type='ACTIVATION',
-                phone_number=result['phone'],
-                country=result.get('country', ''),
-                operator=result.get('operator', ''),
-                product=result['product'],
-                price=Decimal(str(result['price'])),
-                price_naira=price_naira,
-                status=result['status'],
-                expires_at=expires_at,
-                forwarding=result.get('forwarding', False),
-                forwarding_number=result.get('forwarding_number', ''),
-                reuse_enabled=reuse,
-                voice_enabled=voice,
-                max_price=Decimal(str(max_price)) if max_price else None,
-                referral_key=ref or None,
-            )
-            
-            # Create transaction record
-            Transaction.objects.create(
-                user=request.user,
-                amount=price_naira,
-                transaction_type='RENTAL',
-                description=f'Dashboard 1 activation number: {product} ({result["phone"]})',
-                rental=None,  # This is for Dashboard 1, not old rental system
-            )
+        user_profile = UserProfile.objects.get(user=request.user)
         
         return JsonResponse({
             'success': True,
@@ -185,61 +149,24 @@ def check_order_status(request, order_id):
         api_client = FiveSimAPI(FIVESIM_API_KEY)
         
         # Check order status with 5sim
-        result = api_client.check_order(order_id)
-        
-        # Update order status
-        order.status = result['status']
-        order.save()
-        
-        # *** THIS IS THE FIX ***
-        # Update SMS messages by clearing and recreating them
-        if result.get('sms'):
-            # Clear any existing (and potentially outdated) SMS messages for this order
-            order.sms_messages.all().delete()
-            
-            # Process and save the new SMS data from the API response
-            for sms_data in result['sms']:
-                # The broken ID check is now removed. We process every message.
-                sms_date = datetime.fromisoformat(sms_data['date'].replace('Z', '+00:00'))
-                FiveSimSMS.objects.create(
-                    order=order,
-                    # sms_id is removed as it's not provided by the API in this context
-                    sender=sms_data.get('sender', ''),
-                    text=sms_data.get('text', ''),
-                    code=sms_data.get('code', ''),
-                    date=sms_date,
-                )
+        refresh_order(api_client, order)
         
         # Get updated SMS messages from the database
         sms_messages = order.sms_messages.all().order_by('-date')
-        sms_data_list = []
-        latest_sms_code = None
-        
-        for sms in sms_messages:
-            sms_data_list.append({
-                'sender': sms.sender,
-                'text': sms.text,
-                'code': sms.code,
-                'date': sms.date.isoformat(),
-            })
-            # Get the latest SMS code for quick access on the frontend
-            if not latest_sms_code and (sms.code or sms.text):
-                # Prioritize the clean 'code' field if it exists
-                if sms.code:
-                    latest_sms_code = sms.code
-                else:
-                    # Fallback to extracting from the full text
-                    import re
-                    match = re.search(r'(\d{4,8})', sms.text)
-                    if match:
-                        latest_sms_code = match.group(1)
+        sms_data_list = [{
+            'sender': sms.sender,
+            'text': sms.text,
+            'code': sms.code,
+            'date': sms.date.isoformat(),
+        } for sms in sms_messages]
+        sms_code = latest_sms_code(sms_messages)
 
         return JsonResponse({
             'success': True,
             'status': order.status,
             'phone_number': order.phone_number,
             'expires_at': order.expires_at.isoformat(),
-            'sms_code': latest_sms_code, # This will now contain the code
+            'sms_code': sms_code, # This will now contain the code
             'sms_messages': sms_data_list, # This will now be populated
         })
         
@@ -339,28 +266,19 @@ def cancel_order(request, order_id):
             order.refunded = True
             order.save()
             
-            # Process refund with locked profile
-            user_profile = UserProfile.objects.select_for_update().get(user=request.user)
+            # Record and credit the refund
             refund_amount = order.price_naira
-            
-            # Credit user balance
-            user_profile.balance += refund_amount
-            user_profile.save()
-            
-            # Create refund transaction
-            Transaction.objects.create(
-                user=request.user,
-                amount=refund_amount,
-                transaction_type='REFUND',
-                description=f'Refund for cancelled Dashboard 1 order: {order.product} ({order.phone_number})',
-                rental=None,
+            queue_fivesim_refund(
+                order, f'Refund for cancelled Dashboard 1 order: {order.product} ({order.phone_number})'
             )
+            apply_refunds([fivesim_refund_key(order)])
+            new_balance = UserProfile.objects.values_list('balance', flat=True).get(user=request.user)
         
         return JsonResponse({
             'success': True,
             'status': order.status,
             'refund_amount': f'{refund_amount:.2f}',
-            'new_balance': float(user_profile.balance),
+            'new_balance': float(new_balance),
             'message': f'Order cancelled successfully. ₦{refund_amount:.2f} has been refunded to your account.'
         })
         
@@ -0,0 +1,331 @@
+"""
+Concurrent 5sim Order Sweeper
+Runs status sync, 5-minute auto-cancel and expired-order refunds for
+FiveSimOrder in a single pass. Upstream calls are issued concurrently from an
+asyncio event loop with a bounded number of in-flight requests and a
+requests-per-second ceiling, over the shared pooled 5sim.net transport.
+"""
+
+import asyncio
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from typing import Dict, List, Optional
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import FiveSimOrder
+from .fivesim import FiveSimAPI
+from .fivesim_sync import merge_order_result
+from .leases import fence
+from .refunds import queue_fivesim_refund, apply_refunds
+
+logger = logging.getLogger(__name__)
+
+# Orders waiting this long without an SMS are cancelled and refunded
+AUTO_CANCEL_AFTER = timedelta(minutes=5)
+
+ACTIVE_STATUSES = ['PENDING', 'RECEIVED']
+REFUNDABLE_STATUSES = ['PENDING', 'TIMEOUT', 'CANCELED']
+
+
+class AsyncRateLimiter:
+    """
+    Token bucket limiting how many requests per second are started
+    """
+
+    def __init__(self, rate: float, burst: Optional[int] = None):
+        self.rate = float(rate)
+        self.capacity = float(burst or max(1, int(rate)))
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        """Wait until a request may be started"""
+        if self.rate <= 0:
+            return  # No limit
+
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class FiveSimSweeper:
+    """
+    One-pass sweep over FiveSimOrder rows (sync + auto-cancel + refund)
+    """
+
+    def __init__(self, api_key: Optional[str] = None, concurrency: int = None,
+                 requests_per_second: float = None, dry_run: bool = False,
+                 sync_max_age_hours: int = 48, refund_max_age_hours: int = 72):
+        self.concurrency = concurrency or getattr(settings, 'FIVESIM_SWEEP_CONCURRENCY', 20)
+        self.requests_per_second = (
+            requests_per_second if requests_per_second is not None
+            else getattr(settings, 'FIVESIM_SWEEP_REQUESTS_PER_SECOND', 10)
+        )
+        self.dry_run = dry_run
+        self.lease = None  # Held Lease fencing refunds, if any
+        self.sync_max_age_hours = sync_max_age_hours
+        self.refund_max_age_hours = refund_max_age_hours
+
+        # Requests share the process-wide pooled 5sim connections (PROVIDER_HTTP_POOL_SIZE)
+        self.api_client = FiveSimAPI(api_key or getattr(settings, 'FIVESIM_API_KEY', None))
+        self.executor = ThreadPoolExecutor(max_workers=self.concurrency)
+
+    # Upstream calls
+
+    async def _call_all(self, method, order_ids: List[int]) -> Dict[int, object]:
+        """Call an API method for every order ID with bounded concurrency"""
+        loop = asyncio.get_running_loop()
+        semaphore = asyncio.Semaphore(self.concurrency)
+        limiter = AsyncRateLimiter(self.requests_per_second)
+
+        async def call(order_id):
+            async with semaphore:
+                await limiter.acquire()
+                try:
+                    return order_id, await loop.run_in_executor(self.executor, method, order_id)
+                except Exception as e:
+                    return order_id, e
+
+        results = await asyncio.gather(*(call(order_id) for order_id in order_ids))
+        return dict(results)
+
+    def call_all(self, method, order_ids: List[int]) -> Dict[int, object]:
+        """
+        Run an API method for many orders concurrently
+
+        Returns:
+            Dict mapping order_id to the API result or the raised exception
+        """
+        if not order_ids:
+            return {}
+        return asyncio.run(self._call_all(method, order_ids))
+
+    # Sweep
+
+    def load_orders(self) -> List[FiveSimOrder]:
+        """Fetch every order any of the three phases may act on in one query"""
+        now = timezone.now()
+        sync_cutoff = now - timedelta(hours=self.sync_max_age_hours)
+        refund_cutoff = now - timedelta(hours=self.refund_max_age_hours)
+
+        return list(
+            FiveSimOrder.objects.filter(
+                Q(status__in=ACTIVE_STATUSES, created_at__gte=sync_cutoff) |
+                Q(status__in=REFUNDABLE_STATUSES, created_at__gte=refund_cutoff, refunded=False)
+            ).select_related('user').prefetch_related('sms_messages').order_by('-created_at')
+        )
+
+    def sweep(self, lease=None) -> Dict[str, int]:
+        """
+        Run one full sweep
+
+        Pass the held sweep lease to fence refunds with it and stop between
+        phases once it was taken over; refunds already queued are credited
+        by the next holder.
+
+        Returns:
+            Dict of counters for the summary
+        """
+        stats = {
+            'checked': 0,
+            'status_changed': 0,
+            'cancelled': 0,
+            'refunded': 0,
+            'skipped': 0,
+            'errors': 0,
+        }
+
+        self.lease = lease
+        orders = self.load_orders()
+        if not orders:
+            return stats
+
+        # PHASE 1: Sync statuses and SMS for active orders
+        active = [order for order in orders if order.status in ACTIVE_STATUSES]
+        results = self.call_all(self.api_client.check_order, [order.order_id for order in active])
+
+        for order in active:
+            result = results.get(order.order_id)
+            stats['checked'] += 1
+            try:
+                self._apply_check_result(order, result, stats)
+            except Exception as e:
+                stats['errors'] += 1
+                logger.error(f"Sweep sync error for order {order.order_id}: {str(e)}")
+
+        if lease is not None and lease.lost:
+            return stats
+
+        # PHASE 2: Auto-cancel orders waiting > 5 minutes without SMS
+        now = timezone.now()
+        to_cancel = [
+            order for order in orders
+            if order.status in ACTIVE_STATUSES
+            and not order.refunded
+            and order.created_at <= now - AUTO_CANCEL_AFTER
+            and not self._has_sms(order)
+        ]
+        if to_cancel and not self.dry_run:
+            # Continue even if an upstream cancel fails - we still refund
+            self.call_all(self.api_client.cancel_order, [order.order_id for order in to_cancel])
+
+        for order in to_cancel:
+            if self._refund(order, 'CANCELED',
+                            f'Auto-cancel: No SMS after 5 minutes - {order.product} ({order.phone_number})'):
+                stats['cancelled'] += 1
+            else:
+                stats['skipped'] += 1
+        cancelled_ids = {order.order_id for order in to_cancel}
+
+        if lease is not None and lease.lost:
+            return stats
+
+        # PHASE 3: Refund orders that expired without SMS
+        to_refund = [
+            order for order in orders
+            if order.order_id not in cancelled_ids
+            and order.status in REFUNDABLE_STATUSES
+            and not order.refunded
+            and now > order.expires_at
+            and not self._has_sms(order)
+        ]
+        for order in to_refund:
+            if self._refund(order, 'EXPIRED',
+                            f'Auto-refund: Expired Dashboard 1 order #{order.id} - {order.product} ({order.phone_number})'):
+                stats['refunded'] += 1
+            else:
+                stats['skipped'] += 1
+
+        # Credit every refund queued by phases 2 and 3 in one batch
+        if not self.dry_run:
+            apply_refunds()
+
+        return stats
+
+    # Single orders (used by the deadline scheduler)
+
+    def cancel_if_waiting(self, order: FiveSimOrder) -> bool:
+        """
+        Apply the 5-minute auto-cancel to one order: sync it once more, then
+        cancel and refund it if it is still waiting without an SMS
+
+        Returns:
+            bool: True if the order was cancelled and refunded
+        """
+        stats = {'status_changed': 0, 'errors': 0}
+        try:
+            result = self.api_client.check_order(order.order_id)
+        except Exception as e:
+            result = e
+        self._apply_check_result(order, result, stats)
+
+        if order.status not in ACTIVE_STATUSES or order.refunded or self._has_sms(order):
+            return False
+
+        if not self.dry_run:
+            fence(self.lease)  # Don't cancel upstream for a scheduler that was replaced
+            try:
+                self.api_client.cancel_order(order.order_id)
+            except Exception as e:
+                # Continue even if the upstream cancel fails - we still refund
+                logger.warning(f"5sim cancel failed for order {order.order_id}: {str(e)}")
+
+        return self._refund(order, 'CANCELED',
+                            f'Auto-cancel: No SMS after 5 minutes - {order.product} ({order.phone_number})',
+                            apply=True)
+
+    def refund_if_expired(self, order: FiveSimOrder) -> bool:
+        """
+        Refund one order past its expires_at that never received an SMS
+
+        Returns:
+            bool: True if the order was refunded
+        """
+        if (order.status not in REFUNDABLE_STATUSES or order.refunded
+                or timezone.now() <= order.expires_at or self._has_sms(order)):
+            return False
+        return self._refund(order, 'EXPIRED',
+                            f'Auto-refund: Expired Dashboard 1 order #{order.id} - {order.product} ({order.phone_number})',
+                            apply=True)
+
+    def _has_sms(self, order: FiveSimOrder) -> bool:
+        """Check for SMS using the prefetched (or freshly synced) messages"""
+        return bool(order.sms_messages.all())
+
+    def _apply_check_result(self, order: FiveSimOrder, result, stats: Dict[str, int]):
+        """Apply a check_order result (or exception) to an order"""
+        if isinstance(result, Exception):
+            error_msg = str(result)
+            if 'order not found' in error_msg.lower() or '404' in error_msg:
+                logger.warning(f"Order {order.order_id} not found on 5sim, marking as EXPIRED")
+                if not self.dry_run:
+                    order.status = 'EXPIRED'
+                    order.save()
+                stats['status_changed'] += 1
+            else:
+                stats['errors'] += 1
+                logger.error(f"Status sync error for order {order.order_id}: {error_msg}")
+            return
+
+        old_status = order.status
+        new_status = result['status']
+        if old_status != new_status:
+            stats['status_changed'] += 1
+            logger.info(f"Order {order.order_id}: {old_status} → {new_status}")
+
+        if self.dry_run:
+            return
+
+        # Inserts only new SMS and refreshes the prefetch cache for later phases
+        merge_order_result(order, result)
+
+    def _refund(self, order: FiveSimOrder, status: str, description: str, apply: bool = False) -> bool:
+        """
+        Move an order to a final status and queue its refund exactly once
+
+        Queued refunds are credited by apply_refunds() at the end of a sweep,
+        or straight away when apply is set.
+
+        Returns:
+            bool: True if a refund was issued (or would be, in dry-run mode)
+        """
+        if self.dry_run:
+            logger.info(f"[DRY RUN] Would mark order {order.order_id} as {status} and refund ₦{order.price_naira}")
+            return True
+
+        with transaction.atomic():
+            # Reload order with lock to prevent race conditions
+            locked = FiveSimOrder.objects.select_for_update().get(pk=order.pk)
+
+            # Check if already refunded (double-refund protection)
+            if locked.refunded:
+                return False
+
+            fence(self.lease)
+            locked.status = status
+            locked.refunded = True
+            locked.save()
+            queue_fivesim_refund(locked, description)
+
+        if apply:
+            apply_refunds()
+
+        order.status = status
+        order.refunded = True
+        logger.info(f"Order {order.order_id} marked {status}, refunded ₦{order.price_naira} to {order.user.username}")
+        return True
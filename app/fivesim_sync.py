@@ -0,0 +1,104 @@
+"""
+5sim Order Sync
+Applies a 5sim check_order response to a FiveSimOrder: new SMS messages are
+inserted and the order is written only when its status changed, instead of
+deleting and re-creating every message on each poll.
+
+Shared by the order status view, the live update stream, the sweeper and
+sync_fivesim_order_statuses.
+"""
+
+import hashlib
+import logging
+import re
+from datetime import datetime
+from typing import Iterable, Optional, Tuple
+
+from .models import FiveSimOrder, FiveSimSMS
+
+logger = logging.getLogger(__name__)
+
+
+def _parse_date(value: str) -> datetime:
+    return datetime.fromisoformat(value.replace('Z', '+00:00'))
+
+
+def _content_key(date: datetime, text: Optional[str]) -> str:
+    """Identity of a message without a 5sim id: its timestamp and text"""
+    digest = hashlib.sha1(f"{date.timestamp():.6f}|{text or ''}".encode()).hexdigest()
+    return f"hash:{digest}"
+
+
+def _stored_keys(messages: Iterable[FiveSimSMS]) -> set:
+    keys = set()
+    for sms in messages:
+        if sms.sms_id is not None:
+            keys.add(f"id:{sms.sms_id}")
+        keys.add(_content_key(sms.date, sms.text))
+    return keys
+
+
+def merge_order_result(order: FiveSimOrder, result: dict) -> Tuple[bool, int]:
+    """
+    Merge a check_order response into an order
+
+    Messages are matched on their 5sim id when the response has one, and on
+    date + text otherwise (rows stored before ids were kept have none).
+
+    Returns:
+        (status_changed, number of new SMS messages stored)
+    """
+    status_changed = order.status != result['status']
+    if status_changed:
+        order.status = result['status']
+        order.save(update_fields=['status', 'updated_at'])
+
+    incoming = result.get('sms') or []
+    if not incoming:
+        return status_changed, 0
+
+    # Uses the prefetched messages when the caller loaded them
+    known = _stored_keys(order.sms_messages.all())
+    created = 0
+    for sms_data in incoming:
+        sms_date = _parse_date(sms_data['date'])
+        sms_id = sms_data.get('id')
+        content_key = _content_key(sms_date, sms_data.get('text', ''))
+        if content_key in known or (sms_id is not None and f"id:{sms_id}" in known):
+            continue
+
+        FiveSimSMS.objects.create(
+            order=order,
+            sms_id=sms_id,
+            sender=sms_data.get('sender', ''),
+            text=sms_data.get('text', ''),
+            code=sms_data.get('code', ''),
+            date=sms_date,
+        )
+        known.add(content_key)
+        created += 1
+
+    if created and hasattr(order, '_prefetched_objects_cache'):
+        # Refresh the prefetch cache so callers see the new messages
+        order._prefetched_objects_cache.pop('sms_messages', None)
+    return status_changed, created
+
+
+def refresh_order(api_client, order: FiveSimOrder) -> FiveSimOrder:
+    """Fetch an order from 5sim and merge the response"""
+    merge_order_result(order, api_client.check_order(order.order_id))
+    return order
+
+
+def latest_sms_code(sms_messages: Iterable[FiveSimSMS]) -> Optional[str]:
+    """Verification code of the newest SMS in a newest-first sequence, if any"""
+    for sms in sms_messages:
+        if sms.code or sms.text:
+            # Prioritize the clean 'code' field if it exists
+            if sms.code:
+                return sms.code
+            # Fallback to extracting from the full text
+            match = re.search(r'(\d{4,8})', sms.text)
+            if match:
+                return match.group(1)
+    return None
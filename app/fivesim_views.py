@@ -13,10 +13,21 @@ import json
 import logging
 
 from .fivesim import fivesim_api
+from .pricing_index import get_pricing_index
+from .operator_stats import public_stats
 
 logger = logging.getLogger(__name__)
 
 
+def _operator_info(row):
+    """Operator pricing row as returned by the per-country/per-product endpoints"""
+    return dict(
+        row,
+        cost_formatted=f"₦{row['cost'] * 1:.2f}",
+        available=row['count'] > 0
+    )
+
+
 @require_http_methods(["GET"])
 @cache_page(60 * 5)  # Cache for 5 minutes
 def get_products(request, country=None, operator=None):
@@ -70,52 +81,16 @@ def get_all_prices(request):
     GET /api/5sim/prices/
     """
     try:
-        prices = fivesim_api.get_all_prices()
+        index = get_pricing_index()
         
-        # Transform data for easier frontend consumption
+        # Transformed data is precomputed once per price refresh
         transformed_data = {
-            'countries': [],
-            'products': set(),
-            'operators': set(),
-            'pricing': prices
+            'countries': index.countries_payload(),
+            'products': index.products,
+            'operators': index.operators,
+            'pricing': index.prices
         }
         
-        for country, country_data in prices.items():
-            country_info = {
-                'name': country,
-                'products': []
-            }
-            
-            if isinstance(country_data, dict):
-                for product, product_data in country_data.items():
-                    transformed_data['products'].add(product)
-                    
-                    product_info = {
-                        'name': product,
-                        'operators': []
-                    }
-                    
-                    if isinstance(product_data, dict):
-                        for operator, operator_data in product_data.items():
-                            transformed_data['operators'].add(operator)
-                            
-                            if isinstance(operator_data, dict):
-                                product_info['operators'].append({
-                                    'name': operator,
-                                    'cost': operator_data.get('cost', 0),
-                                    'count': operator_data.get('count', 0),
-                                    'rate': operator_data.get('rate', 0),
-                                    'cost_formatted': f"₦{operator_data.get('cost', 0) * 1:.2f}",
-                                })
-                    
-                    country_info['products'].append(product_info)
-            
-            transformed_data['countries'].append(country_info)
-        
-        # Convert sets to lists for JSON serialization
-        transformed_data['products'] = list(transformed_data['products'])
-        transformed_data['operators'] = list(transformed_data['operators'])
-        
         return JsonResponse({
             'success': True,
             'data': transformed_data
@@ -137,37 +112,22 @@ def get_prices_by_country(request, country):
     GET /api/5sim/prices/country/<country>/
     """
     try:
-        prices = fivesim_api.get_prices_by_country(country)
+        country_data = get_pricing_index().by_country.get(country)
         
-        if country not in prices:
+        if country_data is None:
             return JsonResponse({
                 'success': False,
                 'error': f'Country "{country}" not found'
             }, status=404)
         
-        country_data = prices[country]
-        
         # Transform data
-        products = []
-        for product_name, product_data in country_data.items():
-            product_info = {
+        products = [
+            {
                 'name': product_name,
-                'operators': []
+                'operators': [_operator_info(row) for row in rows]
             }
-            
-            if isinstance(product_data, dict):
-                for operator_name, operator_data in product_data.items():
-                    if isinstance(operator_data, dict):
-                        product_info['operators'].append({
-                            'name': operator_name,
-                            'cost': operator_data.get('cost', 0),
-                            'count': operator_data.get('count', 0),
-                            'rate': operator_data.get('rate', 0),
-                            'cost_formatted': f"₦{operator_data.get('cost', 0) * 1:.2f}",
-                            'available': operator_data.get('count', 0) > 0
-                        })
-            
-            products.append(product_info)
+            for product_name, rows in country_data.items()
+        ]
         
         return JsonResponse({
             'success': True,
@@ -194,37 +154,22 @@ def get_prices_by_product(request, product):
     GET /api/5sim/prices/product/<product>/
     """
     try:
-        prices = fivesim_api.get_prices_by_product(product)
+        product_data = get_pricing_index().by_product.get(product)
         
-        if product not in prices:
+        if product_data is None:
             return JsonResponse({
                 'success': False,
                 'error': f'Product "{product}" not found'
             }, status=404)
         
-        product_data = prices[product]
-        
         # Transform data
-        countries = []
-        for country_name, country_data in product_data.items():
-            country_info = {
+        countries = [
+            {
                 'name': country_name,
-                'operators': []
+                'operators': [_operator_info(row) for row in rows]
             }
-            
-            if isinstance(country_data, dict):
-                for operator_name, operator_data in country_data.items():
-                    if isinstance(operator_data, dict):
-                        country_info['operators'].append({
-                            'name': operator_name,
-                            'cost': operator_data.get('cost', 0),
-                            'count': operator_data.get('count', 0),
-                            'rate': operator_data.get('rate', 0),
-                            'cost_formatted': f"₦{operator_data.get('cost', 0) * 1:.2f}",
-                            'available': operator_data.get('count', 0) > 0
-                        })
-            
-            countries.append(country_info)
+            for country_name, rows in product_data.items()
+        ]
         
         return JsonResponse({
             'success': True,
@@ -282,6 +227,10 @@ def get_prices_by_country_and_product(request, country, product):
                 'message': 'No operators available for this selection'
             })
         
+        # How each operator did on our own orders (app/operator_stats.py)
+        for operator_name, stats in public_stats(country, operators, product).items():
+            operators[operator_name]['stats'] = stats
+        
         return JsonResponse({
             'success': True,
             'prices': operators,
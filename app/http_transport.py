@@ -0,0 +1,210 @@
+"""
+Provider HTTP Transport
+One pooled, keep-alive requests.Session per provider host (5sim, MTelSMS,
+KoraPay), shared by every thread in the process.
+
+- Connection pools sized by PROVIDER_HTTP_POOL_SIZE (default 20)
+- Per-endpoint (connect, read) timeouts; PROVIDER_HTTP_TIMEOUTS overrides them,
+  e.g. {'fivesim': {'/guest/prices': (5, 60)}}
+- Failed connections are retried for every request (nothing was sent yet);
+  timeouts and 5xx responses are retried only for idempotent calls. Several
+  provider endpoints that buy or cancel numbers are GETs, so callers say
+  which calls are idempotent. All retries happen in request(), with backoff,
+  so every attempt is seen by the circuit breaker (the adapter itself never
+  retries)
+- 5sim and MTelSMS calls go through per-endpoint circuit breakers
+  (app/circuit_breaker.py): while an endpoint is failing, calls to it fail
+  at once with CircuitOpen instead of waiting for a timeout
+"""
+
+import logging
+import threading
+import time
+from typing import Dict, Optional, Tuple, Union
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+from django.conf import settings
+
+from .circuit_breaker import get_breaker, CircuitOpen
+
+logger = logging.getLogger(__name__)
+
+Timeout = Union[float, Tuple[float, float]]
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+def is_connect_error(error: BaseException) -> bool:
+    """
+    Whether a request failed before anything reached the server: the
+    connection could not be made, or the circuit breaker refused the call.
+    Such a request is safe to retry or send elsewhere even if it has side
+    effects; read timeouts and dropped connections are not.
+    """
+    if isinstance(error, (CircuitOpen, requests.exceptions.ConnectTimeout)):
+        return True
+    if isinstance(error, requests.exceptions.ConnectionError):
+        reason = error.args[0] if error.args else None
+        reason = getattr(reason, 'reason', reason)  # urllib3 MaxRetryError
+        return isinstance(reason, NewConnectionError)
+    return False
+
+DEFAULT_TIMEOUTS: Dict[str, Dict[str, Timeout]] = {
+    'fivesim': {
+        'default': (5, 30),
+        '/guest/prices': (5, 60),  # Full price tree is several MB
+    },
+    'mtelsms': {
+        'default': (5, 30),
+        'getCode': (5, 15),
+        'getBalance': (5, 15),
+    },
+    'korapay': {
+        'default': (5, 15),
+    },
+    'webhooks': {
+        'default': (5, 10),  # Reseller endpoints; slow ones are retried later
+    },
+}
+
+
+class ProviderTransport:
+    """
+    Pooled HTTP client for one provider
+    """
+
+    def __init__(self, name: str, pool_size: int = 20, retries: int = 2, backoff_factor: float = 0.3,
+                 timeouts: Optional[Dict[str, Timeout]] = None, headers: Optional[Dict[str, str]] = None,
+                 circuit_breaker: bool = False):
+        self.name = name
+        self.circuit_breaker = circuit_breaker
+        self.pool_size = pool_size
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.timeouts = dict(timeouts or {})
+        self.headers = dict(headers or {})
+        self._session = None
+        self._lock = threading.Lock()
+
+    @property
+    def session(self) -> requests.Session:
+        """Session created on first use (so it is never shared across a fork)"""
+        if self._session is None:
+            with self._lock:
+                if self._session is None:
+                    session = requests.Session()
+                    session.headers.update(self.headers)
+                    # No adapter retries: request() retries connect failures,
+                    # read errors and status codes itself
+                    adapter = HTTPAdapter(
+                        pool_connections=2,
+                        pool_maxsize=self.pool_size,
+                        max_retries=0,
+                    )
+                    session.mount('https://', adapter)
+                    session.mount('http://', adapter)
+                    self._session = session
+        return self._session
+
+    def timeout_for(self, endpoint: Optional[str]) -> Timeout:
+        """(connect, read) timeout for an endpoint, falling back to the provider default"""
+        if endpoint:
+            if endpoint in self.timeouts:
+                return self.timeouts[endpoint]
+            # Endpoints with IDs in the path match on their prefix
+            for prefix, timeout in self.timeouts.items():
+                if prefix.startswith('/') and endpoint.startswith(prefix):
+                    return timeout
+        return self.timeouts.get('default', (5, 30))
+
+    def request(self, method: str, url: str, endpoint: Optional[str] = None,
+                idempotent: Optional[bool] = None, **kwargs) -> requests.Response:
+        """
+        Send a request through the pooled session
+
+        Args:
+            method: HTTP method
+            url: Full URL
+            endpoint: Path or action name used to pick the timeout
+            idempotent: Whether timeouts/5xx may be retried. Defaults to True
+                for GET/HEAD; pass False for GETs with side effects. Failed
+                connections are retried either way.
+
+        Raises:
+            CircuitOpen: If the endpoint's circuit breaker is open (a
+                requests ConnectionError, raised without calling out)
+        """
+        if idempotent is None:
+            idempotent = method.upper() in ('GET', 'HEAD')
+        timeout = kwargs.pop('timeout', None) or self.timeout_for(endpoint)
+        breaker = get_breaker(self.name, endpoint) if self.circuit_breaker else None
+
+        attempts = 1 + self.retries
+        for attempt in range(attempts):
+            last_attempt = attempt == attempts - 1
+            if breaker:
+                # Also stops retrying once the failures so far opened the breaker
+                breaker.before_call()
+                kwargs['timeout'] = breaker.probe_timeout(timeout)
+            else:
+                kwargs['timeout'] = timeout
+            started = time.monotonic()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                if breaker:
+                    breaker.record(False, time.monotonic() - started, str(e))
+                if last_attempt or not (idempotent or is_connect_error(e)):
+                    raise
+                logger.warning(f"{self.name} {endpoint or url} failed ({str(e)}), retrying")
+            except Exception as e:
+                if breaker:
+                    breaker.record(False, time.monotonic() - started, str(e))
+                raise
+            else:
+                if breaker:
+                    breaker.record(response.status_code < 500, time.monotonic() - started,
+                                   f"HTTP {response.status_code}")
+                if last_attempt or not idempotent or response.status_code not in RETRY_STATUSES:
+                    return response
+                logger.warning(f"{self.name} {endpoint or url} returned {response.status_code}, retrying")
+                response.close()
+
+            time.sleep(self.backoff_factor * (2 ** attempt))
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        return self.request('POST', url, **kwargs)
+
+
+_transports: Dict[str, ProviderTransport] = {}
+_transports_lock = threading.Lock()
+
+
+def get_transport(name: str, headers: Optional[Dict[str, str]] = None) -> ProviderTransport:
+    """
+    Return the shared transport for a provider ('fivesim', 'mtelsms', 'korapay')
+
+    headers are applied when the transport is first created.
+    """
+    transport = _transports.get(name)
+    if transport is None:
+        with _transports_lock:
+            transport = _transports.get(name)
+            if transport is None:
+                timeouts = dict(DEFAULT_TIMEOUTS.get(name, {}))
+                timeouts.update(getattr(settings, 'PROVIDER_HTTP_TIMEOUTS', {}).get(name, {}))
+                transport = ProviderTransport(
+                    name,
+                    pool_size=getattr(settings, 'PROVIDER_HTTP_POOL_SIZE', 20),
+                    retries=getattr(settings, 'PROVIDER_HTTP_RETRIES', 2),
+                    timeouts=timeouts,
+                    headers=headers,
+                    circuit_breaker=name in getattr(settings, 'CIRCUIT_BREAKER_PROVIDERS', ('fivesim', 'mtelsms')),
+                )
+                _transports[name] = transport
+    return transport
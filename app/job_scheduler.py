@@ -0,0 +1,298 @@
+"""
+Periodic Job Scheduler
+One process runs every periodic maintenance job, replacing the separate
+sleep-loop daemons (auto_sync_daemon.py, auto_refund_daemon,
+auto_cancel_rentals_daemon) and the check_expired_rentals.bat cron entry,
+each of which paid for its own Django start-up and cache copies.
+
+- Jobs are registered with an interval and a jitter fraction, so jobs with
+  the same interval don't all hit the database and providers together
+- Due jobs run concurrently on a thread pool; a job that is still running
+  when it comes due again is not started a second time
+- After a stall (a long job, a suspended host) missed runs are coalesced
+  into one run, or skipped entirely for jobs registered with misfire='skip'
+- The last run's start time, duration, outcome and error are kept per job
+  and published to the 'shared' cache (see `manage.py run_jobs --status`)
+- Jobs hold a lease (app/leases.py) while running, so run_jobs can run on
+  several hosts with only one of them doing each job
+"""
+
+import io
+import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Callable, Dict, List, Optional
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.management import call_command
+from django.db import close_old_connections
+
+from .leases import hold_lease
+
+logger = logging.getLogger(__name__)
+
+STATUS_CACHE_KEY = 'job_scheduler:status'
+STATUS_CACHE_TIMEOUT = 24 * 60 * 60
+
+# Misfire policies
+COALESCE = 'coalesce'  # run once for any number of missed runs
+SKIP = 'skip'  # drop missed runs and wait for the next slot
+
+# A job function returns this when it did nothing (e.g. another process held
+# the lease it needs), so its status reads 'skipped' rather than 'ok'
+SKIPPED = 'skipped'
+
+
+class Job:
+    """
+    A registered periodic job and the outcome of its last run
+    """
+
+    def __init__(self, name: str, func: Callable[[], object], interval: float,
+                 jitter: float = 0.1, misfire: str = COALESCE, exclusive: bool = True):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.jitter = jitter
+        self.misfire = misfire
+        self.exclusive = exclusive
+        self.next_run = 0.0  # monotonic
+        self.running = False
+
+        self.runs = 0
+        self.failures = 0
+        self.missed = 0
+        self.overlaps = 0
+        self.last_started: Optional[datetime] = None
+        self.last_duration: Optional[float] = None
+        self.last_outcome: Optional[str] = None  # 'ok', 'skipped', 'error' or 'standby'
+        self.last_error = ''
+
+    def schedule_next(self, now: float):
+        spread = self.interval * self.jitter
+        self.next_run = now + self.interval + random.uniform(-spread, spread)
+
+    def as_dict(self) -> Dict:
+        return {
+            'name': self.name,
+            'interval': self.interval,
+            'running': self.running,
+            'runs': self.runs,
+            'failures': self.failures,
+            'missed': self.missed,
+            'overlaps': self.overlaps,
+            'last_started': self.last_started.isoformat() if self.last_started else None,
+            'last_duration': self.last_duration,
+            'last_outcome': self.last_outcome,
+            'last_error': self.last_error,
+        }
+
+
+class JobScheduler:
+    """
+    Runs registered jobs on their intervals from a thread pool
+    """
+
+    def __init__(self, max_workers: Optional[int] = None):
+        self.max_workers = max_workers or getattr(settings, 'JOB_SCHEDULER_MAX_WORKERS', 4)
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='job')
+        self.jobs: Dict[str, Job] = {}
+        self.lock = threading.Lock()
+
+    def register(self, name: str, func: Callable[[], object], interval: float,
+                 jitter: float = 0.1, misfire: str = COALESCE, run_at_start: bool = True,
+                 exclusive: bool = True) -> Job:
+        """
+        Add a job
+
+        Args:
+            func: The job; may return SKIPPED when it had nothing to do
+            interval: Seconds between runs
+            jitter: Fraction of the interval each run may move by
+            misfire: COALESCE or SKIP (what to do with runs missed during a stall)
+            run_at_start: First run shortly after start instead of after one interval
+            exclusive: Hold the job's lease while it runs, so schedulers on
+                other hosts stand by instead of running it too
+        """
+        job = Job(name, func, interval, jitter=jitter, misfire=misfire, exclusive=exclusive)
+        now = time.monotonic()
+        if run_at_start:
+            # Spread the first runs over a few seconds
+            job.next_run = now + random.uniform(0, min(5.0, interval * jitter))
+        else:
+            job.schedule_next(now)
+        self.jobs[name] = job
+        return job
+
+    def run_pending(self) -> List[str]:
+        """
+        Start every due job that is not already running
+
+        Returns:
+            Names of the jobs started
+        """
+        started = []
+        now = time.monotonic()
+        for job in self.jobs.values():
+            if job.next_run > now:
+                continue
+
+            missed = int((now - job.next_run) // job.interval)
+            job.schedule_next(now)
+
+            with self.lock:
+                if job.running:
+                    job.overlaps += 1
+                    logger.warning(f"Job {job.name} is still running, skipping this run")
+                    continue
+                if missed:
+                    job.missed += missed
+                    if job.misfire == SKIP:
+                        logger.warning(f"Job {job.name} missed {missed} run(s), skipping to the next slot")
+                        continue
+                    logger.warning(f"Job {job.name} missed {missed} run(s), running once")
+                job.running = True
+
+            self.executor.submit(self._run, job)
+            started.append(job.name)
+        return started
+
+    def _run(self, job: Job):
+        close_old_connections()
+        job.last_started = datetime.now()
+        started = time.monotonic()
+        try:
+            if job.exclusive:
+                # Only one scheduler across hosts runs the job at a time
+                with hold_lease(f"job:{job.name}") as lease:
+                    if lease is None:
+                        job.last_outcome = 'standby'
+                        return
+                    outcome = job.func()
+            else:
+                outcome = job.func()
+            job.last_outcome = SKIPPED if outcome == SKIPPED else 'ok'
+            job.last_error = ''
+        except Exception as e:
+            job.failures += 1
+            job.last_outcome = 'error'
+            job.last_error = str(e)[:500]
+            logger.error(f"Job {job.name} failed: {str(e)}")
+        finally:
+            job.last_duration = round(time.monotonic() - started, 3)
+            job.runs += 1
+            with self.lock:
+                job.running = False
+            close_old_connections()
+            logger.info(f"Job {job.name} finished in {job.last_duration}s ({job.last_outcome})")
+            self.publish_status()
+
+    def status(self) -> List[Dict]:
+        return [job.as_dict() for job in self.jobs.values()]
+
+    def publish_status(self):
+        """Share per-job status with other processes (run_jobs --status)"""
+        try:
+            caches['shared'].set(STATUS_CACHE_KEY, {
+                'updated_at': datetime.now().isoformat(),
+                'jobs': self.status(),
+            }, STATUS_CACHE_TIMEOUT)
+        except Exception as e:
+            logger.debug(f"Could not publish job status: {str(e)}")
+
+    def seconds_until_next(self) -> float:
+        if not self.jobs:
+            return 1.0
+        return max(0.0, min(job.next_run for job in self.jobs.values()) - time.monotonic())
+
+    def run_forever(self, max_sleep: float = 5.0):
+        """Main loop"""
+        logger.info(f"Job scheduler started with {len(self.jobs)} jobs and {self.max_workers} workers")
+        while True:
+            self.run_pending()
+            time.sleep(min(max_sleep, max(0.1, self.seconds_until_next())))
+
+    def shutdown(self, wait: bool = True):
+        self.executor.shutdown(wait=wait)
+
+
+def get_published_status() -> Optional[Dict]:
+    return caches['shared'].get(STATUS_CACHE_KEY)
+
+
+def command_job(name: str, *args, **options) -> Callable[[], str]:
+    """Job that runs a management command and logs its output"""
+    def run():
+        out = io.StringIO()
+        call_command(name, *args, stdout=out, stderr=out, **options)
+        output = out.getvalue().strip()
+        if output:
+            logger.info(f"{name}: {output.splitlines()[-1]}")
+        return output
+    return run
+
+
+def register_default_jobs(scheduler: JobScheduler, dry_run: bool = False):
+    """
+    The jobs previously run by the separate daemons
+
+    Intervals come from settings so deployments can tune them without code
+    changes; the defaults match the old daemons.
+    """
+    dry = ('--dry-run',) if dry_run else ()
+    cycle = getattr(settings, 'REFUND_JOB_INTERVAL', 120)
+
+    # auto_cancel_rentals_daemon / check_expired_rentals.bat: the cancel runs
+    # before the expiry check, as it did in the daemon
+    cancel_rentals = command_job('auto_cancel_5min_rentals', *dry)
+    # SWEEP_SHARDS > 1 fans the expiry check out over worker processes (app/sharding.py)
+    shards = getattr(settings, 'SWEEP_SHARDS', 1)
+    sharding = {'shards': shards, 'parallel': True} if shards > 1 else {}
+    expire_rentals = command_job('check_expired_rentals', *dry, limit=100, **sharding)
+
+    def rental_refunds():
+        cancel_rentals()
+        expire_rentals()
+
+    scheduler.register('rental_refunds', rental_refunds, cycle)
+
+    # auto_refund_daemon
+    if getattr(settings, 'FIVESIM_API_KEY', None):
+        from .fivesim_sweeper import FiveSimSweeper
+
+        # One sweeper keeps the 5sim connection pool warm between runs
+        sweeper = FiveSimSweeper(dry_run=dry_run)
+
+        def fivesim_sweep():
+            # Same lease as sweep_fivesim_orders and auto_refund_daemon
+            with hold_lease('sweep_fivesim_orders') as lease:
+                if lease is None:
+                    return SKIPPED
+                sweeper.sweep(lease=lease)
+
+        scheduler.register('fivesim_sweep', fivesim_sweep, cycle)
+
+    # auto_sync_daemon.py
+    scheduler.register(
+        'fivesim_service_sync', command_job('sync_fivesim_services', '--force'),
+        getattr(settings, 'FIVESIM_SYNC_INTERVAL_HOURS', 6) * 3600, jitter=0.05,
+    )
+    scheduler.register(
+        'fivesim_price_update', command_job('update_fivesim_prices'),
+        getattr(settings, 'FIVESIM_PRICE_UPDATE_INTERVAL_HOURS', 1) * 3600, jitter=0.05, misfire=SKIP,
+    )
+
+    # Operator success rates and SMS latency (app/operator_stats.py)
+    if not dry_run:
+        scheduler.register(
+            'operator_stats', command_job('rollup_operator_stats'),
+            getattr(settings, 'OPERATOR_STATS_INTERVAL', 300), misfire=SKIP,
+        )
+
+    # Refunds left pending by a crash (see app/refunds.py)
+    if not dry_run:
+        scheduler.register('apply_refunds', command_job('apply_refunds'), 60)
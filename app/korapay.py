@@ -1,6 +1,7 @@
-import requests
 from django.conf import settings
 
+from .http_transport import get_transport
+
 class KoraPayClient:
     def __init__(self):
         self.secret_key = settings.KORAPAY_SECRET_KEY
@@ -42,7 +43,7 @@ class KoraPayClient:
             payload["narration"] = narration
             
         try:
-            response = requests.post(self.initialize_url, headers=headers, json=payload, timeout=15)
+            response = get_transport('korapay').post(self.initialize_url, headers=headers, json=payload)
             data = response.json()
             if data.get("status") and data.get("data", {}).get("checkout_url"):
                 return {
@@ -65,7 +66,7 @@ class KoraPayClient:
         try:
             verify_url = f"{self.verify_url}?reference={reference}"
             logger.info(f"KoraPay verify_payment making request to: {verify_url}")
-            response = requests.get(verify_url, headers=headers, timeout=15)
+            response = get_transport('korapay').get(verify_url, headers=headers)
             logger.info(f"KoraPay verify_payment response status: {response.status_code}")
             
             # Check if request was successful
@@ -0,0 +1,249 @@
+"""
+Job Leases
+Lets a sweep or daemon run on several hosts for redundancy while only one
+instance does the work at a time (hot standby):
+
+- acquire_lease() takes the named JobLease row with one conditional UPDATE
+  that only matches a free or expired lease, so two hosts can never both win
+- Every acquisition increments the lease's token (a fencing token): writes
+  guarded with lease.assert_held() inside their transaction commit only
+  while that token is still current, so a holder that stalled past its TTL
+  and was replaced cannot act on stale state
+- Long sweeps also check lease.lost (set once a renewal finds the lease
+  taken over) between batches and stop early
+- hold_lease() renews the lease from a background thread while the job runs
+  and releases it afterwards; exclusive_command() wraps a management
+  command's handle() with it
+- Always-on daemons (run_sms_poller, run_deadline_scheduler) use
+  wait_for_lease(): standby instances wait and retry until the active one
+  stops or loses the lease
+"""
+
+import functools
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import timedelta
+from typing import Iterator, Optional
+
+from django.conf import settings
+from django.db import IntegrityError, connection, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .models import JobLease
+
+logger = logging.getLogger(__name__)
+
+# Identifies this process as a lease holder
+HOLDER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+class LeaseLost(Exception):
+    """Raised when a lease expired and was taken over by another holder"""
+    pass
+
+
+class Lease:
+    """
+    A held JobLease (name, holder, fencing token)
+    """
+
+    def __init__(self, name: str, holder: str, token: int, ttl: float):
+        self.name = name
+        self.holder = holder
+        self.token = token
+        self.ttl = ttl
+        self.lost = False
+
+    def renew(self) -> bool:
+        """Extend the lease by its TTL; False (and lost) if it was taken over"""
+        now = timezone.now()
+        renewed = JobLease.objects.filter(name=self.name, holder=self.holder, token=self.token).update(
+            expires_at=now + timedelta(seconds=self.ttl), renewed_at=now
+        )
+        if not renewed:
+            self.lost = True
+            logger.warning(f"Lease {self.name} (token {self.token}) was lost")
+        return bool(renewed)
+
+    def release(self):
+        JobLease.objects.filter(name=self.name, holder=self.holder, token=self.token).update(
+            holder='', expires_at=timezone.now()
+        )
+
+    def assert_held(self):
+        """
+        Fence a write: call inside the transaction doing the work
+
+        Writes the lease row (guarded by holder and token), which keeps it
+        write-locked until the transaction ends - a row lock on PostgreSQL and
+        MySQL, the database write lock on SQLite - so acquire_lease() on
+        another host waits for this commit and the lease cannot change hands
+        in between. Outside a transaction it is only a point-in-time check.
+
+        Raises:
+            LeaseLost: If another holder has the lease now
+        """
+        now = timezone.now()
+        held = JobLease.objects.filter(
+            name=self.name, holder=self.holder, token=self.token, expires_at__gt=now
+        ).update(renewed_at=now)
+        if not held:
+            self.lost = True
+            raise LeaseLost(f"Lease {self.name} (token {self.token}) is no longer held")
+
+
+def acquire_lease(name: str, ttl: Optional[float] = None, holder: str = HOLDER_ID) -> Optional[Lease]:
+    """
+    Take a lease if it is free or expired
+
+    Returns:
+        Lease, or None if another holder has it
+    """
+    ttl = ttl or getattr(settings, 'JOB_LEASE_TTL', 120)
+    now = timezone.now()
+    try:
+        with transaction.atomic():
+            JobLease.objects.get_or_create(name=name)
+    except IntegrityError:
+        pass  # Created concurrently
+
+    acquired = JobLease.objects.filter(name=name).filter(
+        Q(expires_at__lte=now) | Q(holder='')
+    ).update(
+        holder=holder,
+        token=F('token') + 1,
+        expires_at=now + timedelta(seconds=ttl),
+        acquired_at=now,
+        renewed_at=now,
+    )
+    if not acquired:
+        return None
+
+    token = JobLease.objects.filter(name=name, holder=holder).values_list('token', flat=True).first()
+    if token is None:
+        return None  # Lost it again already (TTL shorter than this call)
+    return Lease(name, holder, token, ttl)
+
+
+@contextmanager
+def hold_lease(name: str, ttl: Optional[float] = None) -> Iterator[Optional[Lease]]:
+    """
+    Hold a lease for the duration of a block, renewing it every TTL/3
+
+    Yields None if another holder has the lease; the block should then skip
+    its work.
+    """
+    lease = acquire_lease(name, ttl)
+    if lease is None:
+        yield None
+        return
+
+    stop = threading.Event()
+
+    def keep_alive():
+        try:
+            while not stop.wait(lease.ttl / 3):
+                try:
+                    if not lease.renew():
+                        break
+                except Exception as e:
+                    # Try again next time; the lease only lapses after a full TTL
+                    logger.warning(f"Could not renew lease {name}: {str(e)}")
+        finally:
+            connection.close()  # This thread's connection
+
+    renewer = threading.Thread(target=keep_alive, name=f"lease-{name}", daemon=True)
+    renewer.start()
+    try:
+        yield lease
+    finally:
+        stop.set()
+        renewer.join()
+        if not lease.lost:
+            lease.release()
+
+
+@contextmanager
+def wait_for_lease(name: str, ttl: Optional[float] = None,
+                   retry_interval: Optional[float] = None) -> Iterator[Lease]:
+    """
+    Like hold_lease(), but waits until the lease can be taken (for daemons
+    whose standby instances should take over from a failed active one)
+    """
+    retry_interval = retry_interval or getattr(settings, 'JOB_LEASE_RETRY_INTERVAL', 10)
+    waiting = False
+    while True:
+        with hold_lease(name, ttl) as lease:
+            if lease is not None:
+                if waiting:
+                    logger.info(f"Took over the {name} lease")
+                yield lease
+                return
+        if not waiting:
+            logger.info(f"Another instance holds the {name} lease - standing by")
+            waiting = True
+        connection.close()  # Don't hold a connection while standing by
+        time.sleep(retry_interval)
+
+
+def fence(lease: Optional[Lease]):
+    """lease.assert_held() for code that may run without a lease (None)"""
+    if lease is not None:
+        lease.assert_held()
+
+
+def stop_if_lost(command) -> bool:
+    """
+    For the loops of an exclusive_command: True (after a warning) once the
+    command's lease was taken over, so the sweep stops before its next item
+    """
+    lease = getattr(command, 'lease', None)
+    if lease is None or not lease.lost:
+        return False
+    command.stdout.write(command.style.WARNING(f'Lost the {lease.name} lease - stopping this run'))
+    return True
+
+
+def exclusive_command(name: Optional[str] = None, ttl: Optional[float] = None):
+    """
+    Decorator for BaseCommand.handle: run only while holding the command's
+    lease (named after the command module unless given)
+
+    The held Lease is available as self.lease for fencing writes; dry runs
+    don't take the lease and leave self.lease as None.
+
+    Every run of a command takes the same lease, sharded or not, so an
+    unsharded run and sharded runs with different shard counts never sweep
+    the same rows at once. A --parallel supervisor holds it for its shard
+    workers, which fence their writes with the supervisor's lease
+    (self.supervisor_lease, set by app/sharding.py) instead of taking one.
+    """
+    def decorator(handle):
+        @functools.wraps(handle)
+        def wrapper(self, *args, **options):
+            lease_name = name or self.__module__.rsplit('.', 1)[-1]
+            self.lease = None
+            if options.get('dry_run') or options.get('dry_run_only'):
+                return handle(self, *args, **options)
+            supervisor_lease = getattr(self, 'supervisor_lease', None)
+            if supervisor_lease is not None:
+                # Shard worker of a --parallel run
+                self.lease = supervisor_lease
+                return handle(self, *args, **options)
+
+            with hold_lease(lease_name, ttl) as lease:
+                if lease is None:
+                    self.stdout.write(self.style.WARNING(
+                        f'Another instance holds the {lease_name} lease - skipping this run'
+                    ))
+                    return None
+                self.lease = lease
+                return handle(self, *args, **options)
+        return wrapper
+    return decorator
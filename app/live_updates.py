@@ -0,0 +1,185 @@
+"""
+Live Order Updates (Server-Sent Events)
+Streams rental and 5sim order changes to the dashboards over one long-lived
+connection instead of each browser polling every active order.
+
+- Saves of Rental, SMSMessage, FiveSimOrder and FiveSimSMS bump a per-user
+  version in the 'shared' cache, so a stream in any worker notices changes
+  made by the SMS poller, sweepers or other requests within about a second
+- Every RESYNC_INTERVAL the stream re-reads the user's orders anyway, to
+  catch queryset.update() writes that bypass the save signals
+- Streams never call a provider: while they are enabled the SMS poller
+  (app/sms_poller.py) refreshes pending 5sim orders, which browser polling
+  of the order status view used to drive
+- Streams close after LIVE_UPDATES_MAX_SECONDS and the browser reconnects,
+  so a worker is never held indefinitely
+
+The stream is a sync generator that sleeps between checks, so each open
+tab holds a worker thread for the whole stream. It is therefore off unless
+LIVE_UPDATES_ENABLED is set, which should only be done when /api/events/ is
+served by an async server or workers set aside for it. While it is off the
+dashboards poll the existing endpoints, as do clients that cannot keep a
+stream open.
+"""
+
+import json
+import logging
+import time
+from datetime import timedelta
+from typing import Dict, Iterator, Optional
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import close_old_connections
+from django.db.models.signals import post_save
+from django.utils import timezone
+
+from .models import Rental, SMSMessage, FiveSimOrder, FiveSimSMS
+from .fivesim_sync import latest_sms_code
+
+logger = logging.getLogger(__name__)
+
+VERSION_CHECK_INTERVAL = 1.0  # seconds between shared-cache version checks
+RESYNC_INTERVAL = 15.0  # seconds between unconditional re-reads
+HEARTBEAT_INTERVAL = 15.0  # keeps proxies from closing an idle stream
+RECONNECT_MS = 3000
+
+# Orders shown on the dashboards
+RENTAL_WINDOW = timedelta(hours=24)
+ACTIVE_FIVESIM_STATUSES = ['PENDING', 'RECEIVED']
+
+
+def _version_key(user_id: int) -> str:
+    return f"live_updates:user:{user_id}"
+
+
+def notify_user(user_id: Optional[int]):
+    """Tell open streams of a user that their orders changed"""
+    if user_id is None:
+        return
+    cache = caches['shared']
+    key = _version_key(user_id)
+    try:
+        if not cache.add(key, 1, None):
+            cache.incr(key)
+    except ValueError:
+        cache.set(key, 1, None)
+    except Exception as e:
+        logger.debug(f"Could not bump live update version for user {user_id}: {str(e)}")
+
+
+def get_version(user_id: int) -> int:
+    return caches['shared'].get(_version_key(user_id), 0)
+
+
+def _on_save(sender, instance, **kwargs):
+    if sender is Rental or sender is FiveSimOrder:
+        notify_user(instance.user_id)
+    elif sender is SMSMessage:
+        notify_user(Rental.objects.filter(pk=instance.rental_id).values_list('user_id', flat=True).first())
+    elif sender is FiveSimSMS:
+        notify_user(FiveSimOrder.objects.filter(pk=instance.order_id).values_list('user_id', flat=True).first())
+
+
+def connect_signals():
+    """Called from AppConfig.ready()"""
+    for model in (Rental, SMSMessage, FiveSimOrder, FiveSimSMS):
+        post_save.connect(_on_save, sender=model, dispatch_uid=f"live_updates_{model.__name__}")
+
+
+def snapshot(user) -> Dict[str, dict]:
+    """
+    Current state of the user's dashboard orders
+
+    Returns:
+        {'rental:<rental_id>' | 'fivesim:<order_id>': event payload}
+    """
+    state = {}
+
+    rentals = Rental.objects.filter(
+        user=user, created_at__gte=timezone.now() - RENTAL_WINDOW
+    ).order_by('-created_at').prefetch_related('messages')[:50]
+    for rental in rentals:
+        messages = sorted(rental.messages.all(), key=lambda msg: msg.received_at, reverse=True)
+        state[f"rental:{rental.rental_id}"] = {
+            'type': 'rental',
+            'id': rental.rental_id,
+            'status': rental.status,
+            'code': messages[0].code if messages else None,
+        }
+
+    orders = FiveSimOrder.objects.filter(user=user).order_by('-created_at').prefetch_related('sms_messages')[:20]
+    for order in orders:
+        messages = sorted(order.sms_messages.all(), key=lambda sms: sms.date, reverse=True)
+        state[f"fivesim:{order.order_id}"] = {
+            'type': 'fivesim_order',
+            'id': str(order.order_id),
+            'status': order.status,
+            'sms_code': latest_sms_code(messages),
+            'expires_at': order.expires_at.isoformat(),
+        }
+    return state
+
+
+def live_updates_enabled() -> bool:
+    """Whether /api/events/ streams (off by default, see the module docstring)"""
+    return getattr(settings, 'LIVE_UPDATES_ENABLED', False)
+
+
+def pending_fivesim_orders():
+    """5sim orders still waiting for their first SMS (refreshed by the SMS poller)"""
+    return FiveSimOrder.objects.filter(
+        status__in=ACTIVE_FIVESIM_STATUSES, expires_at__gt=timezone.now()
+    ).exclude(sms_messages__isnull=False)
+
+
+def _format(event: str, data: dict, event_id: Optional[str] = None) -> str:
+    lines = []
+    if event_id:
+        lines.append(f"id: {event_id}")
+    lines.append(f"event: {event}")
+    lines.append(f"data: {json.dumps(data)}")
+    return "\n".join(lines) + "\n\n"
+
+
+def event_stream(user, max_seconds: Optional[float] = None) -> Iterator[str]:
+    """
+    SSE body for a user: a 'snapshot' event, then one event per changed order
+
+    Events are 'rental' and 'fivesim_order'; their data is the order's
+    snapshot payload. A 'bye' event is sent before the server closes the
+    stream so the client can tell it apart from a network error.
+    """
+    max_seconds = max_seconds or getattr(settings, 'LIVE_UPDATES_MAX_SECONDS', 300)
+    started = time.monotonic()
+    last_version = get_version(user.pk)
+    last_resync = last_heartbeat = started
+
+    try:
+        state = snapshot(user)
+        yield f"retry: {RECONNECT_MS}\n\n"
+        yield _format('snapshot', {'orders': list(state.values())}, str(last_version))
+
+        while time.monotonic() - started < max_seconds:
+            time.sleep(VERSION_CHECK_INTERVAL)
+            now = time.monotonic()
+
+            version = get_version(user.pk)
+            if version == last_version and now - last_resync < RESYNC_INTERVAL:
+                if now - last_heartbeat >= HEARTBEAT_INTERVAL:
+                    last_heartbeat = now
+                    yield ": heartbeat\n\n"
+                continue
+
+            last_version, last_resync = version, now
+            current = snapshot(user)
+            for key, payload in current.items():
+                if state.get(key) != payload:
+                    last_heartbeat = now
+                    yield _format(payload['type'], payload, str(version))
+            state = current
+
+        yield _format('bye', {})
+    finally:
+        # Streams run outside the request/response cycle's connection cleanup
+        close_old_connections()
@@ -0,0 +1,43 @@
+"""
+Logging Handlers
+QueuedFileHandler appends to a file from a background thread, so request
+handlers only pay for putting a record on an in-memory queue.
+"""
+
+import atexit
+import logging
+import logging.handlers
+import queue
+
+
+class QueuedFileHandler(logging.handlers.QueueHandler):
+    """
+    File handler whose writes happen on a QueueListener thread
+
+    Usable from LOGGING like logging.FileHandler:
+
+        'class': 'app.log_handlers.QueuedFileHandler',
+        'filename': BASE_DIR / 'korapay_debug.txt',
+    """
+
+    def __init__(self, filename, mode: str = 'a', encoding: str = 'utf-8'):
+        super().__init__(queue.SimpleQueue())
+        self.file_handler = logging.FileHandler(filename, mode=mode, encoding=encoding, delay=True)
+        self.listener = logging.handlers.QueueListener(self.queue, self.file_handler, respect_handler_level=False)
+        self.listener.start()
+        atexit.register(self.close)
+
+    def setFormatter(self, fmt):
+        # Formatting happens on the listener thread
+        self.file_handler.setFormatter(fmt)
+
+    def prepare(self, record):
+        # Keep the record intact; the file handler's formatter does the work
+        return record
+
+    def close(self):
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+            self.file_handler.close()
+        super().close()
@@ -1,6 +1,7 @@
 from django.core.management.base import BaseCommand
 from django.contrib.auth.models import User
-from app.models import UserProfile, Transaction
+from app.models import UserProfile
+from app.balance_ops import credit
 from decimal import Decimal
 import uuid
 
@@ -32,17 +33,9 @@ class Command(BaseCommand):
             old_balance = profile.balance
             old_balance_naira = profile.get_naira_balance()
             
-            # Add the balance
-            profile.balance += amount
-            profile.save()
-            
-            # Create transaction record
-            Transaction.objects.create(
-                user=user,
-                amount=amount,
-                transaction_type='CREDIT',
-                description=description
-            )
+            # Add the balance and record the transaction (atomic UPDATE, no read-modify-write)
+            credit(user.pk, amount, transaction_type='CREDIT', description=description)
+            profile.refresh_from_db(fields=['balance'])
             
             # Calculate new balances
             new_balance = profile.balance
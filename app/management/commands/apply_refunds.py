@@ -0,0 +1,38 @@
+"""
+Credit pending refund intents
+The poller, sweeps and views apply the refunds they queue themselves; this
+picks up anything left pending (e.g. a process died between recording a
+refund and crediting it). Safe to run alongside them.
+"""
+from django.core.management.base import BaseCommand
+
+from app.models import RefundIntent
+from app.refunds import apply_refunds
+
+
+class Command(BaseCommand):
+    help = 'Apply pending refunds in batches (one balance update per user)'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=None,
+            help='Refunds per batch (default: REFUND_BATCH_SIZE or 500)',
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Show pending refunds without applying them',
+        )
+
+    def handle(self, *args, **options):
+        if options['dry_run']:
+            pending = RefundIntent.objects.filter(status='PENDING').select_related('user').order_by('created_at')
+            for intent in pending:
+                self.stdout.write(f'[DRY RUN] Would refund ₦{intent.amount} to {intent.user.username} ({intent.key})')
+            self.stdout.write(self.style.WARNING(f'[DRY RUN] {len(pending)} pending refunds'))
+            return
+
+        applied = apply_refunds(limit=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Applied {applied} refunds'))
@@ -6,8 +6,10 @@ from django.core.management.base import BaseCommand
 from django.utils import timezone
 from datetime import timedelta
 from django.db import transaction
-from app.models import FiveSimOrder, UserProfile, Transaction
+from app.models import FiveSimOrder
+from app.refunds import queue_fivesim_refund, apply_refunds
 from app.fivesim import FiveSimAPI
+from app.leases import exclusive_command, stop_if_lost
 from django.conf import settings
 
 
@@ -21,6 +23,7 @@ class Command(BaseCommand):
             help='Show what would be cancelled without actually doing it',
         )
 
+    @exclusive_command()
     def handle(self, *args, **options):
         dry_run = options['dry_run']
         
@@ -58,6 +61,8 @@ class Command(BaseCommand):
         error_count = 0
         
         for order in waiting_orders:
+            if stop_if_lost(self):
+                break
             # Check if SMS was received - if yes, skip
             if order.sms_messages.exists():
                 if dry_run:
@@ -107,18 +112,8 @@ class Command(BaseCommand):
                         order.refunded = True
                         order.save()
                         
-                        # Refund user with locked profile
-                        profile = UserProfile.objects.select_for_update().get(user=order.user)
-                        profile.balance += order.price_naira
-                        profile.save()
-                        
-                        # Log transaction
-                        Transaction.objects.create(
-                            user=order.user,
-                            amount=order.price_naira,
-                            transaction_type='REFUND',
-                            description=f'Auto-cancel: No SMS after 5 minutes - {order.product} ({order.phone_number})'
-                        )
+                        # Queue the refund (credited in one batch after the loop)
+                        queue_fivesim_refund(order, f'Auto-cancel: No SMS after 5 minutes - {order.product} ({order.phone_number})')
                         
                         self.stdout.write(
                             self.style.SUCCESS(
@@ -136,6 +131,9 @@ class Command(BaseCommand):
                     self.style.ERROR(f'✗ Error cancelling Order #{order.id}: {str(e)}')
                 )
         
+        if not dry_run:
+            apply_refunds()
+        
         # Summary
         self.stdout.write('\n' + '='*50)
         if dry_run:
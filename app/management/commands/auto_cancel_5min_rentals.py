@@ -6,8 +6,11 @@ from django.core.management.base import BaseCommand
 from django.utils import timezone
 from datetime import timedelta
 from django.db import transaction
-from app.models import Rental, UserProfile, Transaction, SMSMessage
+from app.models import Rental, SMSMessage
 from app.mtelsms import get_mtelsms_client, MTelSMSException
+from app.refunds import queue_rental_refund, apply_refunds
+from app.webhooks import emit_order_event
+from app.leases import exclusive_command, stop_if_lost
 
 
 class Command(BaseCommand):
@@ -20,6 +23,7 @@ class Command(BaseCommand):
             help='Show what would be cancelled without actually doing it',
         )
 
+    @exclusive_command()
     def handle(self, *args, **options):
         dry_run = options['dry_run']
         
@@ -52,6 +56,8 @@ class Command(BaseCommand):
         client = get_mtelsms_client()
         
         for rental in waiting_rentals:
+            if stop_if_lost(self):
+                break
             # Calculate wait time
             wait_time = timezone.now() - rental.created_at
             wait_minutes = wait_time.total_seconds() / 60
@@ -67,14 +73,16 @@ class Command(BaseCommand):
                     # If SMS was received, save it and skip cancellation
                     if status == 'RECEIVED' and code:
                         if not dry_run:
-                            rental.status = 'RECEIVED'
-                            rental.save()
-                            
-                            SMSMessage.objects.get_or_create(
-                                rental=rental,
-                                code=code,
-                                defaults={'full_text': code}
-                            )
+                            with transaction.atomic():
+                                rental.status = 'RECEIVED'
+                                rental.save()
+                                
+                                SMSMessage.objects.get_or_create(
+                                    rental=rental,
+                                    code=code,
+                                    defaults={'full_text': code}
+                                )
+                                emit_order_event('sms_received', rental, code=code)
                         
                         self.stdout.write(
                             self.style.SUCCESS(
@@ -124,21 +132,11 @@ class Command(BaseCommand):
                                 rental.status = 'CANCELLED'
                                 rental.refunded = True
                                 rental.save()
+                                emit_order_event('order_cancelled', rental)
                                 
-                                # Refund user with locked profile
+                                # Queue the refund (credited in one batch after the loop)
                                 refund_amount_naira = rental.get_naira_price()
-                                profile = UserProfile.objects.select_for_update().get(user=rental.user)
-                                profile.balance += refund_amount_naira
-                                profile.save()
-                                
-                                # Log transaction
-                                Transaction.objects.create(
-                                    user=rental.user,
-                                    amount=refund_amount_naira,
-                                    transaction_type='REFUND',
-                                    description=f'Auto-cancel: No SMS after 5 minutes - {rental.phone_number}',
-                                    rental=rental
-                                )
+                                queue_rental_refund(rental, f'Auto-cancel: No SMS after 5 minutes - {rental.phone_number}')
                                 
                                 self.stdout.write(
                                     self.style.SUCCESS(
@@ -160,6 +158,9 @@ class Command(BaseCommand):
                     self.style.ERROR(f'✗ Error processing Rental #{rental.id}: {str(e)}')
                 )
         
+        if not dry_run:
+            apply_refunds()
+        
         # Summary
         self.stdout.write('\n' + '='*50)
         if dry_run:
@@ -5,6 +5,8 @@ Always-on daemon for Dashboard-2 (MTelSMS) that:
 
 This is the Dashboard-2 equivalent of auto_refund_daemon.py
 Run as an always-on task on PythonAnywhere
+
+Superseded by run_jobs, which runs this cycle with the other periodic jobs
 """
 from django.core.management.base import BaseCommand
 from django.core.management import call_command
@@ -1,8 +1,17 @@
+"""
+Development auto-refund daemon: sweeps 5sim orders every --interval seconds
+
+Superseded by run_jobs, which runs the same sweep with the other periodic jobs
+"""
 from django.core.management.base import BaseCommand
-from django.core.management import call_command
+from django.conf import settings
 import time
 from datetime import datetime
 
+from app.fivesim_sweeper import FiveSimSweeper
+from app.leases import hold_lease
+from app.management.commands.sweep_fivesim_orders import Command as SweepCommand
+
 class Command(BaseCommand):
     help = 'Development auto-refund daemon - simulates production cron job'
 
@@ -22,54 +31,45 @@ class Command(BaseCommand):
     def handle(self, *args, **options):
         interval = options['interval']
         dry_run_only = options['dry_run_only']
-        
+
         self.stdout.write(
             self.style.SUCCESS(f'🧪 Starting development auto-refund daemon')
         )
         self.stdout.write(f'   Interval: {interval} seconds')
         self.stdout.write(f'   Dry-run only: {dry_run_only}')
         self.stdout.write('   Press Ctrl+C to stop\n')
-        
+
+        if not getattr(settings, 'FIVESIM_API_KEY', None):
+            self.stdout.write(self.style.ERROR('FIVESIM_API_KEY not configured'))
+            return
+
+        # One sweeper for the daemon's lifetime keeps the 5sim connection pool warm
+        sweeper = FiveSimSweeper(dry_run=dry_run_only)
+        summary = SweepCommand(stdout=self.stdout, stderr=self.stderr)
+
         try:
             while True:
                 self.stdout.write(f'[{datetime.now()}] Starting refund cycle...')
-                
-                # STEP 1: Sync order statuses from 5sim first
-                self.stdout.write('   → Syncing order statuses from 5sim...')
-                try:
-                    if dry_run_only:
-                        call_command('sync_fivesim_order_statuses', '--dry-run')
-                    else:
-                        call_command('sync_fivesim_order_statuses')
-                except Exception as e:
-                    self.stdout.write(
-                        self.style.ERROR(f'   ✗ Status sync failed: {str(e)}')
-                    )
-                
-                # STEP 1.5: Auto-cancel orders waiting > 5 minutes without SMS
-                self.stdout.write('   → Auto-cancelling orders waiting > 5 minutes...')
+
+                # Sync statuses, auto-cancel orders waiting > 5 minutes and
+                # refund expired orders in a single concurrent pass
+                self.stdout.write('   → Sweeping 5sim orders (sync, 5-minute cancel, expired refunds)...')
                 try:
-                    if dry_run_only:
-                        call_command('auto_cancel_5min_fivesim', '--dry-run')
-                    else:
-                        call_command('auto_cancel_5min_fivesim')
+                    # Standby instances on other hosts skip the cycle while one sweeps
+                    with hold_lease('sweep_fivesim_orders') as lease:
+                        if lease is None:
+                            self.stdout.write('   → Another instance is sweeping, skipping this cycle')
+                        else:
+                            stats = sweeper.sweep(lease=lease)
+                            summary.write_summary(stats, dry_run=dry_run_only)
                 except Exception as e:
                     self.stdout.write(
-                        self.style.ERROR(f'   ✗ 5-minute auto-cancel failed: {str(e)}')
+                        self.style.ERROR(f'   ✗ Sweep failed: {str(e)}')
                     )
-                
-                # STEP 2: Process refunds for expired orders
-                self.stdout.write('   → Checking for expired orders to refund...')
-                if dry_run_only:
-                    # Always dry-run
-                    call_command('auto_refund_expired_fivesim', '--dry-run')
-                else:
-                    # Run actual refunds
-                    call_command('auto_refund_expired_fivesim')
-                
+
                 self.stdout.write(f'✓ Cycle complete. Sleeping for {interval} seconds...\n')
                 time.sleep(interval)
-                
+
         except KeyboardInterrupt:
             self.stdout.write(
                 self.style.WARNING('\n🛑 Auto-refund daemon stopped by user')
@@ -2,7 +2,9 @@ from django.core.management.base import BaseCommand
 from django.utils import timezone
 from datetime import timedelta
 from django.db import transaction
-from app.models import FiveSimOrder, UserProfile, Transaction
+from app.models import FiveSimOrder
+from app.refunds import queue_fivesim_refund, apply_refunds
+from app.leases import exclusive_command, stop_if_lost
 
 class Command(BaseCommand):
     help = 'Automatically refund expired 5sim orders that never received SMS'
@@ -20,6 +22,7 @@ class Command(BaseCommand):
             help='Maximum age of orders to check (default: 72 hours)',
         )
 
+    @exclusive_command()
     def handle(self, *args, **options):
         dry_run = options['dry_run']
         max_age_hours = options['max_age_hours']
@@ -51,6 +54,8 @@ class Command(BaseCommand):
         error_count = 0
         
         for order in expired_orders:
+            if stop_if_lost(self):
+                break
             # Check if order has truly expired using the actual expires_at field
             if timezone.now() <= order.expires_at:
                 # Order hasn't expired yet, skip it
@@ -96,18 +101,8 @@ class Command(BaseCommand):
                         order.refunded = True
                         order.save()
                         
-                        # Refund user with locked profile
-                        profile = UserProfile.objects.select_for_update().get(user=order.user)
-                        profile.balance += order.price_naira
-                        profile.save()
-                        
-                        # Log transaction
-                        Transaction.objects.create(
-                            user=order.user,
-                            amount=order.price_naira,
-                            transaction_type='REFUND',
-                            description=f'Auto-refund: Expired Dashboard 1 order #{order.id} - {order.product} ({order.phone_number})'
-                        )
+                        # Queue the refund (credited in one batch after the loop)
+                        queue_fivesim_refund(order, f'Auto-refund: Expired Dashboard 1 order #{order.id} - {order.product} ({order.phone_number})')
                         
                         self.stdout.write(
                             self.style.SUCCESS(
@@ -125,6 +120,9 @@ class Command(BaseCommand):
                     self.style.ERROR(f'✗ Error refunding Order #{order.id}: {str(e)}')
                 )
         
+        if not dry_run:
+            apply_refunds()
+        
         # Summary
         self.stdout.write('\n' + '='*50)
         if dry_run:
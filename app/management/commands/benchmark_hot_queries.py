@@ -0,0 +1,269 @@
+"""
+Management command to benchmark the hot Rental/FiveSimOrder/APIOrderMapping
+queries with and without the indexes from migration 0018.
+
+Seeds a synthetic dataset, prints the query plan and timing of each query
+with the indexes dropped and again with them in place, then rolls back every
+change - nothing is left in the database.
+"""
+import random
+import time
+from contextlib import contextmanager
+from datetime import timedelta
+from decimal import Decimal
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Exists, OuterRef, Q
+from django.utils import timezone
+
+from app.models import Rental, Service, FiveSimOrder, FiveSimSMS, APIKey, APIOrderMapping
+
+
+class Rollback(Exception):
+    """Raised to undo the seeded data once the benchmark is done"""
+    pass
+
+
+@contextmanager
+def explicit_timestamps(*models):
+    """Let bulk_create keep the seeded created_at/updated_at values"""
+    fields = [
+        field for model in models for field in model._meta.concrete_fields
+        if getattr(field, 'auto_now', False) or getattr(field, 'auto_now_add', False)
+    ]
+    saved = [(field, field.auto_now, field.auto_now_add) for field in fields]
+    for field in fields:
+        field.auto_now = field.auto_now_add = False
+    try:
+        yield
+    finally:
+        for field, auto_now, auto_now_add in saved:
+            field.auto_now, field.auto_now_add = auto_now, auto_now_add
+
+
+class Command(BaseCommand):
+    help = 'Benchmark hot dashboard/sweep queries before and after the composite indexes (rolled back)'
+
+    BENCHMARK_INDEXES = [
+        (Rental, 'rental_user_created_idx'),
+        (Rental, 'rental_waiting_created_idx'),
+        (FiveSimOrder, 'fivesim_user_created_idx'),
+        (FiveSimOrder, 'fivesim_status_created_idx'),
+        (APIOrderMapping, 'apiorder_key_created_idx'),
+    ]
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--rows',
+            type=int,
+            default=1000000,
+            help='Rentals and 5sim orders to seed (each; default: 1,000,000)'
+        )
+        parser.add_argument(
+            '--users',
+            type=int,
+            default=2000,
+            help='Users to spread the rows over (default: 2000)'
+        )
+        parser.add_argument(
+            '--repeat',
+            type=int,
+            default=5,
+            help='Runs per query; the best time is reported (default: 5)'
+        )
+
+    def handle(self, *args, **options):
+        self.repeat = options['repeat']
+        random.seed(42)
+
+        try:
+            with transaction.atomic():
+                self._seed(options['rows'], options['users'])
+
+                self.stdout.write(self.style.WARNING('\n=== BEFORE: indexes dropped ==='))
+                self._set_indexes(drop=True)
+                before = self._run_queries()
+
+                self.stdout.write(self.style.SUCCESS('\n=== AFTER: indexes in place ==='))
+                self._set_indexes(drop=False)
+                after = self._run_queries()
+
+                self._summary(before, after)
+                raise Rollback()
+        except Rollback:
+            self.stdout.write('\nSeeded data rolled back')
+
+    # Seeding
+
+    def _seed(self, rows, user_count):
+        started = time.time()
+        now = timezone.now()
+        batch = 5000
+
+        self.stdout.write(f'Seeding {user_count} users, {rows} rentals and {rows} 5sim orders...')
+
+        users = User.objects.bulk_create([
+            User(username=f'bench_user_{i}', email=f'bench_{i}@example.com') for i in range(user_count)
+        ], batch_size=batch)
+        if users[0].pk is None:
+            users = list(User.objects.filter(username__startswith='bench_user_'))
+        user_ids = [user.pk for user in users]
+
+        service = Service.objects.create(code='bench_service', name='Benchmark Service')
+        api_keys = [
+            APIKey.objects.create(user_id=user_id, key_hash=f'{i:064d}')
+            for i, user_id in enumerate(user_ids[:50])
+        ]
+        self.api_key = api_keys[0]
+        self.user_id = user_ids[0]
+
+        def age():
+            # Mostly old rows, ~0.1% created in the last 10 minutes
+            if random.random() < 0.001:
+                return now - timedelta(seconds=random.randint(0, 600))
+            return now - timedelta(minutes=random.randint(10, 60 * 24 * 365))
+
+        with explicit_timestamps(Rental, FiveSimOrder, APIOrderMapping):
+            for start in range(0, rows, batch):
+                rentals = []
+                for i in range(start, min(start + batch, rows)):
+                    created_at = age()
+                    recent = now - created_at < timedelta(minutes=20)
+                    status = 'WAITING' if recent else random.choice(['RECEIVED', 'EXPIRED', 'CANCELLED'])
+                    rentals.append(Rental(
+                        user_id=random.choice(user_ids),
+                        rental_id=f'bench_{i}',
+                        service=service,
+                        phone_number='+10000000000',
+                        status=status,
+                        price=Decimal('1500.00'),
+                        refunded=status in ('EXPIRED', 'CANCELLED'),
+                        created_at=created_at,
+                        updated_at=created_at,
+                    ))
+                Rental.objects.bulk_create(rentals)
+
+                orders = []
+                for i in range(start, min(start + batch, rows)):
+                    created_at = age()
+                    recent = now - created_at < timedelta(minutes=20)
+                    status = 'PENDING' if recent else random.choice(['FINISHED', 'RECEIVED', 'CANCELED', 'TIMEOUT', 'EXPIRED'])
+                    orders.append(FiveSimOrder(
+                        user_id=random.choice(user_ids),
+                        order_id=900000000 + i,
+                        phone_number='+10000000000',
+                        country='usa',
+                        operator='any',
+                        product='whatsapp',
+                        price=Decimal('10.00'),
+                        price_naira=Decimal('1200.00'),
+                        status=status,
+                        expires_at=created_at + timedelta(minutes=15),
+                        refunded=status in ('CANCELED', 'TIMEOUT', 'EXPIRED'),
+                        created_at=created_at,
+                        updated_at=created_at,
+                    ))
+                FiveSimOrder.objects.bulk_create(orders)
+
+            # Reseller orders for the benchmark API key's rentals (plus other keys)
+            mapped = list(Rental.objects.filter(rental_id__startswith='bench_').values_list('pk', 'created_at')[:rows // 10])
+            for start in range(0, len(mapped), batch):
+                APIOrderMapping.objects.bulk_create([
+                    APIOrderMapping(
+                        api_key=random.choice(api_keys),
+                        rental_id=rental_pk,
+                        api_order_id=f'BENCH{rental_pk}',
+                        api_price=Decimal('1800.00'),
+                        base_price=Decimal('1500.00'),
+                        status='RECEIVED',
+                        created_at=created_at,
+                        updated_at=created_at,
+                    )
+                    for rental_pk, created_at in mapped[start:start + batch]
+                ])
+
+        self._analyze()
+        self.stdout.write(f'Seeded in {time.time() - started:.1f}s')
+
+    def _analyze(self):
+        """Refresh planner statistics so the plans reflect the seeded data"""
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+
+    def _set_indexes(self, drop):
+        # Run the index DDL directly: SQLite's schema editor refuses to open
+        # inside the transaction that keeps the seeded data revertible
+        editor = connection.schema_editor()
+        with connection.cursor() as cursor:
+            for model, name in self.BENCHMARK_INDEXES:
+                index = next(index for index in model._meta.indexes if index.name == name)
+                if drop:
+                    statement = editor.sql_delete_index % {'name': editor.quote_name(index.name)}
+                else:
+                    statement = str(index.create_sql(model, editor))
+                cursor.execute(statement)
+        self._analyze()
+
+    # Queries
+
+    def _queries(self):
+        """The real access paths, mirrored from their call sites"""
+        now = timezone.now()
+        has_sms = FiveSimSMS.objects.filter(order=OuterRef('pk')).exclude(
+            Q(text__isnull=True) & Q(code__isnull=True)
+        )
+        return [
+            ('check_expired_rentals', Rental.objects.filter(
+                status='WAITING', refunded=False
+            ).order_by('-created_at')[:100]),
+            ('auto_cancel_5min_rentals', Rental.objects.filter(
+                status='WAITING', created_at__lte=now - timedelta(minutes=5), refunded=False
+            )),
+            ('get_rental_history', Rental.objects.filter(
+                user_id=self.user_id, created_at__gte=now - timedelta(days=365)
+            ).order_by('-created_at')[:20]),
+            ('get_user_orders', FiveSimOrder.objects.filter(
+                user_id=self.user_id
+            ).exclude(
+                status__in=['CANCELED', 'EXPIRED', 'TIMEOUT']
+            ).filter(
+                Q(status__in=['PENDING', 'RECEIVED']) | Q(Exists(has_sms)) | Q(status='FINISHED')
+            ).order_by('-created_at')[:20]),
+            ('fivesim_sweep', FiveSimOrder.objects.filter(
+                Q(status__in=['PENDING', 'RECEIVED'], created_at__gte=now - timedelta(hours=48)) |
+                Q(status__in=['PENDING', 'TIMEOUT', 'CANCELED'], created_at__gte=now - timedelta(hours=72), refunded=False)
+            )),
+            ('auto_refund_expired_fivesim', FiveSimOrder.objects.filter(
+                status__in=['PENDING', 'TIMEOUT', 'CANCELED'],
+                created_at__gte=now - timedelta(hours=72),
+                refunded=False
+            )),
+            ('api_get_orders', APIOrderMapping.objects.filter(
+                api_key=self.api_key
+            ).order_by('-created_at')[:20]),
+        ]
+
+    def _run_queries(self):
+        timings = {}
+        for name, queryset in self._queries():
+            best = None
+            for _ in range(self.repeat):
+                started = time.perf_counter()
+                list(queryset.all())
+                elapsed = (time.perf_counter() - started) * 1000
+                best = elapsed if best is None else min(best, elapsed)
+            timings[name] = best
+
+            self.stdout.write(f'\n{name}: {best:.2f}ms')
+            for line in queryset.explain().splitlines():
+                self.stdout.write(f'   {line}')
+        return timings
+
+    def _summary(self, before, after):
+        self.stdout.write(self.style.SUCCESS('\n=== SUMMARY (best of %d) ===' % self.repeat))
+        self.stdout.write(f"{'query':<30}{'before':>12}{'after':>12}{'speedup':>10}")
+        for name in before:
+            speedup = before[name] / after[name] if after[name] else float('inf')
+            self.stdout.write(f'{name:<30}{before[name]:>10.2f}ms{after[name]:>10.2f}ms{speedup:>9.1f}x')
@@ -3,7 +3,7 @@ Management command to cap all user balances at a maximum amount
 Useful for testing or cleanup purposes
 """
 from django.core.management.base import BaseCommand
-from django.db import transaction
+from django.utils import timezone
 from app.models import UserProfile
 from decimal import Decimal
 
@@ -67,14 +67,11 @@ class Command(BaseCommand):
             self.stdout.write(self.style.WARNING('Operation cancelled'))
             return
         
-        # Apply the cap
-        updated_count = 0
-        
-        with transaction.atomic():
-            for profile in UserProfile.objects.filter(balance__gt=max_balance).select_for_update():
-                profile.balance = max_balance
-                profile.save()
-                updated_count += 1
+        # Apply the cap with one conditional UPDATE (balances that dropped below the cap since the
+        # count above are left alone)
+        updated_count = UserProfile.objects.filter(balance__gt=max_balance).update(
+            balance=max_balance, updated_at=timezone.now()
+        )
         
         self.stdout.write('')
         self.stdout.write(
@@ -1,16 +1,32 @@
 """
 Management command to check for expired rentals and issue refunds
 Run this periodically via cron or task scheduler
+
+Expired rentals are found from the stored provider deadline
+(Rental.expires_at) with one indexed query; MTelSMS is not called. Codes that
+arrive before the deadline are stored by the SMS poller.
+
+The whole batch is expired with one UPDATE and refunded through the refund
+ledger (one balance update per user, one bulk insert of transactions).
+
+Large sweeps can be split by rental: --shards N --shard-index I checks one
+shard, --parallel checks every shard on worker processes (app/sharding.py).
+--limit then applies per shard.
 """
 from django.core.management.base import BaseCommand
 from django.db import transaction
 from django.utils import timezone
-from app.models import Rental, Transaction, SMSMessage, UserProfile
-from app.mtelsms import get_mtelsms_client, MTelSMSException
+from app.models import Rental
+from app.refunds import rental_refund, rental_refund_key, queue_refunds, apply_refunds
+from app.live_updates import notify_user
+from app.webhooks import emit_order_event
+from app.leases import exclusive_command
+from app.sharding import add_shard_arguments, shard_options, shard_queryset, supervise
 
 
 class Command(BaseCommand):
     help = 'Check for expired rentals and automatically issue refunds'
+    shard_passthrough_options = ('limit', 'dry_run', 'verbosity')
 
     def add_arguments(self, parser):
         parser.add_argument(
@@ -24,129 +40,104 @@ class Command(BaseCommand):
             action='store_true',
             help='Show what would be refunded without actually doing it',
         )
+        add_shard_arguments(parser)
 
+    @exclusive_command()
     def handle(self, *args, **options):
         limit = options['limit']
         dry_run = options['dry_run']
+        shards, shard_index = shard_options(options)
         
         if dry_run:
             self.stdout.write(self.style.WARNING('DRY RUN MODE - No changes will be made'))
         
-        # Get active rentals that might be expired
-        active_rentals = Rental.objects.filter(
+        if options['parallel']:
+            supervise(self, 'check_expired_rentals', options, shards)
+            return
+        
+        # WAITING, unrefunded rentals past their provider deadline (rental_waiting_expires_idx)
+        expired_rentals = list(shard_queryset(Rental.objects.filter(
             status='WAITING',
-            refunded=False  # Only non-refunded rentals
-        ).order_by('-created_at')[:limit]
+            refunded=False,
+            expires_at__lte=timezone.now()
+        ), shards, shard_index).select_related('user').order_by('expires_at')[:limit])
         
-        self.stdout.write(f"Checking {active_rentals.count()} active rentals for expiration...")
+        self.stdout.write(f"Found {len(expired_rentals)} expired rentals...")
         
         expired_count = 0
         refunded_count = 0
         error_count = 0
         
-        client = get_mtelsms_client()
-        
-        for rental in active_rentals:
-            try:
-                # Check status with MTelSMS
-                status, code, phone_number, time_remaining = client.get_code(
-                    rental_id=rental.rental_id
+        if dry_run:
+            for rental in expired_rentals:
+                self.stdout.write(
+                    self.style.WARNING(
+                        f"[DRY RUN] Would refund expired: {rental.rental_id} - {rental.phone_number}"
+                    )
                 )
+                expired_count += 1
+        elif expired_rentals:
+            try:
+                with transaction.atomic():
+                    # Commit only while this instance still holds the sweep lease
+                    if self.lease:
+                        self.lease.assert_held()
+                    
+                    # Reload with locks and re-check (double-refund protection)
+                    locked = list(Rental.objects.select_for_update().filter(
+                        pk__in=[rental.pk for rental in expired_rentals],
+                        status='WAITING',
+                        refunded=False
+                    ))
+                    handled = len(expired_rentals) - len(locked)
+                    if handled:
+                        self.stdout.write(self.style.WARNING(f"⚠ Already handled: {handled} rentals"))
+                    
+                    # Mark them expired in one statement and queue their refunds
+                    Rental.objects.filter(pk__in=[rental.pk for rental in locked]).update(
+                        status='EXPIRED', refunded=True, updated_at=timezone.now()
+                    )
+                    for rental in locked:
+                        rental.status = 'EXPIRED'
+                        rental.refunded = True
+                        emit_order_event('order_expired', rental)
+                    queue_refunds([
+                        rental_refund(rental, f'Automatic refund for expired rental {rental.phone_number}')
+                        for rental in locked
+                    ])
+                    expired_count = len(locked)
                 
-                # Check if expired
-                if time_remaining <= 0 and status == 'WAITING':
-                    if dry_run:
-                        self.stdout.write(
-                            self.style.WARNING(
-                                f"[DRY RUN] Would refund expired: {rental.rental_id} - {rental.phone_number}"
-                            )
-                        )
-                        expired_count += 1
-                    else:
-                        with transaction.atomic():
-                            # Reload rental with lock to prevent race conditions
-                            rental = Rental.objects.select_for_update().get(rental_id=rental.rental_id)
-                            
-                            # Check if already refunded (double-refund protection)
-                            if rental.refunded:
-                                self.stdout.write(
-                                    self.style.WARNING(
-                                        f"⚠ Already refunded: {rental.rental_id}"
-                                    )
-                                )
-                                continue
-                            
-                            # Mark as expired
-                            rental.status = 'EXPIRED'
-                            rental.refunded = True
-                            rental.save()
-                            expired_count += 1
-                            
-                            # Issue refund with locked profile
-                            profile = UserProfile.objects.select_for_update().get(user=rental.user)
-                            profile.balance += rental.price
-                            profile.save()
-                            
-                            # Log refund transaction
-                            Transaction.objects.create(
-                                user=rental.user,
-                                amount=rental.price,
-                                transaction_type='REFUND',
-                                description=f'Automatic refund for expired rental {rental.phone_number}'
-                            )
-                            
-                            refunded_count += 1
-                                
-                            self.stdout.write(
-                                self.style.SUCCESS(
-                                    f"✓ Expired and refunded: {rental.rental_id} - {rental.phone_number}"
-                                )
-                            )
+                # One balance update per user, one bulk insert of REFUND transactions.
+                # A shard only applies its own refunds, so shards don't contend.
+                keys = [rental_refund_key(rental) for rental in locked] if shard_index is not None else None
+                refunded_count = apply_refunds(keys=keys)
                 
-                elif status == 'RECEIVED' and code:
-                    # Update status if SMS was received and save the SMS message
-                    if not dry_run:
-                        rental.status = 'RECEIVED'
-                        rental.save()
-                        
-                        # Save SMS message if not already saved
-                        SMSMessage.objects.get_or_create(
-                            rental=rental,
-                            code=code,
-                            defaults={'full_text': code}
-                        )
-                    
+                for rental in locked:
+                    notify_user(rental.user_id)
                     self.stdout.write(
                         self.style.SUCCESS(
-                            f"✓ SMS received: {rental.rental_id} - {code}"
+                            f"✓ Expired and refunded: {rental.rental_id} - {rental.phone_number}"
                         )
                     )
-                
-            except MTelSMSException as e:
-                error_count += 1
-                self.stdout.write(
-                    self.style.ERROR(
-                        f"✗ Error checking {rental.rental_id}: {str(e)}"
-                    )
-                )
             
             except Exception as e:
                 error_count += 1
                 self.stdout.write(
                     self.style.ERROR(
-                        f"✗ Unexpected error for {rental.rental_id}: {str(e)}"
+                        f"✗ Unexpected error expiring rentals: {str(e)}"
                     )
                 )
         
-        # Summary
+        self.counters = {'expired': expired_count, 'refunded': refunded_count, 'errors': error_count}
+        self.write_summary(self.counters, dry_run)
+    
+    def write_summary(self, counters, dry_run):
         self.stdout.write("\n" + "="*50)
         if dry_run:
-            self.stdout.write(self.style.WARNING(f"[DRY RUN] Checked: {active_rentals.count()} rentals"))
-            self.stdout.write(self.style.WARNING(f"[DRY RUN] Would have refunded: {expired_count} expired rentals"))
+            self.stdout.write(self.style.WARNING(f"[DRY RUN] Would have refunded: {counters.get('expired', 0)} expired rentals"))
         else:
-            self.stdout.write(self.style.SUCCESS(f"✓ Checked: {active_rentals.count()} rentals"))
-            self.stdout.write(self.style.WARNING(f"⏰ Expired: {expired_count} rentals"))
-            self.stdout.write(self.style.SUCCESS(f"💰 Refunded: {refunded_count} rentals"))
-        if error_count > 0:
-            self.stdout.write(self.style.ERROR(f"✗ Errors: {error_count}"))
+            self.stdout.write(self.style.WARNING(f"⏰ Expired: {counters.get('expired', 0)} rentals"))
+            self.stdout.write(self.style.SUCCESS(f"💰 Refunded: {counters.get('refunded', 0)} rentals"))
+        if counters.get('errors', 0) > 0:
+            self.stdout.write(self.style.ERROR(f"✗ Errors: {counters['errors']}"))
         self.stdout.write("="*50)
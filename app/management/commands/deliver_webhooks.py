@@ -0,0 +1,63 @@
+"""
+Always-on sender for reseller webhooks
+Sends events queued in WebhookDelivery (SMS received, order expired/cancelled)
+to each reseller's APIWebhook endpoint, batching and retrying as needed.
+
+Several instances may run at once; deliveries are leased before sending.
+"""
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from app.webhooks import WebhookDispatcher
+
+
+class Command(BaseCommand):
+    help = 'Deliver queued reseller webhook events'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--interval',
+            type=float,
+            default=2.0,
+            help='Seconds to sleep when nothing is due (default: 2.0)',
+        )
+        parser.add_argument(
+            '--concurrency',
+            type=int,
+            default=None,
+            help='Endpoints called in parallel (default: WEBHOOK_CONCURRENCY or 8)',
+        )
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Deliver everything that is due once and exit',
+        )
+
+    def handle(self, *args, **options):
+        dispatcher = WebhookDispatcher(concurrency=options['concurrency'])
+
+        if options['once']:
+            self._write_stats(dispatcher.run_once())
+            return
+
+        self.stdout.write(self.style.SUCCESS('🚀 Webhook delivery starting'))
+        self.stdout.write(f'   Concurrency: {dispatcher.concurrency}')
+        self.stdout.write('   Press Ctrl+C to stop\n')
+
+        try:
+            while True:
+                close_old_connections()
+                totals = dispatcher.run_once()
+                if any(totals.values()):
+                    self._write_stats(totals)
+                else:
+                    time.sleep(options['interval'])
+        except KeyboardInterrupt:
+            self.stdout.write(self.style.WARNING('\n🛑 Webhook delivery stopped by user'))
+
+    def _write_stats(self, totals):
+        self.stdout.write(
+            f"Delivered: {totals['delivered']}, retrying: {totals['retrying']}, failed: {totals['failed']}"
+        )
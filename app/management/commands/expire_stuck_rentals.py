@@ -4,8 +4,11 @@ even though they've expired on MTelSMS
 """
 from django.core.management.base import BaseCommand
 from django.db import transaction
-from app.models import Rental, Transaction
+from app.models import Rental
 from app.mtelsms import get_mtelsms_client, MTelSMSException
+from app.refunds import queue_rental_refund, apply_refunds
+from app.webhooks import emit_order_event
+from app.leases import exclusive_command, stop_if_lost
 import logging
 
 logger = logging.getLogger(__name__)
@@ -21,6 +24,7 @@ class Command(BaseCommand):
             help='Maximum number of rentals to check'
         )
 
+    @exclusive_command()
     def handle(self, *args, **options):
         limit = options['limit']
         
@@ -34,6 +38,8 @@ class Command(BaseCommand):
         error_count = 0
         
         for rental in waiting_rentals:
+            if stop_if_lost(self):
+                break
             try:
                 # Try to get code/status from MTelSMS
                 status, code, phone_number, time_remaining = client.get_code(
@@ -45,6 +51,8 @@ class Command(BaseCommand):
                     self.stdout.write(f'Expiring rental {rental.rental_id} - time_remaining: {time_remaining}')
                     self._expire_rental(rental)
                     expired_count += 1
+                else:
+                    rental.record_time_remaining(time_remaining)
                     
             except MTelSMSException as e:
                 error_msg = str(e)
@@ -58,12 +66,13 @@ class Command(BaseCommand):
                     self.stdout.write(self.style.WARNING(f'Error checking {rental.rental_id}: {error_msg}'))
                     error_count += 1
         
+        # Credit the queued refunds in one batch
+        apply_refunds()
+        
         self.stdout.write(self.style.SUCCESS(f'Expired {expired_count} rentals, {error_count} errors'))
     
     def _expire_rental(self, rental):
-        """Expire a rental and issue refund"""
-        from app.models import UserProfile
-        
+        """Expire a rental and queue its refund"""
         with transaction.atomic():
             # Reload rental with lock to prevent race conditions
             rental = Rental.objects.select_for_update().get(rental_id=rental.rental_id)
@@ -76,17 +85,7 @@ class Command(BaseCommand):
             rental.status = 'EXPIRED'
             rental.refunded = True
             rental.save()
+            emit_order_event('order_expired', rental)
+            queue_rental_refund(rental, f'Auto-refund: Expired rental - {rental.phone_number}')
             
-            # Issue refund with locked profile
-            profile = UserProfile.objects.select_for_update().get(user=rental.user)
-            profile.balance += rental.price
-            profile.save()
-            
-            Transaction.objects.create(
-                user=rental.user,
-                amount=rental.price,
-                transaction_type='REFUND',
-                description=f'Auto-refund: Expired rental - {rental.phone_number}'
-            )
-            
-            self.stdout.write(f'  Refunded ₦{rental.price} to {rental.user.username}')
+            self.stdout.write(f'  Refunding ₦{rental.price} to {rental.user.username}')
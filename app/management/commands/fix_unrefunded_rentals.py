@@ -2,7 +2,9 @@ from django.core.management.base import BaseCommand
 from django.utils import timezone
 from datetime import timedelta
 from django.db import transaction
-from app.models import Rental, UserProfile, Transaction
+from app.models import Rental
+from app.refunds import queue_rental_refund, apply_refunds
+from app.leases import exclusive_command, stop_if_lost
 import logging
 
 logger = logging.getLogger(__name__)
@@ -23,6 +25,7 @@ class Command(BaseCommand):
             help='Maximum age of rentals to check (default: 72 hours)',
         )
 
+    @exclusive_command()
     def handle(self, *args, **options):
         dry_run = options['dry_run']
         max_age_hours = options['max_age_hours']
@@ -51,6 +54,8 @@ class Command(BaseCommand):
         self.stdout.write(f'Processing {unrefunded_rentals.count()} unrefunded rentals...')
         
         for rental in unrefunded_rentals:
+            if stop_if_lost(self):
+                break
             try:
                 success = self.process_unrefunded_rental(rental)
                 if success:
@@ -65,6 +70,9 @@ class Command(BaseCommand):
                     )
                 )
         
+        # Credit the queued refunds in one batch
+        apply_refunds()
+        
         self.stdout.write(
             self.style.SUCCESS(
                 f'Fix completed: {refunded_count} refunded, {error_count} errors'
@@ -88,20 +96,13 @@ class Command(BaseCommand):
             # Calculate refund amount
             refund_amount_naira = rental.get_naira_price()
             
-            # Create refund transaction
-            Transaction.objects.create(
-                user=rental.user,
-                amount=refund_amount_naira,
-                transaction_type='REFUND',
-                description=f"Auto-refund for {rental.status.lower()} rental {rental.phone_number} (Fix unrefunded)",
-                rental=rental
+            # Queue the refund (credited in one batch at the end of the run)
+            queue_rental_refund(
+                rental,
+                f"Auto-refund for {rental.status.lower()} rental {rental.phone_number} (Fix unrefunded)",
+                amount=refund_amount_naira
             )
             
-            # Update user balance
-            profile = UserProfile.objects.select_for_update().get(user=rental.user)
-            profile.balance += refund_amount_naira
-            profile.save()
-            
             self.stdout.write(
                 self.style.SUCCESS(
                     f'FIXED: {rental.user.username}: {rental.service.name} ({rental.phone_number}) - Status: {rental.status} - Refunded ₦{refund_amount_naira}'
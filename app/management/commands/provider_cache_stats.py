@@ -0,0 +1,29 @@
+"""
+Management command to show hit/miss metrics for the shared provider cache
+"""
+from django.core.management.base import BaseCommand
+
+from app.provider_cache import provider_cache, METRIC_NAMES
+
+
+class Command(BaseCommand):
+    help = 'Show shared provider cache (5sim/MTelSMS responses) hit/miss metrics'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--reset',
+            action='store_true',
+            help='Reset the counters after showing them'
+        )
+
+    def handle(self, *args, **options):
+        shared = provider_cache.get_metrics()['shared']
+
+        self.stdout.write(f'Provider cache ({provider_cache.alias}) - all processes:')
+        for name in METRIC_NAMES:
+            self.stdout.write(f'   {name}: {shared[name]}')
+        self.stdout.write(f"   hit_ratio: {shared['hit_ratio']:.1%}")
+
+        if options['reset']:
+            provider_cache.reset_metrics()
+            self.stdout.write(self.style.SUCCESS('Counters reset'))
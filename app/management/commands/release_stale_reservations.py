@@ -0,0 +1,65 @@
+"""
+Management command to return funds held by purchases that never completed
+(e.g. the web worker crashed between reserving funds and creating the order)
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from app.purchase_pipeline import recover_stale_reservations
+from app.mtelsms import get_mtelsms_client
+from app.fivesim import FiveSimAPI
+from app.leases import exclusive_command
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Release purchase reservations left HELD and cancel their provider orders'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--minutes',
+            type=int,
+            default=10,
+            help='Release reservations HELD for at least this many minutes (default: 10)'
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Show how many reservations would be released without releasing them'
+        )
+
+    @exclusive_command()
+    def handle(self, *args, **options):
+        minutes = options['minutes']
+        dry_run = options['dry_run']
+
+        stats = recover_stale_reservations(
+            older_than=timedelta(minutes=minutes),
+            cancel_provider_order=self._cancel_provider_order,
+            dry_run=dry_run
+        )
+
+        if dry_run:
+            self.stdout.write(f"[DRY RUN] Found {stats['found']} stale reservations older than {minutes} minutes")
+            return
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Released {stats['released']}/{stats['found']} stale reservations "
+            f"({stats['provider_cancelled']} provider orders cancelled, {stats['errors']} errors)"
+        ))
+
+    def _cancel_provider_order(self, provider, provider_order_id):
+        """Cancel the upstream order of a stale reservation"""
+        try:
+            if provider == 'MTELSMS':
+                return get_mtelsms_client().cancel_rental(provider_order_id)
+            if provider == 'FIVESIM':
+                FiveSimAPI(getattr(settings, 'FIVESIM_API_KEY', None)).cancel_order(int(provider_order_id))
+                return True
+        except Exception as e:
+            logger.error(f"Failed to cancel {provider} order {provider_order_id}: {str(e)}")
+        return False
@@ -0,0 +1,48 @@
+"""
+Add newly finished 5sim orders to the operator success-rate and SMS latency
+stats (app/operator_stats.py). Only orders not counted yet are read, so this
+is cheap to run every few minutes.
+"""
+from django.core.management.base import BaseCommand
+
+from app.leases import exclusive_command
+from app.models import FiveSimOrder, OperatorStats
+from app.operator_stats import FINAL_STATUSES, rollup, reset_stats
+
+
+class Command(BaseCommand):
+    help = 'Roll newly finished 5sim orders into the per-operator success and SMS latency stats'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=500,
+            help='Orders added per transaction (default: 500)',
+        )
+        parser.add_argument(
+            '--rebuild',
+            action='store_true',
+            help='Drop the stats and recount every finished order',
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Show how many orders are waiting to be counted without counting them',
+        )
+
+    @exclusive_command()
+    def handle(self, *args, **options):
+        if options['dry_run']:
+            pending = FiveSimOrder.objects.filter(status__in=FINAL_STATUSES, stats_recorded=False).count()
+            self.stdout.write(f'[DRY RUN] {pending} finished orders not counted yet')
+            return
+
+        if options['rebuild']:
+            reset_stats(lease=self.lease)
+            self.stdout.write('Stats dropped, recounting every finished order...')
+
+        added = rollup(batch_size=options['batch_size'], lease=self.lease)
+        self.stdout.write(self.style.SUCCESS(
+            f'Added {added} orders ({OperatorStats.objects.count()} country/operator/product rows)'
+        ))
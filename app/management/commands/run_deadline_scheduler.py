@@ -0,0 +1,85 @@
+"""
+Always-on deadline scheduler for MTelSMS rentals and 5sim orders
+Fires the 5-minute auto-cancel and expiry refunds when each order is due.
+Replaces the scan-every-N-minutes jobs (auto_cancel_rentals_daemon,
+auto_refund_daemon and the cron commands they run), which remain
+available for manual one-off runs.
+
+Run as an always-on task. Extra instances (e.g. on other hosts) stand by
+and take over if the active one stops: only the holder of the
+run_deadline_scheduler lease fires deadlines.
+"""
+from django.core.management.base import BaseCommand
+
+from app.deadline_scheduler import DeadlineScheduler
+from app.leases import hold_lease, wait_for_lease
+
+LEASE_NAME = 'run_deadline_scheduler'
+
+
+class Command(BaseCommand):
+    help = 'Cancel and refund rentals/5sim orders exactly when their deadlines pass'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--discover-interval',
+            type=float,
+            default=None,
+            help='Seconds between checks for new orders (default: DEADLINE_DISCOVER_INTERVAL or 2)',
+        )
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Load deadlines, fire the ones already due and exit',
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Check providers but do not change any orders or balances',
+        )
+
+    def handle(self, *args, **options):
+        scheduler = DeadlineScheduler(dry_run=options['dry_run'],
+                                      discover_interval=options['discover_interval'])
+
+        if options['dry_run']:
+            self.stdout.write(self.style.WARNING('DRY RUN MODE - No changes will be made'))
+
+        if options['once']:
+            if options['dry_run']:
+                scheduler.load()
+                scheduler.run_due()
+            else:
+                with hold_lease(LEASE_NAME) as lease:
+                    if lease is None:
+                        self.stdout.write(self.style.WARNING(
+                            f'Another instance holds the {LEASE_NAME} lease - skipping this run'
+                        ))
+                        return
+                    scheduler.lease = lease
+                    scheduler.load()
+                    scheduler.run_due()
+            self._write_stats(scheduler)
+            return
+
+        self.stdout.write(self.style.SUCCESS('🚀 Deadline scheduler starting'))
+        self.stdout.write('   Press Ctrl+C to stop\n')
+
+        try:
+            if options['dry_run']:
+                scheduler.run_forever()
+            while True:
+                # Stand by until this instance holds the lease; fire deadlines until it is lost
+                with wait_for_lease(LEASE_NAME) as lease:
+                    scheduler.run_forever(lease=lease)
+                self.stdout.write(self.style.WARNING(f'Lost the {LEASE_NAME} lease - standing by'))
+        except KeyboardInterrupt:
+            self.stdout.write(self.style.WARNING('\n🛑 Deadline scheduler stopped by user'))
+            self._write_stats(scheduler)
+
+    def _write_stats(self, scheduler):
+        stats = scheduler.stats
+        self.stdout.write(
+            f"Loaded: {stats['loaded']}, fired: {stats['fired']}, acted: {stats['acted']}, "
+            f"retried: {stats['retried']}, errors: {stats['errors']}, pending: {len(scheduler.scheduled)}"
+        )
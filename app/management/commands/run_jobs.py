@@ -0,0 +1,70 @@
+"""
+Always-on scheduler for the periodic maintenance jobs
+Runs in one process what auto_sync_daemon.py, auto_refund_daemon,
+auto_cancel_rentals_daemon and check_expired_rentals.bat used to run
+separately (see app/job_scheduler.py). Those remain available for manual
+one-off runs.
+
+Run as an always-on task
+"""
+from django.core.management.base import BaseCommand
+
+from app.job_scheduler import JobScheduler, register_default_jobs, get_published_status
+
+
+class Command(BaseCommand):
+    help = 'Run the periodic sync, cancel and refund jobs from one scheduler'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=None,
+            help='Jobs run in parallel (default: JOB_SCHEDULER_MAX_WORKERS or 4)',
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Run the cancel/refund jobs in dry-run mode',
+        )
+        parser.add_argument(
+            '--status',
+            action='store_true',
+            help='Show the last run of each job (from the running scheduler) and exit',
+        )
+
+    def handle(self, *args, **options):
+        if options['status']:
+            self._write_status(get_published_status())
+            return
+
+        scheduler = JobScheduler(max_workers=options['workers'])
+        register_default_jobs(scheduler, dry_run=options['dry_run'])
+
+        self.stdout.write(self.style.SUCCESS('🚀 Job scheduler starting'))
+        if options['dry_run']:
+            self.stdout.write(self.style.WARNING('   DRY RUN MODE - No changes will be made'))
+        for job in scheduler.jobs.values():
+            self.stdout.write(f'   {job.name}: every {job.interval:g}s')
+        self.stdout.write('   Press Ctrl+C to stop\n')
+
+        try:
+            scheduler.run_forever()
+        except KeyboardInterrupt:
+            self.stdout.write(self.style.WARNING('\n🛑 Job scheduler stopped by user'))
+            scheduler.shutdown(wait=False)
+            self._write_status({'jobs': scheduler.status()})
+
+    def _write_status(self, status):
+        if not status:
+            self.stdout.write('No job status published yet')
+            return
+        for job in status['jobs']:
+            state = 'running' if job['running'] else (job['last_outcome'] or 'not run')
+            duration = f"{job['last_duration']}s" if job['last_duration'] is not None else '-'
+            self.stdout.write(
+                f"{job['name']:<22} {state:<8} last: {job['last_started'] or '-'} ({duration}) "
+                f"runs: {job['runs']} failures: {job['failures']} missed: {job['missed']}"
+            )
+            if job['last_error']:
+                self.stdout.write(self.style.ERROR(f"    {job['last_error']}"))
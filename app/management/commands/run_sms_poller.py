@@ -0,0 +1,88 @@
+"""
+Always-on poller for Dashboard-2 (MTelSMS) rentals
+Replaces per-browser polling: this is the only process that calls
+MTelSMS getCode. Views answer check_sms from the database.
+
+Run as an always-on task. Extra instances (e.g. on other hosts) stand by
+and take over if the active one stops: only the holder of the
+run_sms_poller lease polls.
+"""
+from django.core.management.base import BaseCommand
+
+from app.leases import hold_lease, wait_for_lease
+from app.sms_poller import SMSPoller
+
+LEASE_NAME = 'run_sms_poller'
+
+
+class Command(BaseCommand):
+    help = 'Poll MTelSMS for all WAITING rentals and store received SMS codes'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=None,
+            help='Number of concurrent MTelSMS requests (default: SMS_POLLER_MAX_WORKERS or 8)',
+        )
+        parser.add_argument(
+            '--tick',
+            type=float,
+            default=1.0,
+            help='Seconds between scheduling passes (default: 1.0)',
+        )
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Poll every due rental once and exit',
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Poll MTelSMS but do not change any rentals or balances',
+        )
+
+    def handle(self, *args, **options):
+        poller = SMSPoller(max_workers=options['workers'], dry_run=options['dry_run'])
+
+        if options['dry_run']:
+            self.stdout.write(self.style.WARNING('DRY RUN MODE - No changes will be made'))
+
+        if options['once']:
+            if options['dry_run']:
+                polled = poller.run_once()
+            else:
+                with hold_lease(LEASE_NAME) as lease:
+                    if lease is None:
+                        self.stdout.write(self.style.WARNING(
+                            f'Another instance holds the {LEASE_NAME} lease - skipping this run'
+                        ))
+                        return
+                    poller.lease = lease
+                    polled = poller.run_once()
+            self.stdout.write(self.style.SUCCESS(f'✓ Polled {polled} rentals'))
+            self._write_stats(poller)
+            return
+
+        self.stdout.write(self.style.SUCCESS('🚀 MTelSMS SMS poller starting'))
+        self.stdout.write(f'   Workers: {poller.max_workers}')
+        self.stdout.write('   Press Ctrl+C to stop\n')
+
+        try:
+            if options['dry_run']:
+                poller.run_forever(tick=options['tick'])
+            while True:
+                # Stand by until this instance holds the lease; poll until it is lost
+                with wait_for_lease(LEASE_NAME) as lease:
+                    poller.run_forever(tick=options['tick'], lease=lease)
+                self.stdout.write(self.style.WARNING(f'Lost the {LEASE_NAME} lease - standing by'))
+        except KeyboardInterrupt:
+            self.stdout.write(self.style.WARNING('\n🛑 SMS poller stopped by user'))
+            self._write_stats(poller)
+
+    def _write_stats(self, poller):
+        stats = poller.stats
+        self.stdout.write(
+            f"Polled: {stats['polled']}, received: {stats['received']}, "
+            f"expired: {stats['expired']}, cancelled: {stats['cancelled']}, errors: {stats['errors']}"
+        )
@@ -0,0 +1,73 @@
+"""
+Sweep 5sim orders in a single concurrent pass
+Combines sync_fivesim_order_statuses, auto_cancel_5min_fivesim and
+auto_refund_expired_fivesim: statuses are fetched concurrently once and the
+cancel/refund phases run over the same order data.
+"""
+from django.core.management.base import BaseCommand
+from django.conf import settings
+
+from app.fivesim_sweeper import FiveSimSweeper
+from app.leases import exclusive_command
+
+
+class Command(BaseCommand):
+    help = 'Sync, auto-cancel and refund 5sim orders in one concurrent sweep'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Show what would change without making changes',
+        )
+        parser.add_argument(
+            '--concurrency',
+            type=int,
+            default=None,
+            help='Maximum in-flight 5sim requests (default: FIVESIM_SWEEP_CONCURRENCY or 20)',
+        )
+        parser.add_argument(
+            '--rps',
+            type=float,
+            default=None,
+            help='Maximum 5sim requests started per second, 0 for no limit (default: FIVESIM_SWEEP_REQUESTS_PER_SECOND or 10)',
+        )
+        parser.add_argument(
+            '--max-age-hours',
+            type=int,
+            default=48,
+            help='Maximum age of active orders to sync (default: 48 hours)',
+        )
+
+    @exclusive_command()
+    def handle(self, *args, **options):
+        dry_run = options['dry_run']
+
+        if dry_run:
+            self.stdout.write(self.style.WARNING('DRY RUN MODE - No changes will be made'))
+
+        if not getattr(settings, 'FIVESIM_API_KEY', None):
+            self.stdout.write(self.style.ERROR('FIVESIM_API_KEY not configured'))
+            return
+
+        sweeper = FiveSimSweeper(
+            concurrency=options['concurrency'],
+            requests_per_second=options['rps'],
+            dry_run=dry_run,
+            sync_max_age_hours=options['max_age_hours'],
+        )
+        stats = sweeper.sweep(lease=self.lease)
+        self.write_summary(stats, dry_run)
+
+    def write_summary(self, stats, dry_run=False):
+        prefix = '[DRY RUN] ' if dry_run else ''
+        self.stdout.write('\n' + '='*50)
+        self.stdout.write(self.style.SUCCESS(f"{prefix}Checked {stats['checked']} active orders"))
+        self.stdout.write(self.style.SUCCESS(f"{prefix}Updated {stats['status_changed']} order statuses"))
+        self.stdout.write(self.style.SUCCESS(f"{prefix}Auto-cancelled {stats['cancelled']} orders"))
+        self.stdout.write(self.style.SUCCESS(f"{prefix}Refunded {stats['refunded']} expired orders"))
+        if stats['skipped']:
+            self.stdout.write(f"Skipped {stats['skipped']} orders (already refunded)")
+        if stats['errors']:
+            self.stdout.write(self.style.ERROR(f"Failed to sync {stats['errors']} orders"))
+        self.stdout.write('='*50)
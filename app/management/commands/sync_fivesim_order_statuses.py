@@ -1,6 +1,9 @@
 """
 Sync 5sim order statuses from the API
 This command checks active orders with 5sim and updates their statuses
+
+Large syncs can be split by order: --shards N --shard-index I syncs one
+shard, --parallel syncs every shard on worker processes (app/sharding.py).
 """
 from django.core.management.base import BaseCommand
 from django.utils import timezone
@@ -8,13 +11,17 @@ from datetime import timedelta
 from django.conf import settings
 import logging
 
-from app.models import FiveSimOrder, FiveSimSMS
+from app.models import FiveSimOrder
 from app.fivesim import FiveSimAPI
+from app.fivesim_sync import merge_order_result
+from app.leases import exclusive_command, stop_if_lost
+from app.sharding import add_shard_arguments, shard_options, shard_queryset, supervise
 
 logger = logging.getLogger(__name__)
 
 class Command(BaseCommand):
     help = 'Sync order statuses from 5sim API to keep database up-to-date'
+    shard_passthrough_options = ('dry_run', 'max_age_hours', 'verbosity')
 
     def add_arguments(self, parser):
         parser.add_argument(
@@ -28,10 +35,14 @@ class Command(BaseCommand):
             default=48,
             help='Maximum age of orders to sync (default: 48 hours)',
         )
+        add_shard_arguments(parser)
 
+    @exclusive_command()
     def handle(self, *args, **options):
         dry_run = options['dry_run']
         max_age_hours = options['max_age_hours']
+        shards, shard_index = shard_options(options)
+        self.counters = {}
         
         if dry_run:
             self.stdout.write(self.style.WARNING('DRY RUN MODE - No changes will be made'))
@@ -42,16 +53,20 @@ class Command(BaseCommand):
             self.stdout.write(self.style.ERROR('FIVESIM_API_KEY not configured'))
             return
         
+        if options['parallel']:
+            supervise(self, 'sync_fivesim_order_statuses', options, shards)
+            return
+        
         api_client = FiveSimAPI(api_key)
         
         # Get orders that might need status updates
         cutoff_time = timezone.now() - timedelta(hours=max_age_hours)
         
         # Only sync orders that are not in a final state
-        active_orders = FiveSimOrder.objects.filter(
+        active_orders = shard_queryset(FiveSimOrder.objects.filter(
             created_at__gte=cutoff_time,
             status__in=['PENDING', 'RECEIVED']  # Exclude FINISHED, CANCELED, TIMEOUT, EXPIRED, BANNED
-        ).order_by('-created_at')
+        ), shards, shard_index).prefetch_related('sms_messages').order_by('-created_at')
         
         total_orders = active_orders.count()
         
@@ -66,6 +81,8 @@ class Command(BaseCommand):
         error_count = 0
         
         for order in active_orders:
+            if stop_if_lost(self):
+                break
             try:
                 # Call 5sim API to get current status
                 result = api_client.check_order(order.order_id)
@@ -81,26 +98,8 @@ class Command(BaseCommand):
                         )
                         status_changed_count += 1
                 else:
-                    # Update order status
-                    order.status = new_status
-                    order.save()
-                    
-                    # Update SMS messages if present
-                    if result.get('sms'):
-                        # Clear existing SMS messages
-                        order.sms_messages.all().delete()
-                        
-                        # Create new SMS records
-                        for sms_data in result['sms']:
-                            from datetime import datetime
-                            sms_date = datetime.fromisoformat(sms_data['date'].replace('Z', '+00:00'))
-                            FiveSimSMS.objects.create(
-                                order=order,
-                                sender=sms_data.get('sender', ''),
-                                text=sms_data.get('text', ''),
-                                code=sms_data.get('code', ''),
-                                date=sms_date,
-                            )
+                    # Store new SMS; the order is only written if its status changed
+                    merge_order_result(order, result)
                     
                     if old_status != new_status:
                         self.stdout.write(
@@ -136,7 +135,14 @@ class Command(BaseCommand):
                     )
                     logger.error(f'Status sync error for order {order.id}: {error_msg}')
         
-        # Summary
+        self.counters = {'synced': synced_count, 'status_changed': status_changed_count, 'errors': error_count}
+        self.write_summary(self.counters, dry_run)
+    
+    def write_summary(self, counters, dry_run):
+        synced_count = counters.get('synced', 0)
+        status_changed_count = counters.get('status_changed', 0)
+        error_count = counters.get('errors', 0)
+        
         self.stdout.write('\n' + '='*50)
         if dry_run:
             self.stdout.write(
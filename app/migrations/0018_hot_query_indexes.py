@@ -0,0 +1,35 @@
+# Generated by Django 5.2.18 on 2026-10-18 04:10
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0017_apirequest_created_at_default'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='apiordermapping',
+            index=models.Index(fields=['api_key', '-created_at'], name='apiorder_key_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='fivesimorder',
+            index=models.Index(fields=['user', '-created_at'], name='fivesim_user_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='fivesimorder',
+            index=models.Index(fields=['status', 'created_at'], name='fivesim_status_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='rental',
+            index=models.Index(fields=['user', '-created_at'], name='rental_user_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='rental',
+            index=models.Index(condition=models.Q(('refunded', False), ('status', 'WAITING')), fields=['created_at'], name='rental_waiting_created_idx'),
+        ),
+    ]
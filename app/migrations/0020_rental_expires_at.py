@@ -0,0 +1,37 @@
+# Generated by Django 5.2.18 on 2026-10-18 04:20
+
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import F
+
+
+# MTelSMS activation lifetime (getNumber's default time_remaining)
+DEFAULT_VALIDITY = timedelta(seconds=1800)
+
+
+def backfill_expires_at(apps, schema_editor):
+    Rental = apps.get_model('app', 'Rental')
+    Rental.objects.filter(expires_at__isnull=True).update(expires_at=F('created_at') + DEFAULT_VALIDITY)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0019_webhookdelivery'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='rental',
+            name='expires_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.RunPython(backfill_expires_at, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='rental',
+            index=models.Index(condition=models.Q(('refunded', False), ('status', 'WAITING')), fields=['expires_at'], name='rental_waiting_expires_idx'),
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 5.2.18 on 2026-10-18 04:26
+
+import re
+
+from django.db import migrations, models
+
+
+# Pending Kora Pay deposits were identified by their description:
+# "Wallet funding via Kora Pay - ₦5,000.00 (Pending: YPG_12_20250101_120000_ab12cd)"
+PENDING_REFERENCE = re.compile(r'\(Pending: ([^)]+)\)')
+
+
+def backfill_payment_references(apps, schema_editor):
+    Transaction = apps.get_model('app', 'Transaction')
+    seen = set()
+    pending = Transaction.objects.filter(
+        transaction_type='DEPOSIT', description__contains='(Pending: '
+    ).order_by('id').only('id', 'description')
+    for row in pending.iterator():
+        match = PENDING_REFERENCE.search(row.description or '')
+        if not match or match.group(1) in seen:
+            continue
+        seen.add(match.group(1))
+        Transaction.objects.filter(pk=row.pk).update(payment_reference=match.group(1), status='PENDING')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0021_refundintent'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='transaction',
+            name='payment_reference',
+            field=models.CharField(blank=True, max_length=100, null=True, unique=True),
+        ),
+        migrations.AddField(
+            model_name='transaction',
+            name='status',
+            field=models.CharField(choices=[('PENDING', 'Pending payment'), ('COMPLETED', 'Completed')], default='COMPLETED', max_length=20),
+        ),
+        migrations.RunPython(backfill_payment_references, migrations.RunPython.noop),
+    ]
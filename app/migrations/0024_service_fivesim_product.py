@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 04:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0023_joblease'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='service',
+            name='fivesim_product',
+            field=models.CharField(blank=True, default='', help_text="5sim product sold as the same service (e.g. 'whatsapp'); lets purchases be routed to 5sim", max_length=100),
+        ),
+    ]
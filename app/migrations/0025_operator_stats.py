@@ -0,0 +1,54 @@
+# Generated by Django 5.2.18 on 2026-10-18 04:39
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0024_service_fivesim_product'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OperatorStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('country', models.CharField(max_length=100)),
+                ('operator', models.CharField(max_length=100)),
+                ('product', models.CharField(max_length=100)),
+                ('orders', models.PositiveIntegerField(default=0)),
+                ('received', models.PositiveIntegerField(default=0)),
+                ('canceled', models.PositiveIntegerField(default=0)),
+                ('timed_out', models.PositiveIntegerField(default=0)),
+                ('banned', models.PositiveIntegerField(default=0)),
+                ('sms_latency_buckets', models.JSONField(default=list)),
+                ('sms_latency_total', models.FloatField(default=0)),
+                ('success_rate', models.FloatField(default=0)),
+                ('cancel_rate', models.FloatField(default=0)),
+                ('sms_p50', models.FloatField(blank=True, null=True)),
+                ('sms_p90', models.FloatField(blank=True, null=True)),
+                ('sms_p95', models.FloatField(blank=True, null=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name': 'Operator Stats',
+                'verbose_name_plural': 'Operator Stats',
+            },
+        ),
+        migrations.AddField(
+            model_name='fivesimorder',
+            name='stats_recorded',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddIndex(
+            model_name='fivesimorder',
+            index=models.Index(condition=models.Q(('stats_recorded', False)), fields=['status'], name='fivesim_stats_pending_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='operatorstats',
+            unique_together={('country', 'operator', 'product')},
+        ),
+    ]
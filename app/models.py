@@ -37,6 +37,7 @@ class Service(models.Model):
     supports_multiple_sms = models.BooleanField(default=False)
     is_active = models.BooleanField(default=True)
     mtelsms_service_id = models.CharField(max_length=50, blank=True, null=True, help_text="MTelSMS service ID (numeric) for API calls")
+    fivesim_product = models.CharField(max_length=100, blank=True, default='', help_text="5sim product sold as the same service (e.g. 'whatsapp'); lets purchases be routed to 5sim")
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
@@ -85,21 +86,62 @@ class Rental(models.Model):
     carriers = models.CharField(max_length=255, blank=True, null=True)
     max_price = models.DecimalField(max_digits=12, decimal_places=2, blank=True, null=True)  # NGN
     refunded = models.BooleanField(default=False)  # Prevent double refunds
+    # Provider deadline: set from getNumber's time_remaining, refreshed from getCode
+    expires_at = models.DateTimeField(blank=True, null=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    # MTelSMS activation lifetime when the provider doesn't report one
+    DEFAULT_VALIDITY = timedelta(seconds=1800)
+
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            # Dashboard and rental history: a user's rentals, newest first
+            models.Index(fields=['user', '-created_at'], name='rental_user_created_idx'),
+            # Sweeps and poller: only the few rentals still WAITING and unrefunded
+            models.Index(
+                fields=['created_at'],
+                condition=models.Q(status='WAITING', refunded=False),
+                name='rental_waiting_created_idx'
+            ),
+            # Expiry sweeps: WAITING, unrefunded rentals past their deadline
+            models.Index(
+                fields=['expires_at'],
+                condition=models.Q(status='WAITING', refunded=False),
+                name='rental_waiting_expires_idx'
+            ),
+        ]
 
     def __str__(self):
         return f"{self.user.username} - {self.service.name} - {self.phone_number}"
 
     @property
     def is_expired(self):
-        """Check if rental has expired (handled by MTelSMS sync)"""
-        # Expiration is now handled by MTelSMS API
-        # This property returns True only if status is already EXPIRED
-        return self.status == 'EXPIRED'
+        """Check if rental has expired (status set, or WAITING past the provider deadline)"""
+        if self.status == 'EXPIRED':
+            return True
+        return self.status == 'WAITING' and self.expires_at is not None and self.expires_at <= timezone.now()
+
+    @property
+    def time_remaining(self):
+        """Seconds until the provider deadline, or None if it is unknown"""
+        if self.expires_at is None:
+            return None
+        return max(0, int((self.expires_at - timezone.now()).total_seconds()))
+
+    def record_time_remaining(self, seconds, tolerance=5):
+        """
+        Store the provider deadline from a getCode time_remaining
+
+        Only writes when the deadline moved by more than tolerance seconds,
+        so routine polls don't update the row.
+        """
+        expires_at = timezone.now() + timedelta(seconds=max(0, int(seconds)))
+        if self.expires_at is not None and abs((expires_at - self.expires_at).total_seconds()) <= tolerance:
+            return
+        Rental.objects.filter(pk=self.pk).update(expires_at=expires_at)
+        self.expires_at = expires_at
     
     def get_naira_price(self):
         """Get rental price in Naira (all prices are stored in NGN)"""
@@ -133,10 +175,21 @@ class Transaction(models.Model):
 
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     transaction_id = models.UUIDField(default=uuid.uuid4, unique=True)
+    # NGN. Signs differ by source: MTelSMS and reseller RENTAL payments are
+    # stored negative, 5sim RENTAL payments (and manual recoveries) as the
+    # positive price; deposits and refunds are positive.
     amount = models.DecimalField(max_digits=12, decimal_places=2)  # Now stores NGN amounts
+    STATUS_CHOICES = [
+        ('PENDING', 'Pending payment'),
+        ('COMPLETED', 'Completed'),
+    ]
+
     transaction_type = models.CharField(max_length=20, choices=TRANSACTION_TYPES)
     description = models.TextField(blank=True, null=True)
     rental = models.ForeignKey(Rental, on_delete=models.SET_NULL, blank=True, null=True)
+    # Kora Pay deposits: the tx_ref the webhook reports, PENDING until credited
+    payment_reference = models.CharField(max_length=100, unique=True, blank=True, null=True)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='COMPLETED')
     created_at = models.DateTimeField(auto_now_add=True)
 
     class Meta:
@@ -369,9 +422,25 @@ class FiveSimOrder(models.Model):
     voice_enabled = models.BooleanField(default=False)
     max_price = models.DecimalField(max_digits=12, decimal_places=2, blank=True, null=True)
     referral_key = models.CharField(max_length=100, blank=True, null=True)
+    
+    # Counted in OperatorStats (set once the order is final, see app.operator_stats)
+    stats_recorded = models.BooleanField(default=False)
 
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            # Dashboard 1 order list: a user's orders, newest first
+            models.Index(fields=['user', '-created_at'], name='fivesim_user_created_idx'),
+            # Sync/cancel/refund sweeps: orders by status and age (the sync
+            # sweep also reads refunded orders, so this one is not partial)
+            models.Index(fields=['status', 'created_at'], name='fivesim_status_created_idx'),
+            # Stats rollup: finished orders not counted yet
+            models.Index(
+                fields=['status'],
+                condition=models.Q(stats_recorded=False),
+                name='fivesim_stats_pending_idx',
+            ),
+        ]
 
     def __str__(self):
         return f"{self.user.username} - {self.product} - {self.phone_number} - {self.status}"
@@ -442,6 +511,127 @@ class FiveSimAPIKey(models.Model):
             return f"{self.api_key[:10]}...{self.api_key[-4:]}"
         return "***"
 
+class PurchaseReservation(models.Model):
+    """
+    Funds held from a user's balance while a provider purchase is in flight.
+    The balance is debited when the reservation is created and either kept
+    (CONFIRMED) or returned (RELEASED) once the provider call finishes.
+    """
+    PROVIDER_CHOICES = [
+        ('MTELSMS', 'MTelSMS'),
+        ('FIVESIM', '5sim'),
+    ]
+
+    STATUS_CHOICES = [
+        ('HELD', 'Held'),
+        ('CONFIRMED', 'Confirmed'),
+        ('RELEASED', 'Released'),
+    ]
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    provider = models.CharField(max_length=20, choices=PROVIDER_CHOICES)
+    amount = models.DecimalField(max_digits=12, decimal_places=2)  # NGN held from balance
+    description = models.TextField(blank=True)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='HELD', db_index=True)
+    provider_order_id = models.CharField(max_length=100, blank=True, null=True, help_text="Provider rental/order ID once the purchase succeeded")
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ['-created_at']
+
+    def __str__(self):
+        return f"{self.user.username} - {self.provider} - ₦{self.amount} - {self.status}"
+
+
+class RefundIntent(models.Model):
+    """
+    A refund owed to a user, recorded once per rental or 5sim order in the
+    same transaction that moves the order to its final status. Pending
+    intents are credited in batches by app.refunds.apply_refunds.
+    """
+    STATUS_CHOICES = [
+        ('PENDING', 'Pending'),
+        ('APPLIED', 'Applied'),
+    ]
+
+    key = models.CharField(max_length=100, unique=True, help_text="rental:<id> or fivesim:<order_id>")
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    amount = models.DecimalField(max_digits=12, decimal_places=2)  # NGN
+    description = models.TextField(blank=True)
+    rental = models.ForeignKey(Rental, on_delete=models.SET_NULL, blank=True, null=True)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='PENDING')
+    batch_id = models.UUIDField(blank=True, null=True, db_index=True)  # Set when a batch claims the intent
+    created_at = models.DateTimeField(auto_now_add=True)
+    applied_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['status', 'created_at'], name='refund_status_created_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.key} - {self.user.username} - ₦{self.amount} - {self.status}"
+
+
+class JobLease(models.Model):
+    """
+    Time-limited exclusive lease on a named job (see app.leases), so sweeps
+    can run on several hosts while only one of them acts at a time. token
+    increases on every acquisition and serves as the fencing token.
+    """
+    name = models.CharField(max_length=100, unique=True)
+    holder = models.CharField(max_length=200, blank=True)
+    token = models.BigIntegerField(default=0)
+    expires_at = models.DateTimeField(default=timezone.now)
+    acquired_at = models.DateTimeField(blank=True, null=True)
+    renewed_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        ordering = ['name']
+
+    def __str__(self):
+        return f"{self.name} - {self.holder or 'free'} (token {self.token})"
+
+
+class OperatorStats(models.Model):
+    """
+    Outcomes of finished 5sim orders per (country, operator, product), kept
+    up to date incrementally by app.operator_stats. Rows with operator 'any'
+    cover every operator of a country and product.
+
+    Time to first SMS is kept as a histogram (counts per
+    operator_stats.LATENCY_BUCKETS), so new orders can be added without
+    re-reading old ones; the rates and percentiles are recomputed from the
+    counts on every update.
+    """
+    country = models.CharField(max_length=100)
+    operator = models.CharField(max_length=100)
+    product = models.CharField(max_length=100)
+    
+    orders = models.PositiveIntegerField(default=0)
+    received = models.PositiveIntegerField(default=0)  # Got at least one SMS
+    canceled = models.PositiveIntegerField(default=0)
+    timed_out = models.PositiveIntegerField(default=0)  # TIMEOUT or EXPIRED without an SMS
+    banned = models.PositiveIntegerField(default=0)
+    sms_latency_buckets = models.JSONField(default=list)
+    sms_latency_total = models.FloatField(default=0)  # Seconds, for the mean
+    
+    success_rate = models.FloatField(default=0)  # received / orders
+    cancel_rate = models.FloatField(default=0)
+    sms_p50 = models.FloatField(blank=True, null=True)  # Seconds to first SMS
+    sms_p90 = models.FloatField(blank=True, null=True)
+    sms_p95 = models.FloatField(blank=True, null=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        unique_together = ['country', 'operator', 'product']
+        verbose_name = "Operator Stats"
+        verbose_name_plural = "Operator Stats"
+    
+    def __str__(self):
+        return f"{self.country}/{self.operator}/{self.product}: {self.success_rate:.0%} of {self.orders}"
 
 # Import Reseller API Models
 from .api_models import APIKey, APIRequest, APIWebhook, APIOrderMapping
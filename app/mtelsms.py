@@ -11,8 +11,15 @@ from typing import Dict, List, Optional, Tuple
 from django.conf import settings
 from django.utils import timezone
 
+from .http_transport import get_transport
+from .circuit_breaker import CircuitOpen
+from .provider_cache import provider_cache
+from .singleflight import provider_calls
+
 logger = logging.getLogger(__name__)
 
+SERVICES_CACHE_KEY = "mtelsms_all_services"
+
 class MTelSMSException(Exception):
     """Custom exception for MTelSMS API errors"""
     pass
@@ -24,10 +31,13 @@ class MTelSMSClient:
     
     BASE_URL = "https://mtelsms.com/stubs/handler_api.php"
     
+    # Actions without side effects, safe to retry on timeouts/5xx
+    IDEMPOTENT_ACTIONS = {'getBalance', 'getCode', 'allService', 'getPrice'}
+    
     def __init__(self, api_key: str):
         self.api_key = api_key
-        self.session = requests.Session()
-        self.session.headers.update({
+        # Pooled keep-alive connections shared by every client in the process
+        self.transport = get_transport('mtelsms', headers={
             'User-Agent': 'WDN-Virtual-SMS/2.0'
         })
     
@@ -49,7 +59,9 @@ class MTelSMSClient:
         start_time = time.time()
         
         try:
-            response = requests.get(self.BASE_URL, params=params, timeout=30)
+            response = self.transport.get(
+                self.BASE_URL, endpoint=action, idempotent=action in self.IDEMPOTENT_ACTIONS, params=params
+            )
             execution_time = time.time() - start_time
             
             # Log request details
@@ -87,6 +99,11 @@ class MTelSMSClient:
             
             logger.info(f"MTelSMS API call successful: {action}")
             return data
+        
+        except CircuitOpen as e:
+            # MTelSMS has been failing - not called at all
+            logger.warning(f"MTelSMS API call skipped: {action} - {str(e)}")
+            raise MTelSMSException("SMS service is currently unavailable. Please try again in a few minutes.")
             
         except requests.RequestException as e:
             execution_time = time.time() - start_time
@@ -177,7 +194,12 @@ class MTelSMSClient:
             Tuple[status, code, phone_number, time_remaining]
             status: 'WAITING' or 'RECEIVED'
             code: SMS code or None if waiting
+        
+        Concurrent checks of the same rental share one upstream call.
         """
+        return provider_calls.do(('mtelsms', 'getCode', str(rental_id)), lambda: self._get_code(rental_id))
+    
+    def _get_code(self, rental_id: str) -> Tuple[str, Optional[str], str, int]:
         params = {'id': rental_id}
         response = self._make_request('getCode', params)
         
@@ -212,13 +234,27 @@ class MTelSMSClient:
         
         return False
     
-    def get_all_services(self) -> List[Dict]:
+    def get_all_services(self, use_cache: bool = True) -> List[Dict]:
         """
         Get all available services with pricing
         
+        Args:
+            use_cache: Serve from the shared provider cache (fresh for 5 minutes).
+                With False the list is always fetched, and the cache is updated.
+        
         Returns:
             List of service dictionaries with id, name, price, wholesale_price, validity_time
         """
+        if use_cache:
+            return provider_cache.get_or_fetch(
+                SERVICES_CACHE_KEY, self._fetch_all_services, ttl=300, stale_ttl=300
+            )
+        
+        services = self._fetch_all_services()
+        provider_cache.set(SERVICES_CACHE_KEY, services, ttl=300, stale_ttl=300)
+        return services
+    
+    def _fetch_all_services(self) -> List[Dict]:
         response = self._make_request('allService')
         
         if response.get('status') == 'success':
@@ -279,7 +315,7 @@ class MTelSMSClient:
             from .models import Service
             from decimal import Decimal
             
-            services_data = self.get_all_services()
+            services_data = self.get_all_services(use_cache=False)
             updated_count = 0
             
             for service_data in services_data:
@@ -0,0 +1,300 @@
+"""
+Operator Statistics
+How 5sim operators actually perform for our users, per (country, operator,
+product): the share of orders that received an SMS, the cancel rate and
+the time to the first SMS (p50/p90/p95). 5sim's own 'rate' and the static
+SMSOperator.success_rate say nothing about our orders.
+
+- rollup() is incremental: it only reads orders that reached a final status
+  since the last run (FiveSimOrder.stats_recorded is False), folds them into
+  the OperatorStats rows and marks them recorded in the same transaction
+- Time to first SMS is kept as a histogram over LATENCY_BUCKETS, so a batch
+  is merged into a row without reading the orders already counted
+- Each batch also updates the (country, 'any', product) row, which is what
+  a purchase for operator 'any' is judged by
+- Readers (purchase routing, the price endpoints) use get_operator_stats(),
+  a dict lookup on an in-process index that is rebuilt only after a rollup
+  bumped the version key in the 'shared' cache
+
+Run by `manage.py rollup_operator_stats` (also a run_jobs job).
+
+Settings (all optional):
+    OPERATOR_STATS_INTERVAL     seconds between rollups in run_jobs (default 300)
+    OPERATOR_STATS_MIN_ORDERS   orders before a row is used for routing (default 20)
+"""
+
+import logging
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Min
+from django.utils import timezone
+
+from .models import FiveSimOrder, FiveSimSMS, OperatorStats
+from .provider_cache import provider_cache
+
+logger = logging.getLogger(__name__)
+
+# Statuses after which an order's outcome no longer changes
+FINAL_STATUSES = ('FINISHED', 'CANCELED', 'TIMEOUT', 'BANNED', 'EXPIRED')
+
+# Upper bounds (seconds) of the time-to-first-SMS buckets; one more bucket
+# holds everything slower
+LATENCY_BUCKETS = [5, 10, 15, 20, 30, 45, 60, 90, 120, 180, 240, 300, 450, 600, 900, 1200]
+
+VERSION_CACHE_KEY = 'operator_stats_version'
+# How often readers re-read the version key
+VERSION_CHECK_INTERVAL = 5.0
+
+ANY_OPERATOR = 'any'
+
+StatsKey = Tuple[str, str, str]  # (country, operator, product)
+
+
+def _bucket(seconds: float) -> int:
+    return bisect_left(LATENCY_BUCKETS, seconds)
+
+
+def percentile(buckets: List[int], fraction: float) -> Optional[float]:
+    """
+    Estimate a percentile (fraction 0-1) of a latency histogram, interpolating
+    within the bucket it falls in; values past the last bound report that bound
+    """
+    total = sum(buckets)
+    if not total:
+        return None
+    target = fraction * total
+    seen = 0
+    for index, count in enumerate(buckets):
+        if count and seen + count >= target:
+            if index >= len(LATENCY_BUCKETS):
+                return float(LATENCY_BUCKETS[-1])
+            lower = LATENCY_BUCKETS[index - 1] if index else 0
+            upper = LATENCY_BUCKETS[index]
+            return round(lower + (upper - lower) * (target - seen) / count, 1)
+        seen += count
+    return float(LATENCY_BUCKETS[-1])
+
+
+class _Delta:
+    """Counts from one batch of orders for one stats row"""
+
+    def __init__(self):
+        self.counts = Counter()
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.latency_total = 0.0
+
+    def add(self, status: str, latency: Optional[float]):
+        self.counts['orders'] += 1
+        if latency is not None:
+            self.counts['received'] += 1
+            self.buckets[_bucket(latency)] += 1
+            self.latency_total += latency
+        if status == 'CANCELED':
+            self.counts['canceled'] += 1
+        elif status == 'BANNED':
+            self.counts['banned'] += 1
+        elif status in ('TIMEOUT', 'EXPIRED') and latency is None:
+            self.counts['timed_out'] += 1
+
+    def apply(self, row: OperatorStats):
+        for field in ('orders', 'received', 'canceled', 'timed_out', 'banned'):
+            setattr(row, field, getattr(row, field) + self.counts[field])
+        buckets = list(row.sms_latency_buckets or [])
+        buckets += [0] * (len(self.buckets) - len(buckets))
+        row.sms_latency_buckets = [old + new for old, new in zip(buckets, self.buckets)]
+        row.sms_latency_total += self.latency_total
+
+        row.success_rate = row.received / row.orders if row.orders else 0
+        row.cancel_rate = row.canceled / row.orders if row.orders else 0
+        row.sms_p50 = percentile(row.sms_latency_buckets, 0.50)
+        row.sms_p90 = percentile(row.sms_latency_buckets, 0.90)
+        row.sms_p95 = percentile(row.sms_latency_buckets, 0.95)
+        row.updated_at = timezone.now()  # bulk_update() skips auto_now
+
+
+def _first_sms(order_ids: List[int]) -> Dict[int, object]:
+    """order id -> time of its first SMS, for the orders that got one"""
+    return dict(
+        FiveSimSMS.objects.filter(order_id__in=order_ids)
+        .values('order_id')
+        .annotate(first=Min('date'))
+        .values_list('order_id', 'first')
+    )
+
+
+def _rollup_batch(batch_size: int, lease=None) -> int:
+    """Fold one batch of newly finished orders into the stats; returns its size"""
+    with transaction.atomic():
+        orders = list(
+            FiveSimOrder.objects.filter(status__in=FINAL_STATUSES, stats_recorded=False)
+            .order_by('id')
+            .values('id', 'country', 'operator', 'product', 'status', 'created_at')[:batch_size]
+        )
+        if not orders:
+            return 0
+        ids = [order['id'] for order in orders]
+        first_sms = _first_sms(ids)
+
+        deltas: Dict[StatsKey, _Delta] = {}
+        for order in orders:
+            latency = None
+            if order['id'] in first_sms:
+                latency = max(0.0, (first_sms[order['id']] - order['created_at']).total_seconds())
+            country, product = order['country'] or '', order['product'] or ''
+            for operator in {order['operator'] or ANY_OPERATOR, ANY_OPERATOR}:
+                deltas.setdefault((country, operator, product), _Delta()).add(order['status'], latency)
+
+        existing = {
+            (row.country, row.operator, row.product): row
+            for row in OperatorStats.objects.select_for_update().filter(
+                country__in={key[0] for key in deltas},
+                product__in={key[2] for key in deltas},
+            )
+        }
+        new_rows = []
+        for key, delta in deltas.items():
+            row = existing.get(key)
+            if row is None:
+                row = OperatorStats(country=key[0], operator=key[1], product=key[2])
+                new_rows.append(row)
+            delta.apply(row)
+
+        if lease is not None:
+            lease.assert_held()
+        updated = [row for key, row in existing.items() if key in deltas]
+        if updated:
+            OperatorStats.objects.bulk_update(updated, [
+                'orders', 'received', 'canceled', 'timed_out', 'banned',
+                'sms_latency_buckets', 'sms_latency_total',
+                'success_rate', 'cancel_rate', 'sms_p50', 'sms_p90', 'sms_p95', 'updated_at',
+            ])
+        if new_rows:
+            OperatorStats.objects.bulk_create(new_rows)
+        FiveSimOrder.objects.filter(id__in=ids).update(stats_recorded=True)
+    return len(orders)
+
+
+def rollup(batch_size: int = 500, lease=None) -> int:
+    """
+    Add every order that became final since the last rollup to the stats
+
+    Only one rollup may run at a time (the command holds a lease); pass the
+    lease to fence each batch's writes with it and stop once it is lost.
+
+    Returns:
+        Number of orders added
+    """
+    total = 0
+    while lease is None or not lease.lost:
+        added = _rollup_batch(batch_size, lease)
+        total += added
+        if added < batch_size:
+            break
+    if total:
+        bump_stats_version()
+        logger.info(f"Operator stats: added {total} finished 5sim orders")
+    return total
+
+
+def reset_stats(lease=None):
+    """Drop the stats and mark every order unrecorded, so the next rollup rebuilds them"""
+    with transaction.atomic():
+        if lease is not None:
+            lease.assert_held()
+        OperatorStats.objects.all().delete()
+        FiveSimOrder.objects.filter(stats_recorded=True).update(stats_recorded=False)
+    bump_stats_version()
+
+
+def bump_stats_version():
+    """Tell readers in every process to rebuild their index"""
+    try:
+        provider_cache.cache.set(VERSION_CACHE_KEY, time.time(), None)
+    except Exception as e:
+        logger.debug(f"Could not bump operator stats version: {str(e)}")
+
+
+class _StatsIndex:
+    """In-process copy of OperatorStats keyed by (country, operator, product)"""
+
+    def __init__(self):
+        self.rows: Dict[StatsKey, Dict] = {}
+        self.version = None
+        self.loaded = False
+        self.checked = 0.0
+        self.lock = threading.Lock()
+
+    def get(self, key: StatsKey) -> Optional[Dict]:
+        self._refresh()
+        return self.rows.get(key)
+
+    def _refresh(self):
+        now = time.monotonic()
+        if self.loaded and now - self.checked < VERSION_CHECK_INTERVAL:
+            return
+        with self.lock:
+            if self.loaded and now - self.checked < VERSION_CHECK_INTERVAL:
+                return
+            self.checked = now
+            try:
+                version = provider_cache.cache.get(VERSION_CACHE_KEY)
+            except Exception:
+                version = self.version
+            if self.loaded and version == self.version:
+                return
+            try:
+                rows = OperatorStats.objects.values(
+                    'country', 'operator', 'product', 'orders', 'success_rate', 'cancel_rate',
+                    'sms_p50', 'sms_p90', 'sms_p95',
+                )
+                self.rows = {(row['country'], row['operator'], row['product']): row for row in rows}
+            except Exception as e:
+                logger.warning(f"Could not load operator stats: {str(e)}")
+                return
+            self.version = version
+            self.loaded = True
+
+
+_index = _StatsIndex()
+
+
+def get_operator_stats(country: str, operator: str, product: str) -> Optional[Dict]:
+    """
+    Stats for a country/operator/product (operator 'any' for all operators),
+    or None if no order for it has finished yet
+
+    Returns:
+        {'orders', 'success_rate', 'cancel_rate', 'sms_p50', 'sms_p90', 'sms_p95'}
+        (rates 0-1, latencies in seconds)
+    """
+    return _index.get((country, operator or ANY_OPERATOR, product))
+
+
+def delivery_rate(country: str, operator: str, product: str) -> Optional[float]:
+    """Share of orders that received an SMS, once enough orders back it up (else None)"""
+    stats = get_operator_stats(country, operator, product)
+    if stats is None or stats['orders'] < getattr(settings, 'OPERATOR_STATS_MIN_ORDERS', 20):
+        return None
+    return stats['success_rate']
+
+
+def public_stats(country: str, operators: Iterable[str], product: str) -> Dict[str, Dict]:
+    """Per-operator stats for the price endpoints (operators with none are left out)"""
+    result = {}
+    for operator in operators:
+        stats = get_operator_stats(country, operator, product)
+        if stats is not None:
+            result[operator] = {
+                'orders': stats['orders'],
+                'success_rate': round(stats['success_rate'], 3),
+                'cancel_rate': round(stats['cancel_rate'], 3),
+                'sms_p50': stats['sms_p50'],
+                'sms_p90': stats['sms_p90'],
+            }
+    return result
@@ -0,0 +1,169 @@
+"""
+5sim Pricing Index
+Lookup tables built once from the /guest/prices tree so price and catalogue
+views don't re-walk the full country → product → operator dict per request.
+
+The index is rebuilt only when FiveSimAPI.get_all_prices() fetches new data
+from 5sim (it bumps PRICES_VERSION_CACHE_KEY), so all workers follow the same
+price refresh.
+"""
+
+import logging
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+from .provider_cache import provider_cache
+
+logger = logging.getLogger(__name__)
+
+PRICES_CACHE_KEY = "5sim_all_prices"
+PRICES_VERSION_CACHE_KEY = "5sim_all_prices_version"
+
+
+def bump_prices_version():
+    """Mark the cached price tree as refreshed so indexes are rebuilt"""
+    provider_cache.cache.set(PRICES_VERSION_CACHE_KEY, time.time(), None)
+
+
+def _operator_row(name: str, data: Dict) -> Dict:
+    return {
+        'name': name,
+        'cost': data.get('cost', 0),
+        'count': data.get('count', 0),
+        'rate': data.get('rate', 0),
+    }
+
+
+class PricingIndex:
+    """
+    Precomputed maps over a 5sim price tree
+
+    Operator rows ({'name', 'cost', 'count', 'rate'}) are shared between the
+    per-country and per-product maps and keep 5sim's original order.
+    """
+
+    def __init__(self, prices: Dict):
+        self.prices = prices
+
+        # country -> product -> [operator rows]
+        self.by_country: Dict[str, Dict[str, List[Dict]]] = {}
+        # product -> country -> [operator rows]
+        self.by_product: Dict[str, Dict[str, List[Dict]]] = {}
+        # operator -> [(country, product, row)]
+        self.by_operator: Dict[str, List[Tuple[str, str, Dict]]] = {}
+
+        # (country, product) -> operator rows sorted by cost
+        self.sorted_prices: Dict[Tuple[str, str], List[Dict]] = {}
+        # (country, product) -> cheapest operator row with numbers in stock
+        self.cheapest: Dict[Tuple[str, str], Dict] = {}
+
+        country_operators: Dict[str, set] = {}
+
+        for country, country_data in prices.items():
+            if not isinstance(country_data, dict):
+                continue
+            products = self.by_country.setdefault(country, {})
+            operators = country_operators.setdefault(country, set())
+
+            for product, product_data in country_data.items():
+                rows = []
+                if isinstance(product_data, dict):
+                    for operator, operator_data in product_data.items():
+                        if not isinstance(operator_data, dict):
+                            continue
+                        row = _operator_row(operator, operator_data)
+                        rows.append(row)
+                        operators.add(operator)
+                        self.by_operator.setdefault(operator, []).append((country, product, row))
+
+                products[product] = rows
+                self.by_product.setdefault(product, {})[country] = rows
+
+                by_cost = sorted(rows, key=lambda r: r['cost'])
+                self.sorted_prices[(country, product)] = by_cost
+                in_stock = [row for row in by_cost if row['count'] > 0]
+                if in_stock:
+                    self.cheapest[(country, product)] = in_stock[0]
+
+        self.countries: List[str] = list(self.by_country.keys())
+        self.products: List[str] = sorted(self.by_product.keys())
+        self.operators: List[str] = sorted(self.by_operator.keys())
+        self.operators_by_country: Dict[str, List[str]] = {
+            country: sorted(operators) for country, operators in country_operators.items()
+        }
+
+        self._countries_payload = None
+
+    def operators_for(self, country: Optional[str] = None, product: Optional[str] = None) -> List[str]:
+        """Operator names, optionally limited to a country and/or product"""
+        if country and product:
+            return [row['name'] for row in self.by_country.get(country, {}).get(product, [])]
+        if country:
+            return self.operators_by_country.get(country, [])
+        if product:
+            return sorted({row['name'] for rows in self.by_product.get(product, {}).values() for row in rows})
+        return self.operators
+
+    def countries_payload(self) -> List[Dict]:
+        """Nested country/product/operator list used by the all-prices endpoint (built once)"""
+        if self._countries_payload is None:
+            self._countries_payload = [
+                {
+                    'name': country,
+                    'products': [
+                        {
+                            'name': product,
+                            'operators': [
+                                dict(row, cost_formatted=f"₦{row['cost'] * 1:.2f}") for row in rows
+                            ]
+                        }
+                        for product, rows in products.items()
+                    ]
+                }
+                for country, products in self.by_country.items()
+            ]
+        return self._countries_payload
+
+
+_index: Optional[PricingIndex] = None
+_index_version = None
+_index_lock = threading.Lock()
+
+
+def get_pricing_index(api=None) -> PricingIndex:
+    """
+    Return the pricing index for the current price data, rebuilding it only
+    after the cached price tree has been refreshed
+    """
+    global _index, _index_version
+
+    if api is None:
+        from .fivesim import fivesim_api
+        api = fivesim_api
+
+    # Fast path: price tree still fresh and unchanged since the index was
+    # built, so skip loading (and unpickling) the whole tree from the shared
+    # cache. A stale tree goes through get_all_prices() below, which serves it
+    # and starts the background refresh.
+    version = provider_cache.cache.get(PRICES_VERSION_CACHE_KEY)
+    if _index is not None and version == _index_version and provider_cache.is_fresh(PRICES_CACHE_KEY):
+        return _index
+
+    with _index_lock:
+        # get_all_prices() bumps the version when it fetches new data
+        prices = api.get_all_prices()
+        version = provider_cache.cache.get(PRICES_VERSION_CACHE_KEY)
+        if version is None:
+            bump_prices_version()
+            version = provider_cache.cache.get(PRICES_VERSION_CACHE_KEY)
+
+        if _index is None or version != _index_version:
+            started = time.monotonic()
+            _index = PricingIndex(prices)
+            _index_version = version
+            logger.info(
+                f"Built 5sim pricing index: {len(_index.countries)} countries, "
+                f"{len(_index.products)} products in {(time.monotonic() - started) * 1000:.0f}ms"
+            )
+        return _index
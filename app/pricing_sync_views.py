@@ -9,6 +9,8 @@ from django.utils import timezone
 from datetime import timedelta
 from .models import SMSService
 from .fivesim import FiveSimAPI
+from .circuit_breaker import breaker_status
+from .routing import routing_status
 import json
 
 @require_http_methods(["GET"])
@@ -154,6 +156,10 @@ def pricing_health_check(request):
             'total_services': total_services,
             'recent_updates': recent_updates,
             'stale_services': stale_services,
+            # Provider endpoints this worker currently fails fast on
+            'provider_circuits': [circuit for circuit in breaker_status() if circuit['state'] != 'closed'],
+            # Recent purchase latency and no-number rates used for routing
+            'provider_routing': routing_status(),
             'last_check': now.isoformat()
         })
         
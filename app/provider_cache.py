@@ -0,0 +1,254 @@
+"""
+Shared Provider Response Cache
+Caches 5sim and MTelSMS responses in the 'shared' cache alias (file-based by
+default, Redis when REDIS_URL is set) so web workers, daemons and management
+commands reuse each other's fetches instead of each keeping a private copy.
+
+Entries are stored with a fresh-until time:
+- fresh       -> returned as a hit
+- stale       -> returned immediately while one process refreshes it in the
+                 background (stale-while-revalidate)
+- missing     -> one caller fetches, the others wait for its result
+                 (single-flight across threads and processes)
+
+Within a process, single-flight is exact (a lock per key). Across processes
+it relies on a lock entry in the cache holding the owner's token: only the
+process whose token is stored fetches, and only it can release the lock.
+Redis adds the entry atomically. On
+the file-based backend, add() is a check-then-write, so two processes that
+miss at the same moment can both fetch. Coalescing is best-effort there: the
+worst case is a duplicate upstream call, never a wrong value.
+"""
+
+import atexit
+import logging
+import threading
+import time
+import uuid
+from typing import Any, Callable, Dict, Optional
+
+from django.core.cache import caches
+
+logger = logging.getLogger(__name__)
+
+METRIC_NAMES = ('hits', 'stale_hits', 'misses', 'refreshes', 'refresh_errors', 'waits')
+
+
+class ProviderCache:
+    """
+    Read-through cache for upstream provider responses
+    """
+
+    LOCK_TIMEOUT = 30  # seconds, matches provider request timeouts
+    WAIT_INTERVAL = 0.05
+    METRICS_FLUSH_INTERVAL = 10  # seconds between writes to the shared counters
+
+    def __init__(self, alias: str = 'shared', prefix: str = 'provider'):
+        self.alias = alias
+        self.prefix = prefix
+        self.local_locks: Dict[str, threading.Lock] = {}
+        self.local_locks_guard = threading.Lock()
+        self.metrics = {name: 0 for name in METRIC_NAMES}
+        self.unflushed = {name: 0 for name in METRIC_NAMES}
+        self.last_metrics_flush = time.monotonic()
+        self.metrics_lock = threading.Lock()
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def _key(self, key: str) -> str:
+        return f"{self.prefix}:{key}"
+
+    def _local_lock(self, key: str) -> threading.Lock:
+        with self.local_locks_guard:
+            return self.local_locks.setdefault(key, threading.Lock())
+
+    # Metrics
+
+    def _count(self, name: str):
+        with self.metrics_lock:
+            self.metrics[name] += 1
+            self.unflushed[name] += 1
+            due = time.monotonic() - self.last_metrics_flush >= self.METRICS_FLUSH_INTERVAL
+        if due:
+            self.flush_metrics()
+
+    def flush_metrics(self):
+        """Add this process's counters to the shared totals"""
+        with self.metrics_lock:
+            pending = {name: count for name, count in self.unflushed.items() if count}
+            self.unflushed = {name: 0 for name in METRIC_NAMES}
+            self.last_metrics_flush = time.monotonic()
+
+        for name, count in pending.items():
+            metric_key = self._key(f"metrics:{name}")
+            try:
+                self.cache.incr(metric_key, count)
+            except ValueError:
+                if not self.cache.add(metric_key, count, None):
+                    self.cache.incr(metric_key, count)
+            except Exception as e:
+                logger.debug(f"Could not update shared cache metric {name}: {str(e)}")
+
+    def get_metrics(self) -> Dict[str, Dict[str, int]]:
+        """
+        Returns:
+            {'process': counters for this process, 'shared': counters for all processes}
+        """
+        self.flush_metrics()
+        with self.metrics_lock:
+            process = dict(self.metrics)
+        shared = {name: self.cache.get(self._key(f"metrics:{name}"), 0) for name in METRIC_NAMES}
+
+        for counters in (process, shared):
+            lookups = counters['hits'] + counters['stale_hits'] + counters['misses']
+            counters['hit_ratio'] = round((counters['hits'] + counters['stale_hits']) / lookups, 3) if lookups else 0
+        return {'process': process, 'shared': shared}
+
+    def reset_metrics(self):
+        with self.metrics_lock:
+            self.metrics = {name: 0 for name in METRIC_NAMES}
+            self.unflushed = {name: 0 for name in METRIC_NAMES}
+        self.cache.delete_many([self._key(f"metrics:{name}") for name in METRIC_NAMES])
+
+    # Lookups
+
+    def get_or_fetch(self, key: str, fetch: Callable[[], Any], ttl: int, stale_ttl: int = 0,
+                     on_refresh: Optional[Callable[[Any], None]] = None) -> Any:
+        """
+        Return the cached value for key, fetching it with fetch() when needed
+
+        Args:
+            key: Cache key (prefixed internally)
+            fetch: Performs the upstream call; exceptions propagate to callers
+                that have no cached value to fall back on
+            ttl: Seconds the value is fresh
+            stale_ttl: Extra seconds a stale value may be served while it is
+                refreshed in the background
+            on_refresh: Called with the new value after it has been stored
+        """
+        entry = self.cache.get(self._key(key))
+        now = time.time()
+
+        if entry is not None:
+            if now < entry['fresh_until']:
+                self._count('hits')
+                return entry['value']
+
+            self._count('stale_hits')
+            self._refresh_in_background(key, fetch, ttl, stale_ttl, on_refresh)
+            return entry['value']
+
+        self._count('misses')
+        return self._fetch_single_flight(key, fetch, ttl, stale_ttl, on_refresh)
+
+    def set(self, key: str, value: Any, ttl: int, stale_ttl: int = 0):
+        """Store a value as freshly fetched"""
+        entry = {'value': value, 'fresh_until': time.time() + ttl}
+        self.cache.set(self._key(key), entry, ttl + stale_ttl)
+        # Expires with the entry's freshness, so is_fresh() need not load the value
+        self.cache.set(self._fresh_key(key), True, ttl)
+
+    def _fresh_key(self, key: str) -> str:
+        return f"{self._key(key)}:fresh"
+
+    def has(self, key: str) -> bool:
+        """Check for an entry (fresh or stale) without loading its value"""
+        return self.cache.has_key(self._key(key))
+
+    def is_fresh(self, key: str) -> bool:
+        """Check for a fresh entry without loading its value"""
+        return self.cache.has_key(self._fresh_key(key))
+
+    def invalidate(self, key: str):
+        self.cache.delete_many([self._key(key), self._fresh_key(key)])
+
+    def _store(self, key, value, ttl, stale_ttl, on_refresh):
+        self.set(key, value, ttl, stale_ttl)
+        if on_refresh:
+            try:
+                on_refresh(value)
+            except Exception as e:
+                logger.error(f"Provider cache refresh hook failed for {key}: {str(e)}")
+
+    def _acquire(self, key: str) -> Optional[str]:
+        """
+        Take the cross-process refresh lock for a key
+
+        Returns:
+            The owner token to release it with, or None if another process
+            holds it. On the file-based backend the token is read back, which
+            narrows (but cannot close) the window in which two processes
+            both think they won.
+        """
+        lock_key = self._key(f"lock:{key}")
+        token = uuid.uuid4().hex
+        if not self.cache.add(lock_key, token, self.LOCK_TIMEOUT):
+            return None
+        if self.cache.get(lock_key) != token:
+            return None
+        return token
+
+    def _release(self, key: str, token: str):
+        """Release the lock if it is still ours (it may have expired and been retaken)"""
+        lock_key = self._key(f"lock:{key}")
+        if self.cache.get(lock_key) == token:
+            self.cache.delete(lock_key)
+
+    def _fetch_single_flight(self, key, fetch, ttl, stale_ttl, on_refresh):
+        # Threads in this process queue on a local lock, then re-check the cache
+        with self._local_lock(key):
+            entry = self.cache.get(self._key(key))
+            if entry is not None:
+                return entry['value']
+
+            token = self._acquire(key)
+            if token is None:
+                # Another process is fetching - wait for its result. Its lock
+                # expires after LOCK_TIMEOUT even if it died, so this ends.
+                self._count('waits')
+                deadline = time.time() + 2 * self.LOCK_TIMEOUT
+                while token is None:
+                    if time.time() >= deadline:
+                        raise TimeoutError(f"Timed out waiting for another process to fetch {key}")
+                    time.sleep(self.WAIT_INTERVAL)
+                    entry = self.cache.get(self._key(key))
+                    if entry is not None:
+                        return entry['value']
+                    if self.cache.get(self._key(f"lock:{key}")) is None:
+                        # Fetch failed in the other process; try ourselves
+                        token = self._acquire(key)
+
+            try:
+                value = fetch()
+                self._count('refreshes')
+                self._store(key, value, ttl, stale_ttl, on_refresh)
+                return value
+            except Exception:
+                self._count('refresh_errors')
+                raise
+            finally:
+                self._release(key, token)
+
+    def _refresh_in_background(self, key, fetch, ttl, stale_ttl, on_refresh):
+        token = self._acquire(key)
+        if token is None:
+            return  # Someone is already refreshing it
+
+        def refresh():
+            try:
+                value = fetch()
+                self._count('refreshes')
+                self._store(key, value, ttl, stale_ttl, on_refresh)
+            except Exception as e:
+                self._count('refresh_errors')
+                logger.warning(f"Background refresh failed for {key}, serving stale data: {str(e)}")
+            finally:
+                self._release(key, token)
+
+        threading.Thread(target=refresh, name="provider-cache-refresh", daemon=True).start()
+
+
+provider_cache = ProviderCache()
+atexit.register(provider_cache.flush_metrics)
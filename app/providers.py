@@ -0,0 +1,318 @@
+"""
+Purchase Providers
+A common interface over MTelSMS and 5sim so a number purchase can be routed
+to either of them (see app/routing.py). Each provider:
+
+- offer():          what it would charge for a product right now, from cached
+                    prices (no purchase call), or None if it doesn't sell it
+- buy():            makes the purchase; raises NoNumbers when out of stock,
+                    ProviderUnreachable when the request never reached the
+                    provider and ProviderFailed for any other provider error
+- create_records(): the order records, created inside confirm_reservation()
+- cancel():         undoes a purchase whose records could not be saved
+- stock_key():      (product, country, operator) for the sold-out cache
+
+MTelSMS purchases are recorded as Rentals, 5sim purchases as FiveSimOrders.
+"""
+
+import logging
+from datetime import datetime, timedelta
+from decimal import Decimal
+from typing import Dict, Optional
+
+from django.conf import settings
+from django.utils import timezone
+
+from .models import Rental, FiveSimOrder, Transaction
+from .mtelsms import get_mtelsms_client, MTelSMSException
+from .fivesim import FiveSimAPI
+from .http_transport import is_connect_error
+from .operator_stats import delivery_rate
+
+logger = logging.getLogger(__name__)
+
+
+class NoNumbers(Exception):
+    """Raised when a provider has no numbers for the product right now"""
+    pass
+
+
+class ProviderFailed(Exception):
+    """
+    Raised when a provider purchase failed for any other reason
+
+    The provider may still have sold the number (e.g. the response timed
+    out), so the purchase must not be retried elsewhere.
+    """
+    pass
+
+
+class ProviderUnreachable(ProviderFailed):
+    """Raised when the purchase request never reached the provider, so nothing was bought"""
+    pass
+
+
+def _failed(error: Exception) -> ProviderFailed:
+    """
+    ProviderUnreachable if the client's error was caused by a connect failure
+    or an open circuit breaker (the clients re-raise those as their own
+    exceptions, so the cause is looked for in the exception chain), else
+    ProviderFailed
+    """
+    cause = error
+    for _ in range(5):
+        if cause is None:
+            break
+        if is_connect_error(cause):
+            return ProviderUnreachable(str(error))
+        cause = cause.__cause__ or cause.__context__
+    return ProviderFailed(str(error))
+
+
+class Product:
+    """
+    What is being bought, in each provider's terms
+
+    Args:
+        service: MTelSMS Service (None for 5sim-only purchases)
+        fivesim_country, fivesim_product, fivesim_operator: 5sim names
+            (no 5sim product means 5sim does not sell it)
+        fivesim_options: Extra buy_activation_number() arguments (forwarding,
+            number, reuse, voice, ref, max_price)
+        description: Used for the reservation and transaction records
+        max_price_naira: The most the user agreed to pay (the price they were
+            shown); offers above it are not bought and the charge is capped
+            at it. None for no cap.
+    """
+
+    def __init__(self, service=None, fivesim_country: Optional[str] = None,
+                 fivesim_product: Optional[str] = None, fivesim_operator: str = 'any',
+                 fivesim_options: Optional[Dict] = None, description: str = '',
+                 max_price_naira: Optional[Decimal] = None):
+        self.service = service
+        self.fivesim_country = fivesim_country
+        self.fivesim_product = fivesim_product
+        self.fivesim_operator = fivesim_operator or 'any'
+        self.fivesim_options = dict(fivesim_options or {})
+        self.description = description
+        self.max_price_naira = max_price_naira
+
+    @classmethod
+    def for_service(cls, service, description: str = '', max_price_naira: Optional[Decimal] = None) -> 'Product':
+        """
+        An MTelSMS service, also bought from 5sim when it is mapped to a 5sim
+        product. The user is never charged more than the service's listed
+        price, or max_price_naira if they agreed to pay more.
+        """
+        fivesim_product = (service.fivesim_product or '').strip() or None
+        listed_price = service.get_naira_price()
+        return cls(
+            service=service,
+            fivesim_country=getattr(settings, 'ROUTING_FIVESIM_COUNTRY', 'usa') if fivesim_product else None,
+            fivesim_product=fivesim_product,
+            description=description or f"Rent {service.name} number",
+            max_price_naira=max(listed_price, max_price_naira or listed_price),
+        )
+
+
+class Offer:
+    """A provider's current price for a product"""
+
+    def __init__(self, provider, price_naira: Decimal, max_price: Optional[Decimal] = None,
+                 delivery_rate: Optional[float] = None):
+        self.provider = provider
+        self.price_naira = price_naira  # Held from the balance before buying
+        self.max_price = max_price  # Provider-currency price cap, if any
+        self.delivery_rate = delivery_rate  # Share of past orders that got an SMS, if known
+
+
+class Purchase:
+    """A number bought from a provider"""
+
+    def __init__(self, order_id, phone_number: str, cost: Decimal, price_naira: Decimal,
+                 expires_at, raw: Optional[Dict] = None):
+        self.order_id = order_id
+        self.phone_number = phone_number
+        self.cost = cost  # What the provider charged, in its currency
+        self.price_naira = price_naira  # What the user pays
+        self.expires_at = expires_at
+        self.raw = raw or {}
+
+
+class MTelSMSProvider:
+    name = 'MTELSMS'  # PurchaseReservation.provider
+    breaker = 'mtelsms'  # Circuit breaker provider and endpoint
+    buy_endpoint = 'getNumber'
+
+    def offer(self, product: Product) -> Optional[Offer]:
+        service = product.service
+        if service is None or not (service.mtelsms_service_id or '').strip():
+            return None
+        return Offer(self, service.get_naira_price(), max_price=service.get_usd_price())
+
+    def stock_key(self, product: Product) -> tuple:
+        return (product.service.code, 'any', 'any')
+
+    def buy(self, product: Product, offer: Offer) -> Purchase:
+        try:
+            rental_id, phone_number, actual_price, time_remaining = get_mtelsms_client().get_number(
+                service_id=product.service.mtelsms_service_id,
+                max_price=offer.max_price,
+                wholesale=False
+            )
+        except MTelSMSException as e:
+            if 'no number' in str(e).lower():
+                raise NoNumbers(str(e))
+            raise _failed(e)
+        return Purchase(
+            rental_id, phone_number, actual_price, offer.price_naira,
+            timezone.now() + timedelta(seconds=time_remaining),
+        )
+
+    def create_records(self, user, product: Product, purchase: Purchase) -> Rental:
+        service = product.service
+        rental = Rental.objects.create(
+            user=user,
+            rental_id=purchase.order_id,
+            service=service,
+            phone_number=purchase.phone_number,
+            price=purchase.price_naira,
+            area_codes=None,
+            carriers=None,
+            max_price=None,
+            expires_at=purchase.expires_at,
+        )
+        logger.info(f"Rental record created: {rental.id}, price=₦{purchase.price_naira}")
+
+        Transaction.objects.create(
+            user=user,
+            amount=-purchase.price_naira,
+            transaction_type='RENTAL',
+            description=f"Rented {service.name} number {purchase.phone_number}",
+            rental=rental
+        )
+        return rental
+
+    def cancel(self, purchase: Purchase) -> bool:
+        return get_mtelsms_client().cancel_rental(rental_id=purchase.order_id)
+
+
+def fivesim_price_naira(cost_rub) -> Decimal:
+    """Convert a 5sim cost in RUB to the price charged to the user in NGN"""
+    rate = Decimal(str(settings.EXCHANGE_RATE_RUB_TO_NGN))
+    profit = Decimal(str(settings.FIVESIM_FIXED_PROFIT_NGN))
+    wholesale_ngn = Decimal(str(cost_rub)) * rate  # Convert to NGN (20x)
+    return wholesale_ngn + profit  # Add ₦1,000 profit
+
+
+def estimate_fivesim_cost_rub(api_client, country: str, operator: str, product: str) -> Optional[Decimal]:
+    """
+    Estimate what 5sim will charge for a purchase from cached price data.
+    For operator "any" the most expensive operator with stock is used so the
+    held amount always covers the actual price.
+
+    Returns:
+        Decimal cost in RUB, or None if no operator has numbers available
+    """
+    try:
+        prices = api_client.get_prices_by_country_and_product(country, product)
+    except Exception as e:
+        logger.error(f"Price lookup failed for {country}/{product}: {str(e)}")
+        return None
+
+    operators = prices.get(country, {}).get(product, {})
+    if operator != 'any':
+        operators = {operator: operators[operator]} if operator in operators else {}
+
+    costs = [
+        Decimal(str(data.get('cost', 0)))
+        for data in operators.values()
+        if isinstance(data, dict) and data.get('count', 0) > 0
+    ]
+    return max(costs) if costs else None
+
+
+class FiveSimProvider:
+    name = 'FIVESIM'
+    breaker = 'fivesim'
+    buy_endpoint = '/user/buy'
+
+    def _api(self):
+        return FiveSimAPI(getattr(settings, 'FIVESIM_API_KEY', None))
+
+    def offer(self, product: Product) -> Optional[Offer]:
+        if not product.fivesim_product or not getattr(settings, 'FIVESIM_API_KEY', None):
+            return None
+        cost_rub = estimate_fivesim_cost_rub(
+            self._api(), product.fivesim_country, product.fivesim_operator, product.fivesim_product
+        )
+        if cost_rub is None:
+            return None
+        return Offer(self, fivesim_price_naira(cost_rub), delivery_rate=delivery_rate(
+            product.fivesim_country, product.fivesim_operator, product.fivesim_product
+        ))
+
+    def stock_key(self, product: Product) -> tuple:
+        return (product.fivesim_product, product.fivesim_country, product.fivesim_operator)
+
+    def buy(self, product: Product, offer: Offer) -> Purchase:
+        try:
+            result = self._api().buy_activation_number(
+                country=product.fivesim_country,
+                operator=product.fivesim_operator,
+                product=product.fivesim_product,
+                **product.fivesim_options
+            )
+        except Exception as e:
+            if 'no free phones' in str(e).lower():
+                raise NoNumbers("No number right now")
+            raise _failed(e)
+
+        expires_at = datetime.fromisoformat(result['expires'].replace('Z', '+00:00'))
+        duration_minutes = (expires_at - timezone.now()).total_seconds() / 60
+        logger.info(f"5sim Purchase: {product.fivesim_product} - Duration given: {duration_minutes:.1f} minutes (expires at {expires_at})")
+
+        cost_rub = Decimal(str(result['price']))  # What 5sim charged us in RUB
+        return Purchase(result['id'], result['phone'], cost_rub, fivesim_price_naira(cost_rub), expires_at, result)
+
+    def create_records(self, user, product: Product, purchase: Purchase) -> FiveSimOrder:
+        result = purchase.raw
+        options = product.fivesim_options
+        order = FiveSimOrder.objects.create(
+            user=user,
+            order_id=purchase.order_id,
+            order_type='ACTIVATION',
+            phone_number=purchase.phone_number,
+            country=result.get('country', ''),
+            operator=result.get('operator', ''),
+            product=result.get('product', product.fivesim_product),
+            price=purchase.cost,
+            price_naira=purchase.price_naira,
+            status=result.get('status', 'PENDING'),
+            expires_at=purchase.expires_at,
+            forwarding=result.get('forwarding', False),
+            forwarding_number=result.get('forwarding_number', ''),
+            reuse_enabled=options.get('reuse', False),
+            voice_enabled=options.get('voice', False),
+            max_price=Decimal(str(options['max_price'])) if options.get('max_price') else None,
+            referral_key=options.get('ref') or None,
+        )
+
+        Transaction.objects.create(
+            user=user,
+            amount=purchase.price_naira,
+            transaction_type='RENTAL',
+            description=f'{product.description} ({purchase.phone_number})',
+            rental=None,  # 5sim orders are not Rentals
+        )
+        return order
+
+    def cancel(self, purchase: Purchase) -> bool:
+        self._api().cancel_order(purchase.order_id)
+        return True
+
+
+PROVIDERS = {
+    MTelSMSProvider.name: MTelSMSProvider(),
+    FiveSimProvider.name: FiveSimProvider(),
+}
@@ -0,0 +1,176 @@
+"""
+Reserve/Confirm Purchase Pipeline
+Keeps provider calls outside of database transactions:
+
+1. reserve_funds()        - short transaction: debit balance, record a HELD reservation
+2. provider call          - no transaction or row lock held
+3. confirm_reservation()  - short transaction: create order records, settle the amount
+   or release_reservation() - short transaction: return the held funds
+
+Reservations orphaned by a crash between steps 1 and 3 are cleaned up by
+release_stale_reservations (see recover_stale_reservations below).
+"""
+
+import logging
+from datetime import timedelta
+from decimal import Decimal
+from typing import Callable, Dict, Optional
+
+from django.db import transaction
+from django.utils import timezone
+
+from .models import PurchaseReservation
+from .balance_ops import InsufficientBalance, debit, credit
+
+logger = logging.getLogger(__name__)
+
+
+class ReservationNotHeld(Exception):
+    """Raised when confirming a reservation that was already confirmed or released"""
+    pass
+
+
+def reserve_funds(user, amount: Decimal, provider: str, description: str = '') -> PurchaseReservation:
+    """
+    Debit a user's balance and record the held amount
+
+    Raises:
+        InsufficientBalance: If the balance does not cover the amount
+    """
+    with transaction.atomic():
+        # Conditional UPDATE - raises before anything is written if the balance is short
+        debit(user.pk, amount)
+
+        reservation = PurchaseReservation.objects.create(
+            user=user,
+            provider=provider,
+            amount=amount,
+            description=description,
+        )
+
+    logger.info(f"Reserved ₦{amount} for {user.username} ({provider}), reservation {reservation.id}")
+    return reservation
+
+
+def record_provider_order(reservation: PurchaseReservation, provider_order_id) -> None:
+    """Remember the provider order ID so recovery can cancel it after a crash"""
+    reservation.provider_order_id = str(provider_order_id)
+    PurchaseReservation.objects.filter(pk=reservation.pk).update(
+        provider_order_id=reservation.provider_order_id,
+        updated_at=timezone.now()
+    )
+
+
+def confirm_reservation(reservation: PurchaseReservation, create_records: Callable,
+                        final_amount: Optional[Decimal] = None):
+    """
+    Keep the held funds and create the order records in one short transaction
+
+    Args:
+        reservation: HELD reservation
+        create_records: Called inside the transaction to create order records;
+            its return value is returned
+        final_amount: Actual price if it differs from the held amount. Any
+            difference is credited back or debited in the same transaction.
+
+    Raises:
+        ReservationNotHeld: If the reservation was already confirmed/released
+        InsufficientBalance: If final_amount exceeds the held amount and the
+            balance cannot cover the difference
+    """
+    with transaction.atomic():
+        locked = PurchaseReservation.objects.select_for_update().get(pk=reservation.pk)
+        if locked.status != 'HELD':
+            raise ReservationNotHeld(f"Reservation {locked.id} is {locked.status}")
+
+        if final_amount is not None and final_amount != locked.amount:
+            difference = locked.amount - final_amount
+            if difference > 0:
+                credit(locked.user_id, difference)
+            else:
+                try:
+                    debit(locked.user_id, -difference)
+                except InsufficientBalance as e:
+                    raise InsufficientBalance(final_amount, e.available + locked.amount)
+            locked.amount = final_amount
+
+        result = create_records()
+
+        locked.status = 'CONFIRMED'
+        locked.save()
+
+    reservation.status = locked.status
+    reservation.amount = locked.amount
+    return result
+
+
+def release_reservation(reservation: PurchaseReservation, reason: str = '') -> bool:
+    """
+    Return held funds to the user
+
+    Returns:
+        bool: True if funds were returned, False if the reservation was not HELD
+    """
+    with transaction.atomic():
+        locked = PurchaseReservation.objects.select_for_update().get(pk=reservation.pk)
+        if locked.status != 'HELD':
+            return False
+
+        credit(locked.user_id, locked.amount)
+
+        locked.status = 'RELEASED'
+        if reason:
+            locked.description = f"{locked.description} [released: {reason}]".strip()
+        locked.save()
+
+    reservation.status = 'RELEASED'
+    logger.info(f"Released reservation {reservation.id}: ₦{locked.amount} returned to {locked.user.username} ({reason})")
+    return True
+
+
+def recover_stale_reservations(older_than: timedelta, cancel_provider_order: Optional[Callable] = None,
+                               dry_run: bool = False) -> Dict[str, int]:
+    """
+    Release reservations left HELD by a crashed request
+
+    Provider calls time out after 30 seconds, so anything HELD for longer than
+    older_than can no longer be confirmed by the request that created it.
+
+    Args:
+        older_than: Minimum reservation age
+        cancel_provider_order: Called with (provider, provider_order_id) for
+            reservations whose provider purchase succeeded; should return True
+            if the provider order was cancelled. If it returns False the
+            reservation stays HELD (counted as an error) and is retried on the
+            next run, so funds are never returned for a number still live
+            upstream.
+        dry_run: Only count what would be released
+    """
+    stats = {'found': 0, 'released': 0, 'provider_cancelled': 0, 'errors': 0}
+    cutoff = timezone.now() - older_than
+
+    stale = PurchaseReservation.objects.filter(status='HELD', created_at__lte=cutoff).select_related('user')
+    for reservation in stale:
+        stats['found'] += 1
+        if dry_run:
+            continue
+
+        try:
+            if reservation.provider_order_id and cancel_provider_order:
+                if not cancel_provider_order(reservation.provider, reservation.provider_order_id):
+                    stats['errors'] += 1
+                    logger.error(
+                        f"Could not cancel {reservation.provider} order {reservation.provider_order_id} "
+                        f"for stale reservation {reservation.id} - keeping it HELD, "
+                        f"MANUAL INTERVENTION REQUIRED if this persists!"
+                    )
+                    continue
+                stats['provider_cancelled'] += 1
+
+            if release_reservation(reservation, 'stale reservation recovered'):
+                stats['released'] += 1
+        except Exception as e:
+            stats['errors'] += 1
+            logger.error(f"Failed to recover reservation {reservation.id}: {str(e)}")
+
+    return stats
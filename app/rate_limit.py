@@ -0,0 +1,200 @@
+"""
+Reseller API Rate Limiting
+Token-bucket limiter for API keys plus batched usage accounting, so an
+authenticated call no longer needs a COUNT(*) over APIRequest or an UPDATE
+on the APIKey row.
+
+Backends (settings.API_RATE_LIMIT_BACKEND):
+    'local' - buckets kept in process memory (default)
+    'cache' - buckets kept in the Django cache, shared across workers
+              (settings.API_RATE_LIMIT_CACHE selects the cache alias)
+"""
+
+import atexit
+import logging
+import threading
+import time
+from dataclasses import dataclass
+from typing import Dict, Optional, Tuple
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models import F
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class RateLimitResult:
+    """Outcome of a rate limit check"""
+    allowed: bool
+    limit: int
+    remaining: int
+    retry_after: int = 0
+
+    def apply_headers(self, response):
+        """Add X-RateLimit-* (and Retry-After when limited) headers to a response"""
+        response['X-RateLimit-Limit'] = str(self.limit)
+        response['X-RateLimit-Remaining'] = str(self.remaining)
+        if not self.allowed:
+            response['Retry-After'] = str(self.retry_after)
+        return response
+
+
+def _refill(tokens: float, updated_at: float, now: float, capacity: int) -> float:
+    """Tokens in a bucket after refilling at capacity tokens per minute"""
+    return min(float(capacity), tokens + (now - updated_at) * capacity / 60.0)
+
+
+def _take(tokens: float, capacity: int) -> Tuple[bool, float, int]:
+    """
+    Try to take one token
+
+    Returns:
+        (allowed, tokens left, seconds until a token is available)
+    """
+    if tokens >= 1:
+        return True, tokens - 1, 0
+    retry_after = max(1, int((1 - tokens) * 60.0 / capacity + 0.999))
+    return False, tokens, retry_after
+
+
+class LocalTokenBucketBackend:
+    """
+    In-process token buckets (one per API key per worker)
+    """
+
+    def __init__(self):
+        self.buckets: Dict[str, Tuple[float, float]] = {}
+        self.lock = threading.Lock()
+
+    def hit(self, key: str, capacity: int) -> RateLimitResult:
+        now = time.monotonic()
+        with self.lock:
+            tokens, updated_at = self.buckets.get(key, (float(capacity), now))
+            tokens = _refill(tokens, updated_at, now, capacity)
+            allowed, tokens, retry_after = _take(tokens, capacity)
+            self.buckets[key] = (tokens, now)
+        return RateLimitResult(allowed, capacity, int(tokens), retry_after)
+
+
+class CacheTokenBucketBackend:
+    """
+    Token buckets stored in the Django cache so every worker shares them
+
+    Updates are serialised with a short cache.add() lock. If the lock cannot
+    be taken quickly the request is allowed rather than blocked on the cache.
+    """
+
+    LOCK_TIMEOUT = 2  # seconds
+    LOCK_ATTEMPTS = 20
+
+    def __init__(self, alias: str = 'default'):
+        self.cache = caches[alias]
+
+    def hit(self, key: str, capacity: int) -> RateLimitResult:
+        bucket_key = f"api_rate_bucket_{key}"
+        lock_key = f"{bucket_key}_lock"
+
+        for _ in range(self.LOCK_ATTEMPTS):
+            if self.cache.add(lock_key, 1, self.LOCK_TIMEOUT):
+                break
+            time.sleep(0.005)
+        else:
+            logger.warning(f"Rate limit lock busy for {key}, allowing request")
+            return RateLimitResult(True, capacity, 0)
+
+        try:
+            now = time.time()
+            tokens, updated_at = self.cache.get(bucket_key, (float(capacity), now))
+            tokens = _refill(tokens, updated_at, now, capacity)
+            allowed, tokens, retry_after = _take(tokens, capacity)
+            # A full bucket refills in one minute, after that the entry is not needed
+            self.cache.set(bucket_key, (tokens, now), 120)
+        finally:
+            self.cache.delete(lock_key)
+
+        return RateLimitResult(allowed, capacity, int(tokens), retry_after)
+
+
+class UsageRecorder:
+    """
+    Accumulates API key usage in memory and writes it to APIKey in batches
+    """
+
+    def __init__(self, flush_interval: float = 30):
+        self.flush_interval = flush_interval
+        self.pending: Dict[int, Tuple[int, object]] = {}
+        self.lock = threading.Lock()
+        self.last_flush = time.monotonic()
+
+    def record(self, api_key_id: int):
+        """Count one request for an API key, flushing if the interval has passed"""
+        now = timezone.now()
+        with self.lock:
+            count, _ = self.pending.get(api_key_id, (0, now))
+            self.pending[api_key_id] = (count + 1, now)
+            due = time.monotonic() - self.last_flush >= self.flush_interval
+
+        if due:
+            self.flush()
+
+    def flush(self) -> int:
+        """
+        Write pending usage to the database
+
+        Returns:
+            int: Number of API keys updated
+        """
+        from .models import APIKey
+
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            self.last_flush = time.monotonic()
+
+        for api_key_id, (count, last_used_at) in pending.items():
+            try:
+                APIKey.objects.filter(pk=api_key_id).update(
+                    total_requests=F('total_requests') + count,
+                    last_used_at=last_used_at
+                )
+            except Exception as e:
+                logger.error(f"Failed to flush usage for API key {api_key_id}: {str(e)}")
+
+        return len(pending)
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+usage_recorder = UsageRecorder(getattr(settings, 'API_USAGE_FLUSH_INTERVAL', 30))
+atexit.register(usage_recorder.flush)
+
+
+def get_rate_limit_backend():
+    """Return the configured limiter backend (created once per process)"""
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                name = getattr(settings, 'API_RATE_LIMIT_BACKEND', 'local')
+                if name == 'cache':
+                    _backend = CacheTokenBucketBackend(getattr(settings, 'API_RATE_LIMIT_CACHE', 'default'))
+                elif name == 'local':
+                    _backend = LocalTokenBucketBackend()
+                else:
+                    raise ValueError(f"Unknown API_RATE_LIMIT_BACKEND: {name}")
+    return _backend
+
+
+def check_rate_limit(api_key_obj) -> Optional[RateLimitResult]:
+    """
+    Take one token from an API key's bucket
+
+    Returns:
+        RateLimitResult, or None if the key has no rate limit
+    """
+    if api_key_obj.rate_limit_per_minute <= 0:
+        return None
+    return get_rate_limit_backend().hit(str(api_key_obj.pk), api_key_obj.rate_limit_per_minute)
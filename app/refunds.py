@@ -0,0 +1,165 @@
+"""
+Refund Ledger
+One place to refund a rental or 5sim order, replacing the lock-profile /
+add-balance / create-Transaction block that used to be repeated in every view
+and command:
+
+1. queue_*_refund()  - inside the transaction that moves the order to its final
+                       status: records a RefundIntent, unique per rental/order,
+                       so a second refund of the same order is a no-op
+                       (queue_refunds() records a whole sweep with one insert)
+2. apply_refunds()   - credits pending intents in batches: one balance UPDATE
+                       per user (credits summed) and one bulk insert of the
+                       REFUND Transaction rows
+
+Interactive paths (cancel buttons, the reseller API) apply their own intent
+straight away so the balance in the response is current. Sweeps queue every
+order they resolve and apply once at the end; anything left pending by a
+crash is picked up by the next sweep or by apply_refunds.
+"""
+
+import logging
+import uuid
+from decimal import Decimal
+from typing import Dict, Iterable, List, Optional
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .models import Transaction, RefundIntent
+from .balance_ops import credit
+
+logger = logging.getLogger(__name__)
+
+
+def rental_refund_key(rental) -> str:
+    return f"rental:{rental.pk}"
+
+
+def fivesim_refund_key(order) -> str:
+    return f"fivesim:{order.order_id}"
+
+
+def rental_refund(rental, description: str, amount: Optional[Decimal] = None) -> RefundIntent:
+    """Unsaved refund intent for a rental (its price unless another amount is given)"""
+    return RefundIntent(
+        key=rental_refund_key(rental),
+        user_id=rental.user_id,
+        amount=rental.get_naira_price() if amount is None else amount,
+        description=description,
+        rental=rental,
+    )
+
+
+def fivesim_refund(order, description: str) -> RefundIntent:
+    """Unsaved refund intent for a 5sim order"""
+    return RefundIntent(
+        key=fivesim_refund_key(order),
+        user_id=order.user_id,
+        amount=order.price_naira,
+        description=description,
+    )
+
+
+def queue_refund(intent: RefundIntent) -> bool:
+    """
+    Record a refund intent
+
+    Call it inside the transaction that marks the order refunded.
+
+    Returns:
+        bool: False if a refund for this key was already recorded
+    """
+    _, created = RefundIntent.objects.get_or_create(
+        key=intent.key,
+        defaults={
+            'user_id': intent.user_id,
+            'amount': intent.amount,
+            'description': intent.description,
+            'rental_id': intent.rental_id,
+        }
+    )
+    if not created:
+        logger.warning(f"Refund {intent.key} already recorded, not queuing it again")
+    return created
+
+
+def queue_refunds(intents: List[RefundIntent]):
+    """Record many refund intents with one insert (keys already recorded are skipped)"""
+    RefundIntent.objects.bulk_create(intents, ignore_conflicts=True)
+
+
+def queue_rental_refund(rental, description: str, amount: Optional[Decimal] = None) -> bool:
+    return queue_refund(rental_refund(rental, description, amount))
+
+
+def queue_fivesim_refund(order, description: str) -> bool:
+    return queue_refund(fivesim_refund(order, description))
+
+
+def _claim(keys: Optional[List[str]], limit: int) -> List[RefundIntent]:
+    """
+    Mark a batch of pending intents as applied and return them
+
+    The batch id makes the claim safe against concurrent appliers: only the
+    rows this call switched from PENDING carry its id.
+    """
+    pending = RefundIntent.objects.filter(status='PENDING')
+    if keys is not None:
+        pending = pending.filter(key__in=keys)
+    ids = list(pending.order_by('created_at').values_list('id', flat=True)[:limit])
+    if not ids:
+        return []
+
+    batch_id = uuid.uuid4()
+    RefundIntent.objects.filter(id__in=ids, status='PENDING').update(
+        status='APPLIED', batch_id=batch_id, applied_at=timezone.now()
+    )
+    return list(RefundIntent.objects.filter(batch_id=batch_id))
+
+
+def apply_refunds(keys: Optional[Iterable[str]] = None, limit: Optional[int] = None) -> int:
+    """
+    Credit pending refund intents
+
+    Args:
+        keys: Only apply these intents (default: everything pending)
+        limit: Maximum intents per batch (default REFUND_BATCH_SIZE)
+
+    Returns:
+        int: Number of refunds applied
+    """
+    limit = limit or getattr(settings, 'REFUND_BATCH_SIZE', 500)
+    if keys is not None:
+        keys = list(keys)  # Read once; a generator would be empty after the first batch
+    applied = 0
+    while True:
+        with transaction.atomic():
+            intents = _claim(keys, limit)
+            if not intents:
+                break
+
+            totals: Dict[int, Decimal] = {}
+            for intent in intents:
+                totals[intent.user_id] = totals.get(intent.user_id, Decimal('0')) + intent.amount
+
+            for user_id, total in totals.items():
+                credit(user_id, total)
+
+            Transaction.objects.bulk_create([
+                Transaction(
+                    user_id=intent.user_id,
+                    amount=intent.amount,
+                    transaction_type='REFUND',
+                    description=intent.description,
+                    rental_id=intent.rental_id,
+                )
+                for intent in intents
+            ])
+
+        applied += len(intents)
+        logger.info(f"Applied {len(intents)} refund(s) to {len(totals)} user(s)")
+        if len(intents) < limit:
+            break
+    return applied
@@ -9,23 +9,32 @@ from django.views.decorators.csrf import csrf_exempt
 from django.utils import timezone
 from django.db import transaction
 from decimal import Decimal
+from datetime import timedelta
 import time
 import json
 import logging
 
 from .api_keys import require_api_key, check_api_permission
+from .api_audit import audit_log
 from .api_models import APIRequest, APIOrderMapping
+from .webhooks import emit_order_event, emit_status_event
+from .refunds import queue_rental_refund, apply_refunds, rental_refund_key
 from .models import UserProfile, Rental, SMSMessage, Service, Transaction
 from .mtelsms import get_mtelsms_client, MTelSMSException
+from .circuit_breaker import provider_available, UNAVAILABLE_MESSAGE
+from .stock_cache import is_sold_out, mark_sold_out
+from .purchase_pipeline import (
+    reserve_funds, record_provider_order, confirm_reservation, release_reservation, InsufficientBalance
+)
 from django.conf import settings
 
 logger = logging.getLogger(__name__)
 
 
 def log_api_request(api_key, endpoint, method, status_code, response_time_ms, order_id=None, amount=None, request=None):
-    """Helper to log API requests"""
+    """Helper to log API requests (queued and written in batches by api_audit)"""
     try:
-        APIRequest.objects.create(
+        audit_log.submit(APIRequest(
             api_key=api_key,
             endpoint=endpoint,
             method=method,
@@ -35,7 +44,7 @@ def log_api_request(api_key, endpoint, method, status_code, response_time_ms, or
             amount=amount,
             ip_address=request.META.get('REMOTE_ADDR') if request else None,
             user_agent=request.META.get('HTTP_USER_AGENT', '')[:500] if request else ''
-        )
+        ))
     except Exception as e:
         logger.error(f"Failed to log API request: {str(e)}")
 
@@ -311,85 +320,122 @@ def api_purchase_number(request):
             # Use calculated price as max
             max_price_usd = final_price / UserProfile.USD_TO_NGN_RATE
         
-        # Make the purchase via MTelSMS
+        # Validate service has MTelSMS ID
+        service_id = service.mtelsms_service_id
+        if not service_id or service_id.strip() == '':
+            return JsonResponse({
+                'success': False,
+                'error': f'Service "{service.name}" is not available. Please contact support.'
+            }, status=400)
+        
+        # MTelSMS is failing right now - answer at once instead of holding funds for a call that would fail
+        if not provider_available('mtelsms', 'getNumber'):
+            response_time_ms = int((time.time() - start_time) * 1000)
+            log_api_request(request.api_key_obj, '/api/v1/purchase', 'POST', 503, response_time_ms, request=request)
+            return JsonResponse({
+                'success': False,
+                'error': UNAVAILABLE_MESSAGE
+            }, status=503)
+        
+        # MTelSMS had no numbers for this service moments ago - don't ask again yet
+        if is_sold_out('MTELSMS', service.code):
+            response_time_ms = int((time.time() - start_time) * 1000)
+            log_api_request(request.api_key_obj, '/api/v1/purchase', 'POST', 400, response_time_ms, request=request)
+            return JsonResponse({
+                'success': False,
+                'error': 'No number right now'
+            }, status=400)
+        
+        # STEP 1: Hold the funds in a short transaction (re-checks balance under lock)
         try:
-            with transaction.atomic():
-                # Lock user profile to prevent race conditions
-                profile = UserProfile.objects.select_for_update().get(user=user)
-                
-                # Double-check balance
-                if profile.balance < final_price:
-                    return JsonResponse({
-                        'success': False,
-                        'error': 'Insufficient balance'
-                    }, status=402)
-                
-                # Call MTelSMS API
-                client = get_mtelsms_client()
-                
-                # Validate service has MTelSMS ID
-                service_id = service.mtelsms_service_id
-                if not service_id or service_id.strip() == '':
-                    return JsonResponse({
-                        'success': False,
-                        'error': f'Service "{service.name}" is not available. Please contact support.'
-                    }, status=400)
-                
-                rental_id, phone_number, actual_price_usd, time_remaining = client.get_number(
-                    service_id=service_id,
-                    max_price=max_price_usd,
-                    wholesale=False
-                )
-                
-                # Create rental record
-                rental = Rental.objects.create(
-                    user=user,
-                    rental_id=rental_id,
-                    service=service,
-                    phone_number=phone_number,
-                    price=final_price,  # Store final price in NGN
-                    max_price=Decimal(str(max_price_ngn)) if max_price_ngn else None
-                )
-                
-                # Create API order mapping
-                import uuid
-                api_order_id = f"api_{uuid.uuid4().hex[:16]}"
-                
-                api_order = APIOrderMapping.objects.create(
-                    api_key=request.api_key_obj,
-                    rental=rental,
-                    api_order_id=api_order_id,
-                    api_price=final_price,
-                    base_price=service_price_ngn,
-                    markup_amount=markup_amount,
-                    status='WAITING'
-                )
-                
-                # Deduct balance
-                profile.balance -= final_price
-                profile.save()
-                
-                # Create transaction record
-                Transaction.objects.create(
-                    user=user,
-                    amount=-final_price,
-                    transaction_type='RENTAL',
-                    description=f"API rental: {service.name} - {phone_number}",
-                    rental=rental
-                )
-                
-                # Update API key stats
-                request.api_key_obj.total_purchases += 1
-                request.api_key_obj.total_revenue += markup_amount
-                request.api_key_obj.save(update_fields=['total_purchases', 'total_revenue'])
+            reservation = reserve_funds(
+                user, final_price, 'MTELSMS',
+                description=f"API rental: {service.name}"
+            )
+        except InsufficientBalance:
+            return JsonResponse({
+                'success': False,
+                'error': 'Insufficient balance'
+            }, status=402)
         
+        # STEP 2: Call MTelSMS with no database transaction or row lock held
+        client = get_mtelsms_client()
+        try:
+            rental_id, phone_number, actual_price_usd, time_remaining = client.get_number(
+                service_id=service_id,
+                max_price=max_price_usd,
+                wholesale=False
+            )
         except MTelSMSException as e:
+            release_reservation(reservation, 'provider error')
+            if 'no number' in str(e).lower():
+                mark_sold_out('MTELSMS', service.code, reason=str(e))
             response_time_ms = int((time.time() - start_time) * 1000)
             log_api_request(request.api_key_obj, '/api/v1/purchase', 'POST', 400, response_time_ms, request=request)
             return JsonResponse({
                 'success': False,
                 'error': str(e)
             }, status=400)
+        except Exception:
+            release_reservation(reservation, 'provider error')
+            raise
+        
+        record_provider_order(reservation, rental_id)
+        
+        # STEP 3: Create the order records and keep the funds
+        import uuid
+        api_order_id = f"api_{uuid.uuid4().hex[:16]}"
+        
+        def create_records():
+            # Create rental record
+            rental = Rental.objects.create(
+                user=user,
+                rental_id=rental_id,
+                service=service,
+                phone_number=phone_number,
+                price=final_price,  # Store final price in NGN
+                max_price=Decimal(str(max_price_ngn)) if max_price_ngn else None,
+                expires_at=timezone.now() + timedelta(seconds=time_remaining)
+            )
+            
+            # Create API order mapping
+            APIOrderMapping.objects.create(
+                api_key=request.api_key_obj,
+                rental=rental,
+                api_order_id=api_order_id,
+                api_price=final_price,
+                base_price=service_price_ngn,
+                markup_amount=markup_amount,
+                status='WAITING'
+            )
+            
+            # Create transaction record
+            Transaction.objects.create(
+                user=user,
+                amount=-final_price,
+                transaction_type='RENTAL',
+                description=f"API rental: {service.name} - {phone_number}",
+                rental=rental
+            )
+            
+            # Update API key stats
+            request.api_key_obj.total_purchases += 1
+            request.api_key_obj.total_revenue += markup_amount
+            request.api_key_obj.save(update_fields=['total_purchases', 'total_revenue'])
+            return rental
+        
+        try:
+            confirm_reservation(reservation, create_records)
+        except Exception as e:
+            # MTelSMS succeeded but the database failed - cancel upstream and return the funds
+            logger.error(f"API purchase: DATABASE ERROR after MTelSMS success! rental_id={rental_id}, error={str(e)}")
+            try:
+                if not client.cancel_rental(rental_id=rental_id):
+                    logger.error(f"Failed to cancel rental_id={rental_id} on MTelSMS - MANUAL INTERVENTION REQUIRED!")
+            except Exception as cancel_error:
+                logger.error(f"Error cancelling rental_id={rental_id}: {str(cancel_error)} - MANUAL INTERVENTION REQUIRED!")
+            release_reservation(reservation, 'database error after provider success')
+            raise
         
         response_time_ms = int((time.time() - start_time) * 1000)
         log_api_request(
@@ -449,7 +495,6 @@ def api_check_order(request, order_id):
         
         # AUTO-CANCEL AFTER 5 MINUTES IF NO SMS RECEIVED
         # Check if rental has been waiting for 5+ minutes
-        from datetime import timedelta
         if rental.status == 'WAITING':
             time_since_creation = timezone.now() - rental.created_at
             if time_since_creation >= timedelta(minutes=5):
@@ -462,16 +507,18 @@ def api_check_order(request, order_id):
                     
                     # If SMS was received, save it and return success (no cancel)
                     if status == 'RECEIVED' and code:
-                        rental.status = 'RECEIVED'
-                        api_order.status = 'RECEIVED'
-                        rental.save()
-                        api_order.save()
-                        
-                        SMSMessage.objects.get_or_create(
-                            rental=rental,
-                            code=code,
-                            defaults={'full_text': code}
-                        )
+                        with transaction.atomic():
+                            rental.status = 'RECEIVED'
+                            api_order.status = 'RECEIVED'
+                            rental.save()
+                            api_order.save()
+                            
+                            SMSMessage.objects.get_or_create(
+                                rental=rental,
+                                code=code,
+                                defaults={'full_text': code}
+                            )
+                            emit_order_event('sms_received', rental, code=code)
                         
                         logger.info(f"API Order {order_id}: SMS received just before auto-cancel - saved code")
                         
@@ -526,21 +573,15 @@ def api_check_order(request, order_id):
                                 
                                 api_order.status = 'CANCELLED'
                                 api_order.save()
+                                emit_order_event('order_cancelled', rental)
                                 
                                 # Issue refund
-                                user = request.api_user
-                                profile = UserProfile.objects.select_for_update().get(user=user)
-                                profile.balance += api_order.api_price
-                                profile.save()
-                                
-                                # Create refund transaction
-                                Transaction.objects.create(
-                                    user=user,
-                                    amount=api_order.api_price,
-                                    transaction_type='REFUND',
-                                    description=f'Auto-refund: API order {order_id} - No SMS after 5 minutes',
-                                    rental=rental
+                                queue_rental_refund(
+                                    rental,
+                                    f'Auto-refund: API order {order_id} - No SMS after 5 minutes',
+                                    amount=api_order.api_price
                                 )
+                                apply_refunds([rental_refund_key(rental)])
                                 
                                 logger.info(f"API Order {order_id}: Auto-cancelled and refunded ₦{api_order.api_price}")
                             
@@ -565,10 +606,16 @@ def api_check_order(request, order_id):
         
         # Check with MTelSMS for updates
         try:
-            client = get_mtelsms_client()
-            status, code, phone_number, time_remaining = client.get_code(
-                rental_id=rental.rental_id
-            )
+            if rental.status == 'WAITING' and rental.is_expired:
+                # Past the stored provider deadline - no need to ask MTelSMS
+                status, code, time_remaining = 'WAITING', None, 0
+            else:
+                client = get_mtelsms_client()
+                status, code, phone_number, time_remaining = client.get_code(
+                    rental_id=rental.rental_id
+                )
+                if status == 'WAITING':
+                    rental.record_time_remaining(time_remaining)
             
             # Check if rental has expired (time_remaining = 0)
             if time_remaining <= 0 and status == 'WAITING':
@@ -601,38 +648,35 @@ def api_check_order(request, order_id):
                     api_order.status = 'EXPIRED'
                     rental.save()
                     api_order.save()
+                    emit_order_event('order_expired', rental)
                     
                     # Issue refund
-                    user = request.api_user
-                    profile = UserProfile.objects.select_for_update().get(user=user)
-                    profile.balance += rental.price
-                    profile.save()
-                    
-                    # Log refund transaction
-                    Transaction.objects.create(
-                        user=user,
-                        amount=rental.price,
-                        transaction_type='REFUND',
-                        description=f'Automatic refund for expired rental {rental.phone_number}'
-                    )
+                    queue_rental_refund(rental, f'Automatic refund for expired rental {rental.phone_number}')
+                    apply_refunds([rental_refund_key(rental)])
                     
                     logger.info(f"Automatic refund issued for expired rental {rental.rental_id}")
             else:
-                # Update rental status normally
-                rental.status = status
-                rental.save()
-                
-                # Update API order status
-                api_order.status = status
-                api_order.save()
-            
-            # Save message if received
-            if status == 'RECEIVED' and code:
-                SMSMessage.objects.get_or_create(
-                    rental=rental,
-                    code=code,
-                    defaults={'full_text': code}
-                )
+                with transaction.atomic():
+                    status_changed = rental.status != status
+                    
+                    # Update rental status normally
+                    rental.status = status
+                    rental.save()
+                    
+                    # Update API order status
+                    api_order.status = status
+                    api_order.save()
+                    
+                    # Save message if received
+                    if status == 'RECEIVED' and code:
+                        SMSMessage.objects.get_or_create(
+                            rental=rental,
+                            code=code,
+                            defaults={'full_text': code}
+                        )
+                    
+                    if status_changed:
+                        emit_status_event(rental, code=code)
         except MTelSMSException as e:
             logger.error(f"MTelSMS status check error: {str(e)}")
         
@@ -750,21 +794,11 @@ def api_cancel_order(request, order_id):
             
             api_order.status = 'CANCELLED'
             api_order.save()
+            emit_order_event('order_cancelled', rental)
             
             # Refund to user
-            user = request.api_user
-            profile = UserProfile.objects.select_for_update().get(user=user)
-            profile.balance += api_order.api_price
-            profile.save()
-            
-            # Create transaction record
-            Transaction.objects.create(
-                user=user,
-                amount=api_order.api_price,
-                transaction_type='REFUND',
-                description=f'API order {order_id} cancelled and refunded',
-                rental=rental
-            )
+            queue_rental_refund(rental, f'API order {order_id} cancelled and refunded', amount=api_order.api_price)
+            apply_refunds([rental_refund_key(rental)])
         
         response_time_ms = int((time.time() - start_time) * 1000)
         log_api_request(request.api_key_obj, f'/api/v1/order/{order_id}/cancel', 'POST', 200, response_time_ms, request=request)
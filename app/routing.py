@@ -0,0 +1,276 @@
+"""
+Purchase Routing
+Picks the provider for each number purchase and falls over to the next one
+within the same request (providers are described in app/providers.py):
+
+1. Every provider that sells the product quotes a price from cached data;
+   providers whose buy endpoint has an open circuit breaker, or that had no
+   numbers for the product moments ago (app/stock_cache.py), are left out,
+   and so are quotes above the price the user was shown (Product.max_price_naira).
+   If only such quotes are left, PriceAboveQuote asks the user to agree to
+   the higher price first; the charge is never above the agreed price
+2. Quotes are ranked by expected cost: the price, plus a charge per second of
+   the provider's recent purchase latency, divided by its recent success rate
+   (purchases that did not end in "no numbers" or an error) and, where the
+   operator stats know it (app/operator_stats.py), by the share of past
+   orders for the product that received an SMS
+3. The best provider's price is held with reserve_funds() and bought; if it
+   has no numbers, or the request could not reach it, the funds are released
+   and the next provider is tried, as long as the request is still inside its
+   time budget. A "no numbers" answer is also remembered in the sold-out
+   cache. Any other error (a timeout, an error response) ends the purchase:
+   the provider may have sold the number anyway, and buying a second one
+   elsewhere would leave the first unrecorded
+
+Latency and success rates are kept per process as moving averages.
+
+Settings (all optional):
+    ROUTING_LATENCY_COST     naira added per second of recent latency (default 20)
+    ROUTING_FAILOVER_BUDGET  seconds after which no further provider is tried (default 20)
+    ROUTING_FIVESIM_COUNTRY  5sim country for services mapped to a 5sim product (default 'usa')
+"""
+
+import logging
+import threading
+import time
+from decimal import Decimal
+from typing import Dict, Iterable, List, Optional
+
+from django.conf import settings
+
+from .circuit_breaker import provider_available, UNAVAILABLE_MESSAGE
+from .stock_cache import is_sold_out, mark_sold_out
+from .providers import PROVIDERS, Product, Offer, Purchase, NoNumbers, ProviderFailed, ProviderUnreachable
+from .purchase_pipeline import (
+    reserve_funds, record_provider_order, confirm_reservation, release_reservation, InsufficientBalance
+)
+
+logger = logging.getLogger(__name__)
+
+# Weight of the newest purchase in the moving averages
+STATS_ALPHA = 0.2
+
+
+class NoProvider(Exception):
+    """Raised when no provider can take a purchase (none sells it, or all are unavailable)"""
+    pass
+
+
+class PriceAboveQuote(NoProvider):
+    """
+    Raised when the only providers that could sell the product now charge
+    more than the user agreed to pay
+    """
+
+    def __init__(self, price_naira: Decimal, quoted_naira: Decimal):
+        self.price_naira = price_naira  # Cheapest available price
+        self.quoted_naira = quoted_naira
+        super().__init__(
+            f"This number now costs ₦{price_naira:,.2f} (you were shown ₦{quoted_naira:,.2f}). "
+            f"Confirm to rent it at the new price."
+        )
+
+
+class ProviderStats:
+    """
+    Moving averages of one provider's recent purchases
+    """
+
+    def __init__(self):
+        self.latency: Optional[float] = None  # seconds
+        self.no_number_rate = 0.0
+        self.error_rate = 0.0
+        self.purchases = 0
+        self.lock = threading.Lock()
+
+    def record(self, outcome: str, duration: float):
+        """outcome: 'ok', 'no_numbers' or 'error'"""
+        with self.lock:
+            self.purchases += 1
+            if self.latency is None:
+                self.latency = duration
+            else:
+                self.latency += STATS_ALPHA * (duration - self.latency)
+            self.no_number_rate += STATS_ALPHA * ((outcome == 'no_numbers') - self.no_number_rate)
+            self.error_rate += STATS_ALPHA * ((outcome == 'error') - self.error_rate)
+
+    @property
+    def success_rate(self) -> float:
+        return max(0.05, 1.0 - self.no_number_rate - self.error_rate)
+
+    def as_dict(self) -> Dict:
+        return {
+            'purchases': self.purchases,
+            'latency': round(self.latency, 3) if self.latency is not None else None,
+            'no_number_rate': round(self.no_number_rate, 3),
+            'error_rate': round(self.error_rate, 3),
+        }
+
+
+_stats: Dict[str, ProviderStats] = {name: ProviderStats() for name in PROVIDERS}
+
+
+def expected_cost(offer: Offer) -> float:
+    """Ranking score for an offer; lower is better"""
+    stats = _stats[offer.provider.name]
+    cost = float(offer.price_naira)
+    cost += getattr(settings, 'ROUTING_LATENCY_COST', 20) * (stats.latency or 0.0)
+    delivery = max(0.05, offer.delivery_rate) if offer.delivery_rate is not None else 1.0
+    return cost / (stats.success_rate * delivery)
+
+
+def rank_offers(product: Product, providers: Optional[Iterable[str]] = None) -> List[Offer]:
+    """
+    Offers for a product, best first
+
+    Args:
+        providers: Provider names to consider, in order of preference for
+            equal scores (default: all)
+
+    Raises:
+        NoProvider: If some provider sells the product but all of them are
+            unavailable right now
+        NoNumbers: If the providers that sell it all had no numbers moments ago
+    """
+    offers = []
+    unavailable = []
+    sold_out = []
+    for name in providers or PROVIDERS:
+        provider = PROVIDERS[name]
+        try:
+            offer = provider.offer(product)
+        except Exception as e:
+            logger.warning(f"{name} could not quote {product.description}: {str(e)}")
+            continue
+        if offer is None:
+            continue
+        if not provider_available(provider.breaker, provider.buy_endpoint):
+            unavailable.append(name)
+            continue
+        if is_sold_out(provider.name, *provider.stock_key(product)):
+            sold_out.append(name)
+            continue
+        offers.append(offer)
+
+    if not offers and unavailable:
+        raise NoProvider(UNAVAILABLE_MESSAGE)
+    if not offers and sold_out:
+        raise NoNumbers("No number right now")
+    # Stable sort: equal scores keep the preference order
+    return sorted(offers, key=expected_cost)
+
+
+class RoutedPurchase:
+    """Result of route_purchase()"""
+
+    def __init__(self, provider: str, purchase: Purchase, record, attempts: List[str]):
+        self.provider = provider
+        self.purchase = purchase
+        self.record = record  # Rental or FiveSimOrder
+        self.attempts = attempts  # Provider names tried, in order
+
+
+def route_purchase(user, product: Product, providers: Optional[Iterable[str]] = None) -> RoutedPurchase:
+    """
+    Buy a number from the best provider, falling over to the next on failure
+
+    Raises:
+        NoProvider: If no provider offers the product right now
+        PriceAboveQuote: If providers offer it, but only above the agreed price
+        NoNumbers: If every provider that sells it had no numbers moments ago
+        InsufficientBalance: If the balance covers none of the offers
+        NoNumbers / ProviderUnreachable: The last provider's error when every
+            provider tried had no numbers or could not be reached
+        ProviderFailed: If a provider failed in a way that may have sold the
+            number (no other provider is tried)
+        Exception: If the purchase succeeded but its records could not be
+            saved (the provider order is cancelled and the funds released)
+    """
+    offers = rank_offers(product, providers)
+    if not offers:
+        raise NoProvider("This product is not available right now. Please try another option.")
+    # Never buy above the price the user agreed to; if nothing cheaper works
+    # out, they are asked about the cheapest of these instead
+    above_quote = []
+    if product.max_price_naira is not None:
+        above_quote = [offer for offer in offers if offer.price_naira > product.max_price_naira]
+        offers = [offer for offer in offers if offer.price_naira <= product.max_price_naira]
+
+    budget = getattr(settings, 'ROUTING_FAILOVER_BUDGET', 20)
+    started = time.monotonic()
+    attempts = []
+    last_error: Optional[Exception] = None
+
+    for offer in offers:
+        provider = offer.provider
+        if attempts and time.monotonic() - started > budget:
+            logger.warning(f"Purchase of {product.description} out of time after {attempts}, not trying {provider.name}")
+            break
+
+        try:
+            reservation = reserve_funds(user, offer.price_naira, provider.name, description=product.description)
+        except InsufficientBalance as e:
+            last_error = e
+            continue
+
+        attempts.append(provider.name)
+        call_started = time.monotonic()
+        try:
+            purchase = provider.buy(product, offer)
+        except (NoNumbers, ProviderUnreachable) as e:
+            # Nothing was bought - safe to try the next provider
+            outcome = 'no_numbers' if isinstance(e, NoNumbers) else 'error'
+            _stats[provider.name].record(outcome, time.monotonic() - call_started)
+            if outcome == 'no_numbers':
+                mark_sold_out(provider.name, *provider.stock_key(product), reason=str(e))
+            release_reservation(reservation, 'provider error')
+            logger.warning(f"{provider.name} could not sell {product.description} ({str(e)}), trying the next provider")
+            last_error = e
+            continue
+        except ProviderFailed as e:
+            _stats[provider.name].record('error', time.monotonic() - call_started)
+            release_reservation(reservation, 'provider error')
+            logger.error(f"{provider.name} purchase of {product.description} failed ({str(e)}); "
+                         f"not trying another provider in case the number was sold")
+            raise
+        except Exception:
+            release_reservation(reservation, 'provider error')
+            raise
+        _stats[provider.name].record('ok', time.monotonic() - call_started)
+        logger.info(f"{provider.name} sold {product.description}: order {purchase.order_id}, phone {purchase.phone_number}")
+
+        if product.max_price_naira is not None and purchase.price_naira > product.max_price_naira:
+            # The actual price came in above the quote: the user pays what they agreed to
+            logger.warning(f"{provider.name} order {purchase.order_id} cost ₦{purchase.price_naira}, "
+                           f"charging the agreed ₦{product.max_price_naira}")
+            purchase.price_naira = product.max_price_naira
+
+        record_provider_order(reservation, purchase.order_id)
+        try:
+            record = confirm_reservation(
+                reservation,
+                lambda: provider.create_records(user, product, purchase),
+                final_amount=purchase.price_naira,
+            )
+        except Exception as e:
+            # The provider sold the number but it could not be recorded (price
+            # rose above the balance, or a database error) - undo both sides
+            logger.error(f"Could not record {provider.name} order {purchase.order_id}: {str(e)}")
+            try:
+                if not provider.cancel(purchase):
+                    logger.error(f"Failed to cancel {provider.name} order {purchase.order_id} - MANUAL INTERVENTION REQUIRED!")
+            except Exception as cancel_error:
+                logger.error(f"Error cancelling {provider.name} order {purchase.order_id}: {str(cancel_error)} - MANUAL INTERVENTION REQUIRED!")
+            release_reservation(reservation, 'could not confirm purchase')
+            raise
+
+        return RoutedPurchase(provider.name, purchase, record, attempts)
+
+    if above_quote and not isinstance(last_error, InsufficientBalance):
+        raise PriceAboveQuote(min(offer.price_naira for offer in above_quote), product.max_price_naira)
+    raise last_error or NoProvider(UNAVAILABLE_MESSAGE)
+
+
+def routing_status() -> Dict[str, Dict]:
+    """Recent purchase stats per provider (this process)"""
+    return {name: stats.as_dict() for name, stats in _stats.items()}
@@ -0,0 +1,187 @@
+"""
+Sweep Sharding
+Splits a sweep command's rows into disjoint shards so one sweep can run on
+several processes (or hosts) at once:
+
+- Rows belong to shard `pk % shards`; the split is done in the database, so
+  each shard only loads its own rows
+- A command run with --shards N --shard-index I sweeps one shard
+- A command run with --parallel is a supervisor: it runs every shard on a
+  ProcessPoolExecutor and merges the per-shard counters into one summary
+- Every run holds the command's one lease (app/leases.py exclusive_command),
+  so runs with different shard counts never overlap. The supervisor holds it
+  for its workers, which fence their writes with it. Shards run
+  concurrently only under one supervisor; separate --shard-index runs take
+  turns.
+
+Commands that support this call add_shard_arguments() in add_arguments(),
+filter their queryset with shard_queryset(), keep their totals in
+self.counters, write their summary from a write_summary(counters, dry_run)
+method and list the options shard workers inherit in
+shard_passthrough_options (see check_expired_rentals and
+sync_fivesim_order_statuses).
+
+This module must stay importable before django.setup(): spawned worker
+processes import it to run _init_worker.
+"""
+
+import io
+import logging
+import multiprocessing
+import os
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Dict, List, Optional
+
+from django.core.management.base import CommandError
+from django.db.models import F
+from django.db.models.functions import Mod
+
+logger = logging.getLogger(__name__)
+
+
+def add_shard_arguments(parser):
+    parser.add_argument(
+        '--shards',
+        type=int,
+        default=1,
+        help='Split the sweep into this many shards (by primary key)',
+    )
+    parser.add_argument(
+        '--shard-index',
+        type=int,
+        default=None,
+        help='Only sweep this shard (0 to shards-1)',
+    )
+    parser.add_argument(
+        '--parallel',
+        action='store_true',
+        help='Sweep every shard at once on worker processes and merge the results '
+             '(default shards: one per CPU)',
+    )
+
+
+def shard_options(options: Dict) -> tuple:
+    """
+    Validated (shards, shard_index) from a command's options
+
+    shard_index is None when the whole table (or, with --parallel, every
+    shard) is to be swept.
+    """
+    shards = options.get('shards') or 1
+    shard_index = options.get('shard_index')
+    if options.get('parallel') and shards == 1:
+        shards = os.cpu_count() or 1
+    if shards < 1:
+        raise CommandError('--shards must be at least 1')
+    if shard_index is not None and not 0 <= shard_index < shards:
+        raise CommandError(f'--shard-index must be between 0 and {shards - 1}')
+    if shard_index is not None and options.get('parallel'):
+        raise CommandError('--parallel runs every shard; do not combine it with --shard-index')
+    return shards, shard_index
+
+
+def shard_queryset(queryset, shards: int, shard_index: Optional[int]):
+    """Restrict a queryset to one shard's rows (no-op when not sharded)"""
+    if shard_index is None or shards <= 1:
+        return queryset
+    return queryset.annotate(shard=Mod(F('pk'), shards)).filter(shard=shard_index)
+
+
+def shard_label(shards: int, shard_index: Optional[int]) -> str:
+    """Suffix for log lines, e.g. 'shard-2/8' ('' when not sharded)"""
+    if shard_index is None or shards <= 1:
+        return ''
+    return f'shard-{shard_index}/{shards}'
+
+
+def _init_worker():
+    import django
+    django.setup()
+
+
+def _run_shard(command_name: str, shards: int, shard_index: int, options: Dict,
+               lease: Optional[tuple] = None) -> Dict:
+    """
+    Run one shard of a command in a worker process
+
+    lease is the supervisor's (name, holder, token, ttl); the worker fences
+    its writes with it instead of taking the command's lease itself.
+    """
+    from django.core.management import call_command, get_commands, load_command_class
+    from .leases import Lease
+
+    command = load_command_class(get_commands()[command_name], command_name)
+    if lease is not None:
+        command.supervisor_lease = Lease(*lease)
+    out = io.StringIO()
+    call_command(command, shards=shards, shard_index=shard_index, stdout=out, stderr=out, **options)
+    return {
+        'shard': shard_index,
+        'counters': dict(getattr(command, 'counters', {})),
+        'output': out.getvalue(),
+    }
+
+
+def run_sharded(command_name: str, shards: int, options: Dict,
+                max_workers: Optional[int] = None, lease=None) -> tuple:
+    """
+    Run every shard of a command on a process pool
+
+    Workers are spawned rather than forked so none of them inherits this
+    process's database connections.
+
+    Args:
+        options: The command's own options (without the shard options)
+        max_workers: Processes to use (default: one per shard, up to the CPU count)
+        lease: The supervisor's held Lease, shared with the shard workers
+
+    Returns:
+        (merged counters, per-shard results ordered by shard)
+    """
+    from django.db import connections
+
+    max_workers = max_workers or min(shards, os.cpu_count() or 1)
+    connections.close_all()
+    lease_args = (lease.name, lease.holder, lease.token, lease.ttl) if lease is not None else None
+
+    totals = Counter()
+    results: List[Dict] = []
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn'),
+                             initializer=_init_worker) as executor:
+        futures = {
+            executor.submit(_run_shard, command_name, shards, index, options, lease_args): index
+            for index in range(shards)
+        }
+        for future in as_completed(futures):
+            index = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                logger.error(f"{command_name} shard {index}/{shards} failed: {str(e)}")
+                result = {'shard': index, 'counters': {'errors': 1}, 'output': '', 'error': str(e)}
+            totals.update(result['counters'])
+            results.append(result)
+
+    results.sort(key=lambda result: result['shard'])
+    return dict(totals), results
+
+
+def supervise(command, command_name: str, options: Dict, shards: int):
+    """
+    The --parallel mode of a sharded command: run every shard, report each
+    shard in one line and write the command's summary for the merged counters
+    """
+    base_options = {key: options[key] for key in command.shard_passthrough_options if key in options}
+
+    command.stdout.write(f'Sweeping {shards} shards in parallel...')
+    counters, results = run_sharded(command_name, shards, base_options, lease=getattr(command, 'lease', None))
+    for result in results:
+        if result.get('error'):
+            command.stdout.write(command.style.ERROR(f"  shard {result['shard']}: failed - {result['error']}"))
+        else:
+            summary = ', '.join(f'{key} {value}' for key, value in sorted(result['counters'].items()))
+            command.stdout.write(f"  shard {result['shard']}: {summary or 'nothing to do'}")
+
+    command.counters = counters
+    command.write_summary(counters, options.get('dry_run', False))
@@ -0,0 +1,99 @@
+"""
+Single-Flight Request Coalescing
+Concurrent callers asking for the same upstream result (e.g. two dashboard
+tabs and a daemon checking one rental) share a single in-flight call. A
+successful result is also reused for a short TTL so back-to-back checks in the
+same second don't hit the provider again. Errors are shared only with callers
+that were already waiting; the next caller retries.
+"""
+
+import copy
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, Hashable, Optional
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+class _Call:
+    __slots__ = ('done', 'result', 'error', 'finished_at')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error: Optional[BaseException] = None
+        self.finished_at = 0.0
+
+
+class SingleFlight:
+    """
+    Coalesces calls with the same key within one process
+    """
+
+    def __init__(self, ttl: float = 2.0):
+        self.ttl = ttl
+        self.calls: Dict[Hashable, _Call] = {}
+        self.lock = threading.Lock()
+        self.stats = {'calls': 0, 'coalesced': 0}
+
+    def do(self, key: Hashable, fn: Callable[[], Any]) -> Any:
+        """
+        Run fn() for key, or share the result of an identical call that is in
+        flight or finished less than ttl seconds ago
+
+        Returned values are shared between callers, so treat them as read-only
+        (use do_copy() for mutable results).
+        """
+        now = time.monotonic()
+        with self.lock:
+            call = self.calls.get(key)
+            if call is not None and call.done.is_set() and (call.error or now - call.finished_at > self.ttl):
+                call = None
+            if call is not None:
+                self.stats['coalesced'] += 1
+                leader = False
+            else:
+                self._prune(now)
+                call = _Call()
+                self.calls[key] = call
+                self.stats['calls'] += 1
+                leader = True
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            with self.lock:
+                if self.calls.get(key) is call:
+                    del self.calls[key]
+            raise
+        finally:
+            call.finished_at = time.monotonic()
+            call.done.set()
+
+    def do_copy(self, key: Hashable, fn: Callable[[], Any]) -> Any:
+        """Like do(), but each caller gets its own deep copy of the result"""
+        return copy.deepcopy(self.do(key, fn))
+
+    def _prune(self, now: float):
+        """Drop finished calls whose TTL has passed (called with the lock held)"""
+        expired = [
+            key for key, call in self.calls.items()
+            if call.done.is_set() and now - call.finished_at > self.ttl
+        ]
+        for key in expired:
+            del self.calls[key]
+
+
+# Shared by provider clients; keys are (provider, operation, id)
+provider_calls = SingleFlight(getattr(settings, 'PROVIDER_COALESCE_TTL', 2.0))
@@ -0,0 +1,359 @@
+"""
+Centralized MTelSMS Poller
+A single long-running process owns every WAITING rental, polls MTelSMS on a
+schedule tuned to the rental's age and stores the outcome locally, so that
+dashboard and API reads never have to call the provider themselves.
+
+While live updates are enabled (app/live_updates.py) it also refreshes
+pending 5sim orders every LIVE_UPDATES_FIVESIM_REFRESH seconds (default 5),
+once for all users, so the live update streams never call 5sim themselves.
+
+Only one poller is active at a time: run_sms_poller holds its lease
+(app/leases.py) and fences every cancel, code and refund write with it.
+"""
+
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from typing import Dict, List, Optional
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+
+from .models import Rental, SMSMessage
+from .api_models import APIOrderMapping
+from .mtelsms import MTelSMSClient, get_mtelsms_client, MTelSMSException
+from .fivesim_sync import merge_order_result
+from .leases import fence
+from .live_updates import live_updates_enabled, pending_fivesim_orders
+from .refunds import queue_rental_refund, apply_refunds
+from .webhooks import emit_order_event, emit_status_event
+
+logger = logging.getLogger(__name__)
+
+# (maximum rental age in seconds, poll interval in seconds)
+# Fresh rentals are polled aggressively because that is when codes arrive;
+# older ones back off since they are close to auto-cancel or expiry.
+DEFAULT_POLL_SCHEDULE = [
+    (60, 3),
+    (300, 5),
+    (900, 15),
+    (None, 30),
+]
+
+# Rentals that have not received an SMS after this long are cancelled and refunded
+AUTO_CANCEL_AFTER = timedelta(minutes=5)
+
+# MTelSMS error messages that mean the activation no longer exists upstream
+EXPIRED_KEYWORDS = [
+    'invalid service id',
+    'record expired',
+    'expired',
+    'not found',
+    'invalid id',
+    'invalid request',
+    'no such',
+    'does not exist'
+]
+
+# How long the last known provider state for a rental is kept in the cache
+STATUS_CACHE_TIMEOUT = 60 * 60
+
+
+def rental_status_cache_key(rental_id: str) -> str:
+    """Cache key holding the last provider state seen for a rental"""
+    return f"mtelsms_rental_status_{rental_id}"
+
+
+def get_cached_rental_status(rental_id: str) -> Optional[Dict]:
+    """
+    Get the last provider state recorded by the poller for a rental
+
+    Returns:
+        Dict with status, time_remaining and checked_at, or None if the
+        poller has not seen this rental yet
+    """
+    return cache.get(rental_status_cache_key(rental_id))
+
+
+def is_expired_error(error_message: str) -> bool:
+    """Check if an MTelSMS error means the rental no longer exists upstream"""
+    error_message = error_message.lower()
+    return any(keyword in error_message for keyword in EXPIRED_KEYWORDS)
+
+
+class SMSPoller:
+    """
+    Polls MTelSMS for every WAITING rental and applies the results
+    """
+
+    def __init__(self, client: Optional[MTelSMSClient] = None, max_workers: int = None,
+                 schedule: Optional[List] = None, dry_run: bool = False):
+        self.client = client or get_mtelsms_client()
+        self.max_workers = max_workers or getattr(settings, 'SMS_POLLER_MAX_WORKERS', 8)
+        self.schedule = schedule or getattr(settings, 'SMS_POLLER_SCHEDULE', DEFAULT_POLL_SCHEDULE)
+        self.dry_run = dry_run
+        self.next_poll_at = {}  # rental_id -> monotonic time of next poll
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        self.fivesim_refresh_interval = getattr(settings, 'LIVE_UPDATES_FIVESIM_REFRESH', 5)
+        self.next_fivesim_refresh = 0.0
+        self.fivesim_api = None
+        self.lease = None  # Held Lease fencing writes, if any
+        self.stats = {
+            'polled': 0,
+            'received': 0,
+            'expired': 0,
+            'cancelled': 0,
+            'errors': 0,
+            'fivesim_refreshed': 0,
+        }
+
+    def poll_interval(self, rental: Rental) -> int:
+        """Get the poll interval in seconds for a rental based on its age"""
+        age_seconds = (timezone.now() - rental.created_at).total_seconds()
+        for max_age, interval in self.schedule:
+            if max_age is None or age_seconds < max_age:
+                return interval
+        return self.schedule[-1][1]
+
+    def due_rentals(self) -> List[Rental]:
+        """Get WAITING rentals whose next poll time has passed"""
+        rentals = list(
+            Rental.objects.filter(status='WAITING', refunded=False).select_related('user')
+        )
+
+        # Forget rentals that left the WAITING state (handled elsewhere or by us)
+        active_ids = {rental.rental_id for rental in rentals}
+        for rental_id in list(self.next_poll_at):
+            if rental_id not in active_ids:
+                del self.next_poll_at[rental_id]
+
+        now = time.monotonic()
+        return [rental for rental in rentals if self.next_poll_at.get(rental.rental_id, 0) <= now]
+
+    def run_once(self) -> int:
+        """
+        Poll every due rental once
+
+        Returns:
+            int: Number of rentals polled
+        """
+        close_old_connections()
+        due = self.due_rentals()
+        if not due:
+            return 0
+
+        # Upstream calls run concurrently; database writes stay on this thread
+        results = self.executor.map(self._fetch, due)
+        for rental, result, error in results:
+            self.next_poll_at[rental.rental_id] = time.monotonic() + self.poll_interval(rental)
+            try:
+                self.apply(rental, result, error)
+            except Exception as e:
+                self.stats['errors'] += 1
+                logger.error(f"SMS poller failed to apply result for rental {rental.rental_id}: {str(e)}")
+
+        # Refunds queued by this pass are credited in one batch
+        if not self.dry_run:
+            apply_refunds()
+
+        self.stats['polled'] += len(due)
+        return len(due)
+
+    def run_forever(self, tick: float = 1.0, lease=None):
+        """
+        Main poller loop
+
+        With a lease, returns once the lease was lost (another instance took
+        over) so the caller can stand by again.
+        """
+        self.lease = lease
+        logger.info(f"SMS poller started with {self.max_workers} workers")
+        while lease is None or not lease.lost:
+            try:
+                self.run_once()
+            except Exception as e:
+                logger.error(f"Unexpected error in SMS poller: {str(e)}")
+            try:
+                if time.monotonic() >= self.next_fivesim_refresh:
+                    self.next_fivesim_refresh = time.monotonic() + self.fivesim_refresh_interval
+                    self.refresh_fivesim_orders()
+            except Exception as e:
+                logger.error(f"Unexpected error refreshing 5sim orders: {str(e)}")
+            time.sleep(tick)
+
+    def refresh_fivesim_orders(self) -> int:
+        """
+        Check every pending 5sim order with 5sim once, for the live update
+        streams (does nothing while they are disabled: the dashboards then
+        poll the order status view, which checks the order itself)
+
+        Returns:
+            int: Number of orders checked
+        """
+        api_key = getattr(settings, 'FIVESIM_API_KEY', None)
+        if not api_key or self.dry_run or not live_updates_enabled():
+            return 0
+        close_old_connections()
+        orders = list(pending_fivesim_orders())
+        if not orders:
+            return 0
+
+        if self.fivesim_api is None:
+            from .fivesim import FiveSimAPI
+            self.fivesim_api = FiveSimAPI(api_key)
+
+        def check(order):
+            try:
+                return order, self.fivesim_api.check_order(order.order_id), None
+            except Exception as e:
+                return order, None, e
+
+        # Upstream calls run concurrently; database writes stay on this thread
+        for order, result, error in self.executor.map(check, orders):
+            if error is not None:
+                self.stats['errors'] += 1
+                logger.warning(f"5sim refresh failed for order {order.order_id}: {str(error)}")
+                continue
+            try:
+                merge_order_result(order, result)
+            except Exception as e:
+                self.stats['errors'] += 1
+                logger.error(f"SMS poller failed to apply 5sim order {order.order_id}: {str(e)}")
+
+        self.stats['fivesim_refreshed'] += len(orders)
+        return len(orders)
+
+    def poll_rental(self, rental: Rental):
+        """Poll and apply a single rental now (used by the deadline scheduler)"""
+        rental, result, error = self._fetch(rental)
+        self.apply(rental, result, error)
+        if not self.dry_run:
+            apply_refunds()
+
+    def _fetch(self, rental: Rental):
+        """Call MTelSMS for a single rental (runs on a worker thread)"""
+        try:
+            return rental, self.client.get_code(rental_id=rental.rental_id), None
+        except Exception as e:
+            # Returned, not raised: one failure must not abort the whole pass
+            return rental, None, e
+
+    def apply(self, rental: Rental, result, error: Optional[Exception]):
+        """Apply a get_code result (or error) to the local database"""
+        if error is not None:
+            error_msg = str(error)
+            if is_expired_error(error_msg):
+                logger.info(f"Detected expired rental {rental.rental_id} from error: {error_msg}")
+                self._finalize(
+                    rental, 'EXPIRED',
+                    f'Automatic refund: Rental expired on provider - {rental.phone_number}'
+                )
+            else:
+                self.stats['errors'] += 1
+                logger.warning(f"MTelSMS error for rental {rental.rental_id}: {error_msg}")
+            return
+
+        status, code, phone_number, time_remaining = result
+        if status == 'WAITING' and not self.dry_run:
+            rental.record_time_remaining(time_remaining)
+        cache.set(rental_status_cache_key(rental.rental_id), {
+            'status': status,
+            'time_remaining': time_remaining,
+            'checked_at': timezone.now().isoformat(),
+        }, STATUS_CACHE_TIMEOUT)
+
+        if status == 'RECEIVED' and code:
+            self._mark_received(rental, code)
+            return
+
+        if status != 'WAITING':
+            return
+
+        if time_remaining <= 0:
+            logger.info(f"Rental {rental.rental_id} has expired (time_remaining={time_remaining})")
+            self._finalize(
+                rental, 'EXPIRED',
+                f'Automatic refund for expired rental {rental.phone_number}'
+            )
+        elif timezone.now() - rental.created_at >= AUTO_CANCEL_AFTER:
+            self._auto_cancel(rental)
+
+    def _mark_received(self, rental: Rental, code: str):
+        """Store a received SMS code"""
+        if self.dry_run:
+            logger.info(f"[DRY RUN] Would store SMS for rental {rental.rental_id}: {code}")
+            return
+
+        with transaction.atomic():
+            updated = Rental.objects.filter(pk=rental.pk, status='WAITING').update(
+                status='RECEIVED', updated_at=timezone.now()
+            )
+            if not updated:
+                logger.info(f"Rental {rental.rental_id} is no longer WAITING, not storing SMS")
+                return
+            fence(self.lease)
+            APIOrderMapping.objects.filter(rental=rental).update(status='RECEIVED')
+            SMSMessage.objects.get_or_create(
+                rental=rental,
+                code=code,
+                defaults={'full_text': code}  # MTelSMS returns code only, not full text
+            )
+            rental.status = 'RECEIVED'
+            emit_order_event('sms_received', rental, code=code)
+
+        self.stats['received'] += 1
+        logger.info(f"SMS received for rental {rental.rental_id}")
+
+    def _auto_cancel(self, rental: Rental):
+        """Cancel a rental that has not received an SMS after AUTO_CANCEL_AFTER"""
+        if self.dry_run:
+            logger.info(f"[DRY RUN] Would auto-cancel rental {rental.rental_id}")
+            return
+
+        logger.info(f"Auto-cancelling rental {rental.rental_id} after 5 minutes with no SMS")
+        fence(self.lease)  # Don't cancel upstream for a poller that was replaced
+        try:
+            cancel_success = self.client.cancel_rental(rental_id=rental.rental_id)
+        except MTelSMSException as e:
+            logger.error(f"MTelSMS error during auto-cancel of {rental.rental_id}: {str(e)}")
+            return
+
+        if not cancel_success:
+            logger.warning(f"Failed to cancel rental {rental.rental_id} with MTelSMS after 5 minutes")
+            return
+
+        self._finalize(
+            rental, 'CANCELLED',
+            f'Auto-refund: No SMS after 5 minutes - {rental.phone_number}'
+        )
+
+    def _finalize(self, rental: Rental, status: str, description: str):
+        """Move a rental to a final status and queue its refund exactly once"""
+        if self.dry_run:
+            logger.info(f"[DRY RUN] Would mark rental {rental.rental_id} as {status} and refund")
+            return
+
+        with transaction.atomic():
+            # Reload rental with lock to prevent race conditions
+            rental = Rental.objects.select_for_update().get(pk=rental.pk)
+
+            # Check if already refunded (double-refund protection)
+            if rental.refunded:
+                logger.info(f"Rental {rental.rental_id} already refunded, skipping")
+                return
+
+            fence(self.lease)
+            rental.status = status
+            rental.refunded = True
+            rental.save()
+
+            APIOrderMapping.objects.filter(rental=rental).update(status=status)
+            emit_status_event(rental)
+            queue_rental_refund(rental, description)
+
+        self.stats['expired' if status == 'EXPIRED' else 'cancelled'] += 1
+        logger.info(f"Rental {rental.rental_id} marked {status}, refund of ₦{rental.price} queued")
@@ -0,0 +1,116 @@
+"""
+Sold-Out Cache
+Remembers for a short time that a provider had no numbers for a product
+(MTelSMS "No number right now", 5sim "no free phones"), so the next buyers
+get that answer straight away instead of repeating the same upstream call.
+
+- Entries are keyed by (provider, product, country, operator): MTelSMS
+  products are Service codes (country and operator 'any'), 5sim ones are
+  5sim product, country and operator names
+- Entries live in the 'shared' cache, so every web worker sees them
+- Each entry expires after NO_NUMBERS_TTL seconds (default 60) moved by up to
+  NO_NUMBERS_TTL_JITTER (default 0.25) of that, so combinations marked
+  together don't all become buyable (and get retried) at the same moment
+- An index of current entries is kept for the Service admin page; it is
+  read-modify-write, so under concurrent marks it can miss an entry, but the
+  suppression itself never depends on it
+"""
+
+import logging
+import random
+import time
+from typing import Dict, List, Optional
+
+from django.conf import settings
+from django.core.cache import caches
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = 'no_numbers:'
+INDEX_KEY = 'no_numbers:index'
+INDEX_TIMEOUT = 24 * 60 * 60
+
+
+def _cache():
+    return caches['shared']
+
+
+def _key(provider: str, product: str, country: str = 'any', operator: str = 'any') -> str:
+    return f"{KEY_PREFIX}{provider}:{country}:{operator}:{product}".lower().replace(' ', '_')
+
+
+def _ttl() -> float:
+    ttl = getattr(settings, 'NO_NUMBERS_TTL', 60)
+    jitter = getattr(settings, 'NO_NUMBERS_TTL_JITTER', 0.25)
+    return ttl * random.uniform(1 - jitter, 1 + jitter)
+
+
+def is_sold_out(provider: str, product: str, country: str = 'any', operator: str = 'any') -> bool:
+    """Whether the provider recently had no numbers for this product"""
+    try:
+        return _cache().get(_key(provider, product, country, operator)) is not None
+    except Exception as e:
+        logger.debug(f"Sold-out cache unavailable: {str(e)}")
+        return False
+
+
+def mark_sold_out(provider: str, product: str, country: str = 'any', operator: str = 'any', reason: str = ''):
+    """Record a "no numbers" answer so purchases skip this combination for a while"""
+    ttl = _ttl()
+    key = _key(provider, product, country, operator)
+    entry = {
+        'provider': provider,
+        'product': product,
+        'country': country,
+        'operator': operator,
+        'reason': reason[:200],
+        'until': time.time() + ttl,
+    }
+    try:
+        _cache().set(key, entry, int(ttl) + 1)
+        index = _live(_cache().get(INDEX_KEY) or {})
+        index[key] = entry
+        _cache().set(INDEX_KEY, index, INDEX_TIMEOUT)
+    except Exception as e:
+        logger.debug(f"Could not record sold-out {key}: {str(e)}")
+        return
+    logger.info(f"{provider} has no numbers for {country}/{operator}/{product}, not offered for {ttl:.0f}s")
+
+
+def _live(index: Dict[str, Dict]) -> Dict[str, Dict]:
+    now = time.time()
+    return {key: entry for key, entry in index.items() if entry['until'] > now}
+
+
+def sold_out_list() -> List[Dict]:
+    """Combinations currently suppressed, soonest to expire first (for admins)"""
+    try:
+        index = _cache().get(INDEX_KEY) or {}
+    except Exception:
+        return []
+    entries = [dict(entry, key=key) for key, entry in _live(index).items()]
+    return sorted(entries, key=lambda entry: entry['until'])
+
+
+def clear_sold_out(provider: Optional[str] = None, product: Optional[str] = None) -> int:
+    """
+    Lift suppressions early, optionally only for one provider and/or product
+
+    Returns:
+        Number of entries cleared
+    """
+    try:
+        index = _live(_cache().get(INDEX_KEY) or {})
+        cleared = [
+            key for key, entry in index.items()
+            if (provider is None or entry['provider'] == provider)
+            and (product is None or entry['product'].lower() == product.lower())
+        ]
+        for key in cleared:
+            _cache().delete(key)
+            index.pop(key)
+        _cache().set(INDEX_KEY, index, INDEX_TIMEOUT)
+    except Exception as e:
+        logger.warning(f"Could not clear sold-out entries: {str(e)}")
+        return 0
+    return len(cleared)
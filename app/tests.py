@@ -1,3 +1,568 @@
-from django.test import TestCase
+import io
+import time
+from datetime import timedelta
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.core.management import call_command, load_command_class
+from django.db.models.query import QuerySet
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from . import pricing_index, routing
+from .api_models import APIWebhook, WebhookDelivery
+from .balance_ops import InsufficientBalance, debit
+from .deadline_scheduler import RENTAL_CANCEL, RENTAL_EXPIRE, RETRY_DELAY, DeadlineScheduler
+from .leases import LeaseLost, acquire_lease, wait_for_lease
+from .models import JobLease, PurchaseReservation, RefundIntent, Rental, Service, SMSMessage, Transaction, UserProfile
+from .operator_stats import LATENCY_BUCKETS, percentile
+from .provider_cache import provider_cache
+from .providers import NoNumbers, Offer, Product, ProviderFailed, ProviderUnreachable, Purchase
+from .purchase_pipeline import (
+    ReservationNotHeld, confirm_reservation, recover_stale_reservations, release_reservation, reserve_funds,
+)
+from .refunds import apply_refunds, queue_refund, queue_refunds
+from .sms_poller import SMSPoller
+from .unified_korapay import process_successful_payment
+from .webhooks import WebhookDispatcher
+
+
+LOCMEM_CACHES = {
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'tests-default'},
+    'shared': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'tests-shared'},
+}
+
+
+def make_rental(user, rental_id='rent-1', **fields):
+    service, _ = Service.objects.get_or_create(code='testsvc', defaults={'name': 'Test', 'price': Decimal('0.50')})
+    fields.setdefault('price', Decimal('800.00'))
+    return Rental.objects.create(user=user, rental_id=rental_id, service=service, phone_number='+15550001', **fields)
+
+
+class RefundLedgerTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('refunds', password='pw')
+        UserProfile.objects.create(user=self.user, balance=Decimal('100.00'))
+
+    def intent(self, key='fivesim:1001', amount='250.00'):
+        return RefundIntent(key=key, user=self.user, amount=Decimal(amount), description='Test refund')
+
+    def balance(self):
+        return UserProfile.objects.get(user=self.user).balance
+
+    def test_same_key_twice_refunds_once(self):
+        self.assertTrue(queue_refund(self.intent()))
+        self.assertFalse(queue_refund(self.intent()))
+
+        self.assertEqual(apply_refunds(), 1)
+        self.assertEqual(apply_refunds(), 0)
+        self.assertEqual(self.balance(), Decimal('350.00'))
+        self.assertEqual(Transaction.objects.filter(user=self.user, transaction_type='REFUND').count(), 1)
+
+    def test_same_key_queued_again_after_apply(self):
+        queue_refund(self.intent())
+        apply_refunds()
+
+        self.assertFalse(queue_refund(self.intent()))
+        queue_refunds([self.intent(), self.intent(key='fivesim:1002', amount='50.00')])
+        self.assertEqual(apply_refunds(), 1)
+        self.assertEqual(self.balance(), Decimal('400.00'))
+
+    def test_apply_keys_from_generator_covers_every_batch(self):
+        keys = [f'fivesim:{n}' for n in range(5)]
+        queue_refunds([self.intent(key=key, amount='10.00') for key in keys])
+
+        self.assertEqual(apply_refunds(keys=(key for key in keys), limit=2), 5)
+        self.assertEqual(self.balance(), Decimal('150.00'))
+
+
+class BalanceOpsTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('balance', password='pw')
+        UserProfile.objects.create(user=self.user, balance=Decimal('100.00'))
+
+    def balance(self):
+        return UserProfile.objects.get(user=self.user).balance
+
+    def test_debit_short_balance_writes_nothing(self):
+        with self.assertRaises(InsufficientBalance) as raised:
+            debit(self.user.pk, Decimal('150.00'), 'RENTAL', 'Too expensive')
+
+        self.assertEqual(raised.exception.available, Decimal('100.00'))
+        self.assertEqual(self.balance(), Decimal('100.00'))
+        self.assertFalse(Transaction.objects.filter(user=self.user).exists())
+
+    def test_debit_records_transaction(self):
+        debit(self.user.pk, Decimal('40.00'), 'RENTAL', 'Rental')
+
+        self.assertEqual(self.balance(), Decimal('60.00'))
+        self.assertEqual(Transaction.objects.get(user=self.user).amount, Decimal('40.00'))
+
+    def test_confirm_below_hold_credits_difference(self):
+        reservation = reserve_funds(self.user, Decimal('60.00'), 'mtelsms')
+        confirm_reservation(reservation, lambda: None, final_amount=Decimal('45.00'))
+
+        self.assertEqual(self.balance(), Decimal('55.00'))
+        self.assertEqual(PurchaseReservation.objects.get(pk=reservation.pk).amount, Decimal('45.00'))
+
+    def test_confirm_above_hold_debits_difference(self):
+        reservation = reserve_funds(self.user, Decimal('60.00'), 'mtelsms')
+        confirm_reservation(reservation, lambda: None, final_amount=Decimal('80.00'))
+
+        self.assertEqual(self.balance(), Decimal('20.00'))
+        self.assertEqual(reservation.status, 'CONFIRMED')
+
+    def test_confirm_above_hold_short_balance_keeps_hold(self):
+        reservation = reserve_funds(self.user, Decimal('60.00'), 'mtelsms')
+        create_records = mock.Mock()
+
+        with self.assertRaises(InsufficientBalance) as raised:
+            confirm_reservation(reservation, create_records, final_amount=Decimal('120.00'))
+
+        self.assertEqual(raised.exception.available, Decimal('100.00'))
+        create_records.assert_not_called()
+        self.assertEqual(self.balance(), Decimal('40.00'))
+        self.assertEqual(PurchaseReservation.objects.get(pk=reservation.pk).status, 'HELD')
+
+
+class KoraPayCreditTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('korapay', password='pw')
+        UserProfile.objects.create(user=self.user, balance=Decimal('0.00'))
+        self.deposit = Transaction.objects.create(
+            user=self.user, amount=Decimal('5000.00'), transaction_type='DEPOSIT',
+            payment_reference='KPY-TEST-1', status='PENDING',
+        )
+
+    def balance(self):
+        return UserProfile.objects.get(user=self.user).balance
+
+    def test_second_call_credits_nothing(self):
+        self.assertTrue(process_successful_payment('KPY-TEST-1', {'amount': '5000.00'}))
+        self.assertTrue(process_successful_payment('KPY-TEST-1', {'amount': '5000.00'}))
+
+        self.assertEqual(self.balance(), Decimal('5000.00'))
+
+    def test_concurrent_call_that_read_pending_credits_nothing(self):
+        # The webhook and the callback both read the deposit while it was PENDING
+        stale = Transaction.objects.get(pk=self.deposit.pk)
+        self.assertTrue(process_successful_payment('KPY-TEST-1', {'amount': '5000.00'}))
+
+        with mock.patch.object(QuerySet, 'first', return_value=stale):
+            self.assertTrue(process_successful_payment('KPY-TEST-1', {'amount': '5000.00'}))
+
+        self.assertEqual(self.balance(), Decimal('5000.00'))
+        self.assertEqual(Transaction.objects.get(pk=self.deposit.pk).status, 'COMPLETED')
+
+
+class PurchaseReservationTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('reservations', password='pw')
+        UserProfile.objects.create(user=self.user, balance=Decimal('100.00'))
+
+    def balance(self):
+        return UserProfile.objects.get(user=self.user).balance
+
+    def stale_reservation(self, provider_order_id='rent-1'):
+        reservation = reserve_funds(self.user, Decimal('30.00'), 'MTELSMS')
+        reservation.provider_order_id = provider_order_id
+        reservation.save()
+        PurchaseReservation.objects.filter(pk=reservation.pk).update(
+            created_at=reservation.created_at - timedelta(minutes=30)
+        )
+        return reservation
+
+    def test_double_release_returns_funds_once(self):
+        reservation = reserve_funds(self.user, Decimal('30.00'), 'MTELSMS')
+
+        self.assertTrue(release_reservation(reservation, 'provider failed'))
+        self.assertFalse(release_reservation(reservation, 'provider failed'))
+        self.assertEqual(self.balance(), Decimal('100.00'))
+
+    def test_confirm_after_release_raises(self):
+        reservation = reserve_funds(self.user, Decimal('30.00'), 'MTELSMS')
+        release_reservation(reservation)
+        create_records = mock.Mock()
+
+        with self.assertRaises(ReservationNotHeld):
+            confirm_reservation(reservation, create_records)
+
+        create_records.assert_not_called()
+        self.assertEqual(self.balance(), Decimal('100.00'))
+
+    def test_stale_release_cancels_provider_order(self):
+        reservation = self.stale_reservation()
+        cancel = mock.Mock(return_value=True)
+
+        stats = recover_stale_reservations(timedelta(minutes=10), cancel)
+
+        cancel.assert_called_once_with('MTELSMS', 'rent-1')
+        self.assertEqual(stats['released'], 1)
+        self.assertEqual(stats['provider_cancelled'], 1)
+        self.assertEqual(PurchaseReservation.objects.get(pk=reservation.pk).status, 'RELEASED')
+        self.assertEqual(self.balance(), Decimal('100.00'))
+
+    def test_stale_release_keeps_hold_when_cancel_fails(self):
+        reservation = self.stale_reservation()
+
+        stats = recover_stale_reservations(timedelta(minutes=10), mock.Mock(return_value=False))
+
+        self.assertEqual(stats['released'], 0)
+        self.assertEqual(stats['errors'], 1)
+        self.assertEqual(PurchaseReservation.objects.get(pk=reservation.pk).status, 'HELD')
+        self.assertEqual(self.balance(), Decimal('70.00'))
+
+
+class SMSPollerTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('poller', password='pw')
+        UserProfile.objects.create(user=self.user, balance=Decimal('0.00'))
+        self.client = mock.Mock()
+        self.poller = SMSPoller(client=self.client, max_workers=1)
+
+    def tearDown(self):
+        self.poller.executor.shutdown()
+
+    def test_unexpected_fetch_error_is_counted_not_raised(self):
+        rental = make_rental(self.user)
+        self.client.get_code.side_effect = ValueError('Expecting value: line 1 column 1')
+
+        self.poller.poll_rental(rental)
+
+        self.assertEqual(self.poller.stats['errors'], 1)
+        self.assertEqual(Rental.objects.get(pk=rental.pk).status, 'WAITING')
+
+    def test_code_for_finished_rental_is_not_stored(self):
+        rental = make_rental(self.user, status='CANCELLED', refunded=True)
+
+        with mock.patch('app.sms_poller.emit_order_event') as emit:
+            self.poller.apply(rental, ('RECEIVED', '123456', rental.phone_number, 0), None)
+
+        emit.assert_not_called()
+        self.assertFalse(SMSMessage.objects.filter(rental=rental).exists())
+        self.assertEqual(Rental.objects.get(pk=rental.pk).status, 'CANCELLED')
+        self.assertEqual(self.poller.stats['received'], 0)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class PricingIndexTests(TestCase):
+    def setUp(self):
+        provider_cache.cache.clear()
+        self.api = mock.Mock()
+        self.api.get_all_prices.return_value = {}
+        pricing_index._index = None
+        pricing_index._index_version = None
+
+    def test_fresh_prices_skip_the_tree(self):
+        provider_cache.set(pricing_index.PRICES_CACHE_KEY, {}, ttl=600)
+        index = pricing_index.get_pricing_index(self.api)
+
+        self.assertIs(pricing_index.get_pricing_index(self.api), index)
+        self.assertEqual(self.api.get_all_prices.call_count, 1)
+
+    def test_stale_prices_go_through_get_all_prices(self):
+        provider_cache.set(pricing_index.PRICES_CACHE_KEY, {}, ttl=600, stale_ttl=600)
+        pricing_index.get_pricing_index(self.api)
+
+        provider_cache.cache.delete(provider_cache._fresh_key(pricing_index.PRICES_CACHE_KEY))
+        pricing_index.get_pricing_index(self.api)
+
+        self.assertEqual(self.api.get_all_prices.call_count, 2)
+
+
+@override_settings(CACHES=LOCMEM_CACHES, DEADLINE_MAX_RETRIES=2)
+class DeadlineSchedulerTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('deadlines', password='pw')
+        UserProfile.objects.create(user=self.user, balance=Decimal('0.00'))
+        self.client = mock.Mock()
+        self.client.get_code.return_value = ('WAITING', None, '+15550001', 600)
+        self.client.cancel_rental.return_value = False
+        self.poller = SMSPoller(client=self.client, max_workers=1)
+        self.scheduler = DeadlineScheduler(poller=self.poller, sweeper=mock.Mock())
+
+        self.rental = make_rental(self.user, expires_at=timezone.now() + timedelta(minutes=10))
+        Rental.objects.filter(pk=self.rental.pk).update(created_at=timezone.now() - timedelta(minutes=6))
+
+    def tearDown(self):
+        self.poller.executor.shutdown()
+
+    def run_next(self):
+        due = self.scheduler.heap[0][0]
+        with mock.patch('time.time', return_value=due + 1):
+            return self.scheduler.run_due()
+
+    def test_failed_cancel_is_retried_with_backoff(self):
+        self.scheduler.schedule(RENTAL_CANCEL, self.rental.rental_id, timezone.now())
+
+        self.run_next()
+        self.assertEqual(self.client.cancel_rental.call_count, 1)
+        self.assertEqual(self.scheduler.stats['retried'], 1)
+        self.assertIn((RENTAL_CANCEL, self.rental.rental_id), self.scheduler.scheduled)
+        self.assertNotIn((RENTAL_EXPIRE, self.rental.rental_id), self.scheduler.scheduled)
+        first_retry = self.scheduler.heap[0][0]
+        self.assertAlmostEqual(first_retry - time.time(), RETRY_DELAY.total_seconds(), delta=5)
+
+        self.client.cancel_rental.return_value = True
+        self.run_next()
+
+        rental = Rental.objects.get(pk=self.rental.pk)
+        self.assertEqual(rental.status, 'CANCELLED')
+        self.assertTrue(rental.refunded)
+        self.assertEqual(self.scheduler.stats['acted'], 1)
+        self.assertEqual(UserProfile.objects.get(user=self.user).balance, Decimal('800.00'))
+
+    def test_failed_cancel_gives_up_after_max_retries(self):
+        self.scheduler.schedule(RENTAL_CANCEL, self.rental.rental_id, timezone.now())
+
+        for _ in range(3):
+            self.run_next()
+
+        self.assertEqual(self.client.cancel_rental.call_count, 3)
+        self.assertEqual(self.scheduler.stats['gave_up'], 1)
+        self.assertEqual(self.scheduler.heap, [])
+        self.assertEqual(Rental.objects.get(pk=self.rental.pk).status, 'WAITING')
+
+    def test_extended_expiry_is_rescheduled(self):
+        self.scheduler.schedule(RENTAL_EXPIRE, self.rental.rental_id, timezone.now())
+        Rental.objects.filter(pk=self.rental.pk).update(created_at=timezone.now())
+
+        self.run_next()
+
+        self.assertEqual(self.scheduler.stats['retried'], 0)
+        self.assertIn((RENTAL_EXPIRE, self.rental.rental_id), self.scheduler.scheduled)
+
+
+class LeaseTests(TestCase):
+    def expire(self, name):
+        JobLease.objects.filter(name=name).update(expires_at=timezone.now() - timedelta(seconds=1))
+
+    def test_second_holder_waits_for_expiry(self):
+        first = acquire_lease('test-job', ttl=60, holder='host-a')
+        self.assertIsNone(acquire_lease('test-job', ttl=60, holder='host-b'))
+
+        self.expire('test-job')
+        second = acquire_lease('test-job', ttl=60, holder='host-b')
+
+        self.assertEqual(second.token, first.token + 1)
+
+    def test_assert_held_after_takeover_raises(self):
+        first = acquire_lease('test-job', ttl=60, holder='host-a')
+        first.assert_held()
+
+        self.expire('test-job')
+        acquire_lease('test-job', ttl=60, holder='host-b')
+
+        with self.assertRaises(LeaseLost):
+            first.assert_held()
+        self.assertTrue(first.lost)
+        self.assertFalse(first.renew())
+
+    def test_standby_takes_over_after_expiry(self):
+        acquire_lease('test-daemon', ttl=60, holder='host-a')
+
+        with mock.patch('app.leases.time.sleep', side_effect=lambda seconds: self.expire('test-daemon')) as sleep:
+            with wait_for_lease('test-daemon', ttl=60, retry_interval=1) as lease:
+                self.assertEqual(lease.token, 2)
+                lease.assert_held()
+        self.assertEqual(sleep.call_count, 1)
+
+    def test_poller_that_lost_its_lease_does_not_refund(self):
+        user = User.objects.create_user('fenced', password='pw')
+        UserProfile.objects.create(user=user, balance=Decimal('0.00'))
+        rental = make_rental(user)
+        poller = SMSPoller(client=mock.Mock(), max_workers=1)
+        self.addCleanup(poller.executor.shutdown)
+        poller.lease = acquire_lease('run_sms_poller', ttl=60, holder='host-a')
+        self.expire('run_sms_poller')
+        acquire_lease('run_sms_poller', ttl=60, holder='host-b')
+
+        with self.assertRaises(LeaseLost):
+            poller.apply(rental, ('WAITING', None, rental.phone_number, 0), None)
+
+        self.assertFalse(Rental.objects.get(pk=rental.pk).refunded)
+        self.assertFalse(RefundIntent.objects.exists())
+
+
+class ShardLeaseTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('shards', password='pw')
+        UserProfile.objects.create(user=self.user, balance=Decimal('0.00'))
+        self.rental = make_rental(self.user, expires_at=timezone.now() - timedelta(minutes=1))
+
+    def sweep(self, command=None, **options):
+        out = io.StringIO()
+        call_command(command or 'check_expired_rentals', stdout=out, **options)
+        return out.getvalue()
+
+    def test_sharded_run_waits_for_unsharded_run(self):
+        acquire_lease('check_expired_rentals', ttl=60, holder='host-a')
+
+        for shards in (4, 8):
+            output = self.sweep(shards=shards, shard_index=self.rental.pk % shards)
+            self.assertIn('Another instance holds the check_expired_rentals lease', output)
+        self.assertFalse(Rental.objects.get(pk=self.rental.pk).refunded)
+
+    def test_shard_worker_fences_with_supervisor_lease(self):
+        supervisor = acquire_lease('check_expired_rentals', ttl=60, holder='supervisor')
+        command = load_command_class('app', 'check_expired_rentals')
+        command.supervisor_lease = supervisor
+
+        self.sweep(command, shards=2, shard_index=self.rental.pk % 2)
+
+        self.assertTrue(Rental.objects.get(pk=self.rental.pk).refunded)
+
+    def test_shard_worker_stops_after_supervisor_lost_lease(self):
+        supervisor = acquire_lease('check_expired_rentals', ttl=60, holder='supervisor')
+        JobLease.objects.filter(name='check_expired_rentals').update(expires_at=timezone.now())
+        acquire_lease('check_expired_rentals', ttl=60, holder='host-b')
+        command = load_command_class('app', 'check_expired_rentals')
+        command.supervisor_lease = supervisor
+
+        self.sweep(command, shards=2, shard_index=self.rental.pk % 2)
+
+        self.assertFalse(Rental.objects.get(pk=self.rental.pk).refunded)
+        self.assertFalse(RefundIntent.objects.exists())
+
+
+class FakeProvider:
+    """Just enough of a provider (app/providers.py) for route_purchase()"""
+
+    def __init__(self, name, price, buy):
+        self.name = name
+        self.breaker = f'test-{name}'
+        self.buy_endpoint = 'buy'
+        self.price = Decimal(price)
+        self.buy = mock.Mock(side_effect=buy)
+        self.cancel = mock.Mock(return_value=True)
+
+    def offer(self, product):
+        return Offer(self, self.price)
+
+    def stock_key(self, product):
+        return ('testproduct', 'any', 'any')
+
+    def create_records(self, user, product, purchase):
+        return purchase.order_id
+
+
+def sells(price_naira):
+    def buy(product, offer):
+        return Purchase('order-1', '+15550001', Decimal('1'), Decimal(price_naira), timezone.now())
+    return buy
+
+
+def fails(error):
+    def buy(product, offer):
+        raise error
+    return buy
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class RoutingTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('routing', password='pw')
+        UserProfile.objects.create(user=self.user, balance=Decimal('5000.00'))
+
+    def route(self, *providers, max_price_naira=None):
+        registry = {provider.name: provider for provider in providers}
+        stats = {provider.name: routing.ProviderStats() for provider in providers}
+        product = Product(description='Test number', max_price_naira=max_price_naira)
+        with mock.patch.dict(routing.PROVIDERS, registry, clear=True), \
+                mock.patch.dict(routing._stats, stats, clear=True):
+            return routing.route_purchase(self.user, product)
+
+    def balance(self):
+        return UserProfile.objects.get(user=self.user).balance
+
+    def test_no_failover_after_provider_failed(self):
+        first = FakeProvider('first', '1000', fails(ProviderFailed('Read timed out')))
+        second = FakeProvider('second', '1100', sells('1100'))
+
+        with self.assertRaises(ProviderFailed):
+            self.route(first, second)
+
+        second.buy.assert_not_called()
+        self.assertEqual(self.balance(), Decimal('5000.00'))
+        self.assertEqual(PurchaseReservation.objects.get().status, 'RELEASED')
+
+    def test_failover_when_provider_unreachable(self):
+        first = FakeProvider('first', '1000', fails(ProviderUnreachable('Connection refused')))
+        second = FakeProvider('second', '1000', sells('1000'))
+
+        routed = self.route(first, second)
+
+        self.assertEqual(routed.provider, 'second')
+        self.assertEqual(routed.attempts, ['first', 'second'])
+        self.assertEqual(self.balance(), Decimal('4000.00'))
+
+    def test_offer_above_quote_needs_consent(self):
+        cheap = FakeProvider('cheap', '1000', fails(NoNumbers('No numbers')))
+        pricey = FakeProvider('pricey', '1500', sells('1500'))
+
+        with self.assertRaises(routing.PriceAboveQuote) as raised:
+            self.route(cheap, pricey, max_price_naira=Decimal('1000'))
+
+        self.assertEqual(raised.exception.price_naira, Decimal('1500'))
+        pricey.buy.assert_not_called()
+        self.assertEqual(self.balance(), Decimal('5000.00'))
+
+    def test_sold_out_provider_is_skipped_next_time(self):
+        first = FakeProvider('first', '1000', fails(NoNumbers('No numbers')))
+        second = FakeProvider('second', '1200', sells('1200'))
+        self.route(first, second)
+
+        self.route(first, second)
+
+        self.assertEqual(first.buy.call_count, 1)
+        self.assertEqual(second.buy.call_count, 2)
+
+    def test_charge_capped_at_agreed_price(self):
+        provider = FakeProvider('only', '1000', sells('1300'))
+
+        routed = self.route(provider, max_price_naira=Decimal('1000'))
+
+        self.assertEqual(routed.purchase.price_naira, Decimal('1000'))
+        self.assertEqual(self.balance(), Decimal('4000.00'))
+
+
+class WebhookClaimTests(TestCase):
+    def setUp(self):
+        user = User.objects.create_user('webhooks', password='pw')
+        webhook = APIWebhook.objects.create(user=user, url='https://example.com/hook', secret='s3cret')
+        for order_id in ('api-1', 'api-2'):
+            WebhookDelivery.objects.create(
+                webhook=webhook, event='sms_received', payload={'order_id': order_id},
+                dedupe_key=f'{webhook.id}:sms_received:{order_id}',
+            )
+
+    def test_claimed_deliveries_are_not_claimed_again(self):
+        first, second = WebhookDispatcher(), WebhookDispatcher()
+
+        self.assertEqual(len(first.claim()), 2)
+        self.assertEqual(second.claim(), [])
+
+    def test_claim_expires_with_its_lease(self):
+        dispatcher = WebhookDispatcher()
+        dispatcher.claim()
+
+        WebhookDelivery.objects.update(next_attempt_at=timezone.now() - timedelta(seconds=1))
+
+        self.assertEqual(len(WebhookDispatcher().claim()), 2)
+
+
+class OperatorStatsTests(TestCase):
+    def test_percentile_interpolates_within_bucket(self):
+        buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        buckets[1] = 10  # 5-10s
+
+        self.assertEqual(percentile(buckets, 0.5), 7.5)
+        self.assertEqual(percentile(buckets, 1.0), 10.0)
+
+    def test_percentile_of_slowest_bucket_reports_last_bound(self):
+        buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        buckets[-1] = 3
+
+        self.assertEqual(percentile(buckets, 0.9), float(LATENCY_BUCKETS[-1]))
+        self.assertIsNone(percentile([0] * len(buckets), 0.5))
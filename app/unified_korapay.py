@@ -7,10 +7,12 @@ from decimal import Decimal
 import json
 import logging
 
-from .models import UserProfile, Transaction
+from .models import Transaction
 from .korapay import KoraPayClient
+from .balance_ops import credit
 
 logger = logging.getLogger(__name__)
+debug_log = logging.getLogger(f"{__name__}.debug")
 
 @csrf_exempt
 @require_http_methods(["GET", "POST"])
@@ -19,11 +21,9 @@ def unified_korapay_handler(request):
     Unified handler for both KoraPay webhook and callback
     This handles both redirect (GET) and webhook (POST) from KoraPay
     """
-    # Write to a debug file so we can see what's happening
-    debug_file = open('korapay_debug.txt', 'a')
-    debug_file.write(f"\n=== KORAPAY UNIFIED CALLED ===\n")
-    debug_file.write(f"Method: {request.method}\n")
-    debug_file.write(f"Time: {str(__import__('datetime').datetime.now())}\n")
+    # Trace to korapay_debug.txt (queued, written by a background thread)
+    debug_log.debug("=== KORAPAY UNIFIED CALLED ===")
+    debug_log.debug(f"Method: {request.method}")
     
     try:
         logger.info(f"=== KORAPAY UNIFIED HANDLER CALLED ===")
@@ -36,8 +36,7 @@ def unified_korapay_handler(request):
             # This is a user redirect - don't process payment, just redirect to success
             tx_ref = request.GET.get('reference')
             logger.info(f"GET redirect for reference: {tx_ref} - redirecting user to wallet")
-            debug_file.write(f"GET redirect: {tx_ref} - NO PROCESSING, just redirect\n")
-            debug_file.close()
+            debug_log.debug(f"GET redirect: {tx_ref} - NO PROCESSING, just redirect")
             
             if tx_ref:
                 # Redirect to wallet with success message
@@ -47,13 +46,13 @@ def unified_korapay_handler(request):
         
         # POST method - this is the webhook from KoraPay, process the payment
         logger.info("POST webhook - PROCESSING PAYMENT")
-        debug_file.write("POST webhook - PROCESSING PAYMENT\n")
+        debug_log.debug("POST webhook - PROCESSING PAYMENT")
         
         # Extract transaction reference and amount from webhook
         try:
             body_raw = request.body.decode('utf-8')
             logger.info(f"POST body raw: {body_raw}")
-            debug_file.write(f"POST body: {body_raw}\n")
+            debug_log.debug(f"POST body: {body_raw}")
             
             if body_raw:
                 body_data = json.loads(body_raw)
@@ -82,7 +81,7 @@ def unified_korapay_handler(request):
                 status = request.POST.get('status')
                 verification_data = {'status': status}
                 logger.info(f"POST form data: {dict(request.POST)}")
-                debug_file.write(f"POST form: {dict(request.POST)}\n")
+                debug_log.debug(f"POST form: {dict(request.POST)}")
                 
         except json.JSONDecodeError as e:
             logger.error(f"JSON decode error: {e}")
@@ -91,41 +90,37 @@ def unified_korapay_handler(request):
             status = request.POST.get('status')
             verification_data = {'status': status}
             logger.info(f"POST form data fallback: {dict(request.POST)}")
-            debug_file.write(f"POST form fallback: {dict(request.POST)}\n")
+            debug_log.debug(f"POST form fallback: {dict(request.POST)}")
         
-        debug_file.write(f"Reference: {tx_ref}, Status: {status}\n")
+        debug_log.debug(f"Reference: {tx_ref}, Status: {status}")
         logger.info(f"Extracted - Reference: {tx_ref}, Status: {status}")
         
         if not tx_ref:
             logger.error("❌ No transaction reference found in webhook")
-            debug_file.write("ERROR: No reference found\n")
-            debug_file.close()
+            debug_log.debug("ERROR: No reference found")
             return JsonResponse({'error': 'No reference found'}, status=400)
         
         logger.info(f"✅ Processing webhook payment: {tx_ref}")
-        debug_file.write(f"PROCESSING WEBHOOK: {tx_ref}\n")
+        debug_log.debug(f"PROCESSING WEBHOOK: {tx_ref}")
         
         # Process the payment via webhook
         success = process_successful_payment(tx_ref, verification_data)
-        debug_file.write(f"Result: {'SUCCESS' if success else 'FAILED'}\n")
+        debug_log.debug(f"Result: {'SUCCESS' if success else 'FAILED'}")
         
         if success:
             logger.info(f"✅ Webhook payment {tx_ref} processed successfully")
-            debug_file.write("FINAL: Webhook payment processed successfully\n")
-            debug_file.close()
+            debug_log.debug("FINAL: Webhook payment processed successfully")
             return JsonResponse({'status': 'success', 'message': 'Payment processed via webhook'})
         else:
             logger.error(f"❌ Failed to process webhook payment {tx_ref}")
-            debug_file.write("FINAL: Webhook processing failed\n")
-            debug_file.close()
+            debug_log.debug("FINAL: Webhook processing failed")
             return JsonResponse({'status': 'error', 'message': 'Webhook processing failed'})
                 
     except Exception as e:
         logger.error(f"💥 EXCEPTION in unified handler: {str(e)}")
         import traceback
         logger.error(f"Traceback: {traceback.format_exc()}")
-        debug_file.write(f"EXCEPTION: {str(e)}\n")
-        debug_file.close()
+        debug_log.debug(f"EXCEPTION: {str(e)}")
         
         if request.method == 'GET':
             return redirect('/wallet/?error=callback_error')
@@ -135,46 +130,23 @@ def unified_korapay_handler(request):
 def process_successful_payment(tx_ref, verification_result):
     """Process a successful payment and update user balance"""
     try:
-        # Extract user ID from transaction reference
-        user_id = None
-        if tx_ref.startswith('YPG_'):
-            try:
-                user_id = int(tx_ref.split('_')[1])
-            except (IndexError, ValueError):
-                logger.warning(f"Could not extract user ID from tx_ref: {tx_ref}")
-        
-        # Find the pending transaction
+        # Find the deposit by its payment reference (unique index)
         pending_transaction = Transaction.objects.filter(
-            transaction_type='DEPOSIT',
-            description__icontains=tx_ref
+            payment_reference=tx_ref,
+            transaction_type='DEPOSIT'
         ).first()
         
-        if not pending_transaction and user_id:
-            # Fallback search by user ID
-            from django.contrib.auth.models import User
-            try:
-                user = User.objects.get(id=user_id)
-                pending_transaction = Transaction.objects.filter(
-                    user=user,
-                    transaction_type='DEPOSIT',
-                    description__icontains='Pending'
-                ).order_by('-id').first()
-            except User.DoesNotExist:
-                logger.error(f"User with ID {user_id} not found")
-        
         if not pending_transaction:
             logger.error(f"No pending transaction found for {tx_ref}")
             return False
         
         # Check if already processed
-        if pending_transaction.description.startswith("Wallet funded via Kora Pay - ₦"):
+        if pending_transaction.status != 'PENDING':
             logger.info(f"Transaction {tx_ref} already processed")
             return True
         
         # Process the payment
         with transaction.atomic():
-            profile = UserProfile.objects.get(user=pending_transaction.user)
-            
             # Determine the correct amount to credit
             if verification_result.get('amount'):
                 # Use the exact amount from KoraPay webhook (what user actually paid)
@@ -188,17 +160,20 @@ def process_successful_payment(tx_ref, verification_result):
             # Credit balance - exact amount paid
             amount_decimal = Decimal(str(amount_ngn))
             
-            # Credit in NGN (the exact amount user paid)
-            profile.balance += amount_decimal
-            profile.save()
-            
-            # Update transaction description to prevent double processing
-            pending_transaction.description = f"Wallet funded via Kora Pay - ₦{amount_ngn:,.2f}"
-            pending_transaction.save()
+            # Complete the transaction first; only the webhook/callback whose
+            # UPDATE still finds it PENDING credits the balance
+            claimed = Transaction.objects.filter(pk=pending_transaction.pk, status='PENDING').update(
+                status='COMPLETED',
+                description=f"Wallet funded via Kora Pay - ₦{amount_ngn:,.2f}"
+            )
+            if not claimed:
+                logger.info(f"Transaction {tx_ref} already processed")
+                return True
             
-            logger.info(f"Successfully credited ₦{amount_ngn} to user {pending_transaction.user.id} (Balance: ₦{profile.balance})")
+            # Credit in NGN (the exact amount user paid)
+            credit(pending_transaction.user_id, amount_decimal)
         
-        logger.info(f"Successfully credited ₦{amount_ngn} to user {pending_transaction.user.id}")
+        logger.info(f"Successfully credited ₦{amount_ngn} to user {pending_transaction.user_id}")
         return True
         
     except Exception as e:
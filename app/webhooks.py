@@ -0,0 +1,236 @@
+"""
+Reseller Webhook Delivery
+Order events (SMS received, expired, cancelled) are written to the
+WebhookDelivery outbox in the same transaction as the status change that
+caused them, then sent by the deliver_webhooks daemon:
+
+- Events queued for the same endpoint are batched into one POST
+- Endpoints are called concurrently from a thread pool
+- Each request is signed: X-Webhook-Signature: t=<unix time>,v1=<hex HMAC-SHA256
+  of "<t>.<body>" keyed with the webhook secret>
+- Failures are retried with exponential backoff (plus jitter) up to
+  WEBHOOK_MAX_ATTEMPTS, after which the delivery is marked FAILED
+"""
+
+import hashlib
+import hmac
+import json
+import logging
+import random
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from typing import Dict, List, Optional
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .api_models import APIOrderMapping, APIWebhook, WebhookDelivery
+from .http_transport import get_transport
+
+logger = logging.getLogger(__name__)
+
+# Event name -> APIWebhook subscription flag
+EVENT_FLAGS = {
+    'sms_received': 'on_sms_received',
+    'order_expired': 'on_order_expired',
+    'order_cancelled': 'on_order_cancelled',
+}
+
+STATUS_EVENTS = {
+    'RECEIVED': 'sms_received',
+    'EXPIRED': 'order_expired',
+    'CANCELLED': 'order_cancelled',
+}
+
+
+def emit_order_event(event: str, rental, code: Optional[str] = None) -> int:
+    """
+    Queue a webhook event for every reseller order backed by a rental
+
+    Call it inside the transaction that changes the rental's status so the
+    event is only queued if the change commits. Duplicate events for the same
+    order are ignored.
+
+    Returns:
+        Number of deliveries created (including ignored duplicates)
+    """
+    flag = EVENT_FLAGS[event]
+    mappings = list(
+        APIOrderMapping.objects.filter(rental=rental).select_related('api_key')
+    )
+    if not mappings:
+        return 0
+
+    user_ids = {mapping.api_key.user_id for mapping in mappings}
+    webhooks: Dict[int, List[APIWebhook]] = {}
+    for webhook in APIWebhook.objects.filter(user_id__in=user_ids, is_active=True, **{flag: True}):
+        webhooks.setdefault(webhook.user_id, []).append(webhook)
+    if not webhooks:
+        return 0
+
+    deliveries = []
+    for mapping in mappings:
+        payload = {
+            'event': event,
+            'order_id': mapping.api_order_id,
+            'rental_id': rental.rental_id,
+            'phone_number': rental.phone_number,
+            'status': rental.status,
+            'code': code,
+            'occurred_at': timezone.now().isoformat(),
+        }
+        for webhook in webhooks.get(mapping.api_key.user_id, []):
+            deliveries.append(WebhookDelivery(
+                webhook=webhook,
+                event=event,
+                payload=payload,
+                dedupe_key=f"{webhook.id}:{event}:{mapping.api_order_id}",
+            ))
+
+    WebhookDelivery.objects.bulk_create(deliveries, ignore_conflicts=True)
+    return len(deliveries)
+
+
+def emit_status_event(rental, code: Optional[str] = None) -> int:
+    """Queue the event matching the rental's current status, if there is one"""
+    event = STATUS_EVENTS.get(rental.status)
+    if event is None:
+        return 0
+    return emit_order_event(event, rental, code=code)
+
+
+def sign_payload(secret: str, body: str, timestamp: Optional[int] = None) -> str:
+    """Signature header value for a request body"""
+    timestamp = int(time.time()) if timestamp is None else timestamp
+    digest = hmac.new(secret.encode(), f"{timestamp}.{body}".encode(), hashlib.sha256).hexdigest()
+    return f"t={timestamp},v1={digest}"
+
+
+class WebhookDispatcher:
+    """
+    Sends due WebhookDelivery rows, batching per endpoint
+    """
+
+    def __init__(self, concurrency: Optional[int] = None, batch_size: Optional[int] = None,
+                 max_attempts: Optional[int] = None):
+        self.concurrency = concurrency or getattr(settings, 'WEBHOOK_CONCURRENCY', 8)
+        self.batch_size = batch_size or getattr(settings, 'WEBHOOK_BATCH_SIZE', 50)
+        self.max_attempts = max_attempts or getattr(settings, 'WEBHOOK_MAX_ATTEMPTS', 8)
+        self.backoff_base = getattr(settings, 'WEBHOOK_BACKOFF_BASE', 10)  # seconds
+        self.backoff_max = getattr(settings, 'WEBHOOK_BACKOFF_MAX', 3600)
+        self.lease_seconds = getattr(settings, 'WEBHOOK_LEASE_SECONDS', 60)
+        self.transport = get_transport('webhooks', headers={'Content-Type': 'application/json'})
+
+    def claim(self, limit: int = 500) -> List[WebhookDelivery]:
+        """
+        Lease due deliveries so concurrent dispatchers don't send them twice
+
+        Claimed rows have next_attempt_at pushed past the lease; if this
+        process dies they become due again once it runs out.
+        """
+        now = timezone.now()
+        # Microsecond offset makes this dispatcher's lease value unique
+        lease_until = now + timedelta(seconds=self.lease_seconds, microseconds=random.randint(0, 999999))
+        with transaction.atomic():
+            ids = list(
+                WebhookDelivery.objects.select_for_update(skip_locked=True)
+                .filter(status='PENDING', next_attempt_at__lte=now)
+                .order_by('next_attempt_at')
+                .values_list('id', flat=True)[:limit]
+            )
+            if not ids:
+                return []
+            WebhookDelivery.objects.filter(
+                id__in=ids, status='PENDING', next_attempt_at__lte=now
+            ).update(next_attempt_at=lease_until)
+        return list(
+            WebhookDelivery.objects.filter(id__in=ids, next_attempt_at=lease_until)
+            .select_related('webhook').order_by('created_at')
+        )
+
+    def run_once(self) -> Dict[str, int]:
+        """
+        Send everything that is due
+
+        Returns:
+            {'delivered': n, 'retrying': n, 'failed': n}
+        """
+        deliveries = self.claim()
+        totals = {'delivered': 0, 'retrying': 0, 'failed': 0}
+        if not deliveries:
+            return totals
+
+        batches = []
+        by_webhook: Dict[int, List[WebhookDelivery]] = {}
+        for delivery in deliveries:
+            by_webhook.setdefault(delivery.webhook_id, []).append(delivery)
+        for group in by_webhook.values():
+            for start in range(0, len(group), self.batch_size):
+                batches.append(group[start:start + self.batch_size])
+
+        with ThreadPoolExecutor(max_workers=min(self.concurrency, len(batches))) as pool:
+            results = list(pool.map(self._send, batches))
+
+        for batch, error in zip(batches, results):
+            outcome = self._record(batch, error)
+            for key, count in outcome.items():
+                totals[key] += count
+        return totals
+
+    def _send(self, batch: List[WebhookDelivery]) -> Optional[str]:
+        """POST a batch to its endpoint; returns an error message or None"""
+        webhook = batch[0].webhook
+        body = json.dumps({'events': [delivery.payload for delivery in batch]}, cls=DjangoJSONEncoder)
+        headers = {
+            'X-Webhook-Signature': sign_payload(webhook.secret, body),
+            'X-Webhook-Id': str(uuid.uuid4()),
+        }
+        try:
+            response = self.transport.post(webhook.url, data=body, headers=headers, idempotent=False)
+        except Exception as e:
+            return str(e)
+        if 200 <= response.status_code < 300:
+            return None
+        return f"HTTP {response.status_code}: {response.text[:200]}"
+
+    def _backoff(self, attempts: int) -> timedelta:
+        delay = min(self.backoff_max, self.backoff_base * (2 ** (attempts - 1)))
+        return timedelta(seconds=delay * random.uniform(0.8, 1.2))
+
+    def _record(self, batch: List[WebhookDelivery], error: Optional[str]) -> Dict[str, int]:
+        now = timezone.now()
+        webhook = batch[0].webhook
+        ids = [delivery.id for delivery in batch]
+
+        if error is None:
+            WebhookDelivery.objects.filter(id__in=ids).update(
+                status='DELIVERED', attempts=F('attempts') + 1, delivered_at=now, last_error=''
+            )
+            APIWebhook.objects.filter(pk=webhook.pk).update(
+                total_sent=F('total_sent') + len(batch), last_success_at=now
+            )
+            return {'delivered': len(batch), 'retrying': 0, 'failed': 0}
+
+        logger.warning(f"Webhook {webhook.url} failed for {len(batch)} event(s): {error}")
+        failed = 0
+        for delivery in batch:
+            attempts = delivery.attempts + 1
+            if attempts >= self.max_attempts:
+                delivery.status = 'FAILED'
+                failed += 1
+            else:
+                delivery.next_attempt_at = now + self._backoff(attempts)
+            delivery.attempts = attempts
+            delivery.last_error = error[:1000]
+        WebhookDelivery.objects.bulk_update(batch, ['status', 'attempts', 'next_attempt_at', 'last_error'])
+
+        updates = {'last_failure_at': now}
+        if failed:
+            updates['total_failed'] = F('total_failed') + failed
+        APIWebhook.objects.filter(pk=webhook.pk).update(**updates)
+        return {'delivered': 0, 'retrying': len(batch) - failed, 'failed': failed}
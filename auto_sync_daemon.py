@@ -1,6 +1,9 @@
 """
 Auto-sync daemon for 5sim services and pricing
 This script runs continuously and syncs data at specified intervals
+
+Superseded by `python manage.py run_jobs`, which runs these syncs alongside
+the cancel/refund jobs in one process.
 """
 import os
 import sys
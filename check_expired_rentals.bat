@@ -1,6 +1,7 @@
 @echo off
 REM Check for expired MTelSMS rentals and issue automatic refunds
 REM Run this every 5-10 minutes via Windows Task Scheduler
+REM (not needed when `python manage.py run_jobs` is running - it includes this check)
 
 cd /d "%~dp0"
 python manage.py check_expired_rentals --limit 100
@@ -447,48 +447,96 @@ async function checkActiveOrdersForSMS() {
     }
 }
 
-// *** THIS IS THE FINAL, CORRECTED FUNCTION ***
 async function checkOrderSMSUpdate(orderId, row) {
     try {
         const response = await fetch(`/api/5sim/order/${orderId}/status/`);
         const data = await response.json();
+        if (data.success && applyOrderUpdate(orderId, data)) await loadRecentOrders();
+    } catch (error) {
+        console.error(`Error checking SMS for order ${orderId}:`, error);
+    }
+}
 
-        // If the API call fails or there's no code, do nothing.
-        if (!data.success || !data.sms_code) {
-            // If the order has a final status (like TIMEOUT), refresh the whole list
-            if (data.status && ['CANCELLED', 'FINISHED', 'TIMEOUT'].includes(data.status)) {
-                await loadRecentOrders();
-            }
-            return;
-        }
+// Apply an order status/SMS update from polling or the live stream.
+// Returns true when the order list needs reloading (the caller reloads once
+// for a whole batch of updates).
+function applyOrderUpdate(orderId, data) {
+    const row = document.querySelector(`#recentOrdersTable tr[data-order-id="${orderId}"]`);
 
-        // SUCCESS! The code is in the response. Update the UI directly.
-        const smsCode = data.sms_code.trim();
-        console.log(`✅ SMS Code Received: ${smsCode} for order ${orderId}. Updating UI.`);
+    // Only rows still showing a loader can be out of date
+    if (!row || !row.querySelector('.code-column .loading-spinner')) return false;
 
-        const codeCell = row.querySelector('.code-column');
-        const timerCell = row.querySelector('.countdown-timer');
-        const statusCell = row.querySelector('.status-column');
+    // Without a code, only a final status matters: the row has to go
+    if (!data.sms_code) {
+        return Boolean(data.status && ['CANCELLED', 'CANCELED', 'FINISHED', 'TIMEOUT', 'EXPIRED'].includes(data.status));
+    }
 
-        if (codeCell) {
-            codeCell.innerHTML = `<span class="code-text text-success fw-bold">${smsCode}</span>`;
-            codeCell.setAttribute('data-copy', smsCode);
-        }
-        if (timerCell) {
-            if (timerCell.intervalId) clearInterval(timerCell.intervalId);
-            timerCell.innerHTML = '✅';
-            timerCell.setAttribute('data-has-code', 'true');
-        }
-        if (statusCell) {
-            statusCell.innerHTML = '<span class="status-success">Success</span>';
-        }
+    const smsCode = data.sms_code.trim();
+    console.log(`✅ SMS Code Received: ${smsCode} for order ${orderId}. Updating UI.`);
 
-        showSuccess(`SMS code received: ${smsCode}`);
-        playNotificationSound();
+    const codeCell = row.querySelector('.code-column');
+    const timerCell = row.querySelector('.countdown-timer');
+    const statusCell = row.querySelector('.status-column');
 
-    } catch (error) {
-        console.error(`Error checking SMS for order ${orderId}:`, error);
+    if (codeCell) {
+        codeCell.innerHTML = `<span class="code-text text-success fw-bold">${smsCode}</span>`;
+        codeCell.setAttribute('data-copy', smsCode);
+    }
+    if (timerCell) {
+        if (timerCell.intervalId) clearInterval(timerCell.intervalId);
+        timerCell.innerHTML = '✅';
+        timerCell.setAttribute('data-has-code', 'true');
+    }
+    if (statusCell) {
+        statusCell.innerHTML = '<span class="status-success">Success</span>';
     }
+
+    showSuccess(`SMS code received: ${smsCode}`);
+    playNotificationSound();
+    return false;
+}
+
+// Live updates: one Server-Sent Events stream replaces per-order polling.
+// Polling takes over when the browser has no EventSource or the server
+// turns the stream off.
+let liveUpdates = null;
+let smsPollTimer = null;
+
+function startSMSPolling() {
+    if (!smsPollTimer) smsPollTimer = setInterval(checkActiveOrdersForSMS, 5000);
+}
+
+function stopSMSPolling() {
+    if (smsPollTimer) {
+        clearInterval(smsPollTimer);
+        smsPollTimer = null;
+    }
+}
+
+function startLiveUpdates() {
+    if (!window.EventSource) {
+        startSMSPolling();
+        return;
+    }
+    liveUpdates = new EventSource('/api/events/');
+    liveUpdates.addEventListener('open', stopSMSPolling);
+    liveUpdates.addEventListener('snapshot', (e) => {
+        // Sent on every (re)connect: catches anything missed while disconnected,
+        // with at most one list reload for the whole snapshot
+        const needsReload = JSON.parse(e.data).orders
+            .filter(order => order.type === 'fivesim_order')
+            .map(order => applyOrderUpdate(order.id, order))
+            .some(Boolean);
+        if (needsReload) loadRecentOrders();
+    });
+    liveUpdates.addEventListener('fivesim_order', (e) => {
+        const order = JSON.parse(e.data);
+        if (applyOrderUpdate(order.id, order)) loadRecentOrders();
+    });
+    liveUpdates.addEventListener('error', () => {
+        // EventSource reconnects by itself; poll until it does, or for good if it gave up
+        startSMSPolling();
+    });
 }
 
 function cleanupExpiredOrders() {
@@ -508,8 +556,8 @@ async function initialize() {
     setupDropdown('country');
     setupDropdown('service');
     await loadRecentOrders();
-    // Start the polling loop
-    setInterval(checkActiveOrdersForSMS, 5000);
+    // Stream SMS updates (falls back to the polling loop)
+    startLiveUpdates();
     // Start the cleanup loop for expired orders
     setInterval(cleanupExpiredOrders, 30000);
     console.log('✅ Dashboard initialization complete');
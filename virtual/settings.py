@@ -10,6 +10,8 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.1/ref/settings/
 """
 
+import os
+import tempfile
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -142,6 +144,11 @@ EMAIL_PORT = 587
 EMAIL_USE_TLS = True
 
 
+# 5sim Pricing (5sim charges in RUB)
+EXCHANGE_RATE_RUB_TO_NGN = 20
+FIVESIM_FIXED_PROFIT_NGN = 1000  # Added to the price of every 5sim number
+
+
 # Authentication Configuration
 AUTHENTICATION_BACKENDS = [
     'app.auth_backends.EmailOrUsernameModelBackend',
@@ -173,8 +180,26 @@ LOGGING = {
             'level': 'INFO',
             'class': 'logging.StreamHandler',
         },
+        # Kora Pay webhook trace, written off the request thread
+        'korapay_debug': {
+            'level': 'DEBUG',
+            'class': 'app.log_handlers.QueuedFileHandler',
+            'filename': BASE_DIR / 'korapay_debug.txt',
+            'formatter': 'timestamped',
+        },
+    },
+    'formatters': {
+        'timestamped': {
+            'format': '{asctime} {message}',
+            'style': '{',
+        },
     },
     'loggers': {
+        'app.unified_korapay.debug': {
+            'handlers': ['korapay_debug'],
+            'level': 'DEBUG',
+            'propagate': False,
+        },
         'app.mtelsms': {
             'handlers': ['file', 'console'],
             'level': 'INFO',
@@ -207,5 +232,23 @@ CACHES = {
         'OPTIONS': {
             'MAX_ENTRIES': 1000,
         }
+    },
+    # Provider responses (5sim prices, MTelSMS services) shared by all web
+    # workers, daemons and management commands - see app/provider_cache.py
+    'shared': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.environ.get('SHARED_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'virtual_shared_cache')),
+        'TIMEOUT': 600,
+        'OPTIONS': {
+            'MAX_ENTRIES': 5000,
+        }
     }
-}
\ No newline at end of file
+}
+
+# Use Redis for the shared cache when available
+if os.environ.get('REDIS_URL'):
+    CACHES['shared'] = {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': os.environ['REDIS_URL'],
+        'TIMEOUT': 600,
+    }
\ No newline at end of file
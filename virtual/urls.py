@@ -76,6 +76,7 @@ urlpatterns = [
     path('api/cancel/', cancel_rental, name='api_cancel'),
     path('api/rentals/', get_rentals, name='api_rentals'),
     path('api/sms/<str:rental_id>/', check_sms, name='api_check_sms'),
+    path('api/events/', order_events, name='api_order_events'),
     path('api/transactions/', get_transactions, name='api_transactions'),
     path('api/rental-history/', get_rental_history, name='api_rental_history'),
     path('api/sync-services/', sync_services, name='api_sync_services'),